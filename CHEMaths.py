@@ -6,15 +6,21 @@ Functionality:
     - balancing equation, determining oxidation state(/number)
 Author: Jingjie YANG (j.yang19 at ejm.org)"""
 
-import decimal
+import argparse
+import collections
+import functools
+import math
 import string
 import fractions
-import time
 import json
 import re
+import threading
+import numpy
 import latex_parser
-from simpleeval import simple_eval
-from linear_algebra import Matrix, ext_euclid, gcd_multiple, lcm_multiple, partition
+from profiling import Profile
+from linear_algebra import IncrementalRowReduction, Matrix, Vector, gcd_multiple, lcm_multiple
+from isomers import alkane_isomers, count_alkane_isomers, parallel_alkane_isomers
+from isotopes import THRESHOLD, isotope_pattern, isotope_patterns
 
 with open("static/data.json") as data:
     data_dict = json.loads(data.read())
@@ -25,6 +31,101 @@ with open("static/data.json") as data:
     ]
 
 
+# Rules of oxidation numbers, compiled once over the element classification:
+# element -> (priority, rule); rules are applied by increasing priority, elements without rule are deduced last
+OXIDATION_RULES = {}
+for _element in relative_atomic_mass:
+    if _element == 'H':  # +1 with non-metals, -1 with metals
+        OXIDATION_RULES[_element] = (3, 'hydrogen')
+    elif _element == 'F':  # always -1
+        OXIDATION_RULES[_element] = (0, 'fluorine')
+    elif _element in alkali_metals:  # Group 1A always +1
+        OXIDATION_RULES[_element] = (1, 'alkali metal')
+    elif _element in alkali_earth_metals:  # Group 2A always +2
+        OXIDATION_RULES[_element] = (2, 'alkali earth metal')
+    elif _element in halogens:  # -1 unless bonded to O, N or a lighter halogen
+        OXIDATION_RULES[_element] = (4, 'halogen')
+NO_OXIDATION_RULE = (5, None)
+
+# Usual valences, for the double bond equivalent (DBE) of a formula: DBE = 1 + sum of count * (valence - 2) / 2
+VALENCES = dict(
+    {'H': 1, 'B': 3, 'C': 4, 'N': 3, 'O': 2, 'Al': 3, 'Si': 4, 'P': 3, 'S': 2, 'Ge': 4, 'As': 3, 'Se': 2},
+    **{element: 1 for element in alkali_metals + halogens}, **{element: 2 for element in alkali_earth_metals}
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def calculate_canonical_oxidation(composition: tuple, sign: int) -> tuple:
+    """Oxidation numbers of a canonical composition (sorted (element, quantity) pairs, without 'sign') and charge
+    Results are memoized; return a tuple of (element, oxidation number) pairs"""
+    quantities = dict(composition)
+    oxidation = {}
+    if len(quantities) == 1:  # pure element or monatomic ion
+        (element,) = quantities
+        return (element, sign),
+
+    for element in sorted(quantities, key=lambda e: OXIDATION_RULES.get(e, NO_OXIDATION_RULE)[0]):
+        rule = OXIDATION_RULES.get(element, NO_OXIDATION_RULE)[1]
+        if rule is None:
+            break  # only elements without rule are left
+        other_elements = quantities.keys() - {element}
+        if rule == 'hydrogen':
+            (other_element,) = other_elements if len(other_elements) == 1 else (None,)
+            oxidation[element] = -1 if other_element and other_element not in non_metals else 1
+        elif rule == 'fluorine':
+            oxidation[element] = -1
+        elif rule == 'alkali metal':
+            oxidation[element] = 1
+        elif rule == 'alkali earth metal':
+            oxidation[element] = 2
+        elif all([
+            halogens.index(element) <= halogens.index(element2) if element2 in halogens
+            else (element2 != 'O' and element2 != 'N')
+            for element2 in other_elements
+        ]):
+            oxidation[element] = -1
+        else:
+            continue
+        sign -= oxidation[element] * quantities[element]
+        # stop as soon as only one element is left: its oxidation number follows from the charge
+        if len(quantities) == len(oxidation) + 1:
+            (other_element,) = quantities.keys() - oxidation.keys()
+            oxidation[other_element] = fractions.Fraction(sign, quantities[other_element])
+            return tuple(oxidation.items())
+
+    remaining = quantities.keys() - oxidation.keys()
+    if 'O' in remaining:
+        oxidation['O'] = -2
+        sign -= (-2) * quantities['O']
+        if len(remaining) == 2:
+            (other_element,) = remaining - oxidation.keys()
+            oxidation[other_element] = fractions.Fraction(sign, quantities[other_element])
+    return tuple(oxidation.items())
+
+
+def calculate_oxidations(molecular_formulas: list) -> list:
+    """Return the oxidation numbers of many parsed molecular formulas at once (one dictionary each)
+    Formulas with the same composition and charge are only computed once"""
+    results = []
+    for molecular_formula in molecular_formulas:
+        composition = tuple(sorted(
+            (element, quantity) for element, quantity in molecular_formula.items() if element != 'sign'
+        ))
+        oxidation = dict(calculate_canonical_oxidation(composition, molecular_formula.get('sign', 0)))
+        # keep the order of the elements in the formula
+        results.append({element: oxidation[element] for element in molecular_formula if element in oxidation})
+    return results
+
+
+def calculate_formula_mass(molecular_formula: dict) -> float:
+    """Calculate the relative formula mass of a parsed molecular formula (as returned by latex2chem)"""
+    return sum(
+        relative_atomic_mass[element] * quantity
+        if element != "sign" else 0
+        for element, quantity in molecular_formula.items()
+    )
+
+
 def get_bond_enthalpy(element1: str, element2: str, bond='single bond') -> int:
     """Utility function that retrieves the bond enthalpy between element1 and element2 (regardless or order)
     An optional argument, bond, describing the bond (single, double, triple) could be specified
@@ -178,48 +279,28 @@ class Molecule:
         return cls(molecular_formula, raw_string=latex_string, mass=mass, mole=mole)
 
     @classmethod
-    def from_ratio(cls, quantity: dict, latex=False) -> 'Molecule':
-        """Calculate empirical formula of a compound given its atoms' mass or percentage of mass in the compound."""
-        # Init
-        decimal.getcontext().prec = 2
-        dict_processing = {}
-        molecular_formula = {}
-        # TODO: complete this
-        # Calculate the relative ratio for each element
-        # through dividing its weight / percentage by its relative atomic mass
-        for chemical, chemical_weight in quantity.items():
-            if latex:
-                parsed = cls.from_latex(chemical)
-            else:
-                parsed = cls.from_string(chemical)
-            relative_formula_mass = parsed.mr
-
-            ratio = decimal.Decimal(chemical_weight) / decimal.Decimal(relative_formula_mass)
-            dict_processing[chemical] = fractions.Fraction(ratio)
-
-        common_multiple = lcm_multiple(*[fraction.denominator for fraction in dict_processing.values()])
-        common_divisor = gcd_multiple(*[fraction.numerator for fraction in dict_processing.values()])
-
-        for chemical, ratio in dict_processing.items():
-            molecular_formula[chemical] = int(ratio * common_multiple / common_divisor)
-        if len(molecular_formula) != 1 and any([value > 16 for value in molecular_formula.values()]):
-            if len(molecular_formula) == 2:
-                # solve for |ax + by| = 1
-                element1, element2 = molecular_formula.keys()
-                ratio1, ratio2 = molecular_formula.values()
-                coefficient1, coefficient2, _ = ext_euclid(ratio2, -ratio1)
-                molecular_formula[element1] = coefficient1
-                molecular_formula[element2] = coefficient2
-        molecular_formula['sign'] = 0
-        return Molecule(molecular_formula)  # place holder
+    def from_ratio(cls, quantity: dict, latex=False, tolerance=0.1, max_multiplier=12, parsed=None) -> 'Molecule':
+        """Calculate empirical formula of a compound given its atoms' mass or percentage of mass in the compound.
+        See calculate_empirical_formulas for the meaning of tolerance, max_multiplier and parsed"""
+        molecular_formula = calculate_empirical_formulas(
+            [quantity], latex=latex, tolerance=tolerance, max_multiplier=max_multiplier, parsed=parsed
+        )[0]
+        return cls(molecular_formula)
+
+    @classmethod
+    def search_by_mr(cls, target: float, tolerance: float, element_ranges: dict, charge=0, min_dbe=None,
+                     even_electron=None):
+        """Generate the molecules whose relative formula mass is within tolerance of target (inverse of calculate_mr)
+        See search_molecular_formulas for the arguments; ex: Molecule.search_by_mr(180.16, 0.01, {'C': (0, 12),
+        'H': (0, 24), 'O': (0, 8)}, min_dbe=0, even_electron=True) yields C6H12O6 among others"""
+        for molecular_formula in search_molecular_formulas(
+            target, tolerance, element_ranges, charge=charge, min_dbe=min_dbe, even_electron=even_electron
+        ):
+            yield cls(molecular_formula)
 
     def calculate_mr(self) -> float:
         """Calculate relative formula mass for dictionary input processed by function process_formula."""
-        return sum(
-            relative_atomic_mass[element] * quantity
-            if element != "sign" else 0
-            for element, quantity in self.molecular_formula.items()
-        )
+        return calculate_formula_mass(self.molecular_formula)
 
     def calculate_percentages(self) -> dict:
         """Calculate the percentage by mass of an element in the compound. """
@@ -236,62 +317,15 @@ class Molecule:
         """Calculate number of moles of compound given its relative formula mass and mass."""
         return mass / self.mr
 
+    def calculate_isotope_pattern(self, threshold=THRESHOLD) -> list:
+        """Return the centroided isotope pattern, a list of (mass, intensity relative to the base peak) by mass
+        See isotopes.isotope_patterns to compute many molecules at once"""
+        return isotope_pattern(self.molecular_formula, threshold=threshold)
+
     def calculate_oxidation(self) -> dict:
         """Return the oxidation number of all elements in the input dictionary
         'Bear in mind: this is merely a model'  - Mr. Osler"""
-        sign = self.molecular_formula["sign"]
-        dict_processing = self.molecular_formula.copy()
-        oxidation = {}
-        del dict_processing["sign"]
-
-        if len(dict_processing.keys()) == 1:  # pure element or monatomic ion
-            for element in dict_processing.keys():
-                oxidation[element] = sign
-
-        else:  # more than one elements
-            for element, quantity in dict_processing.items():
-                if element == 'H':  # Hydrogen always has charge +1 with nonmetals and -1 with metals
-                    oxidation['H'] = 1
-                    other_elements = dict_processing.keys() - {'H'}
-                    if len(other_elements) == 1:
-                        (other_element,) = other_elements
-                        if other_element not in non_metals:  # directly bonded with metals
-                            oxidation['H'] = -1
-                    sign -= oxidation['H'] * quantity
-                elif element == 'F':  # Fluorine always has charge -1
-                    oxidation['F'] = -1
-                    sign -= (-1) * quantity
-                elif element in alkali_metals:  # Group 1A always has charge 1+
-                    oxidation[element] = 1
-                    sign -= 1 * quantity
-                elif element in alkali_earth_metals:  # Group 2A always has charge 2+
-                    oxidation[element] = 2
-                    sign -= 2 * quantity
-                elif element in halogens:
-                    other_elements = dict_processing.keys() - {element}
-                    if all([
-                                halogens.index(element) <= halogens.index(element2) if element2 in halogens
-                                else (element2 is not 'O' and element2 is not 'N')
-                                for element2 in other_elements
-                    ]):
-                        oxidation[element] = -1
-                        sign -= oxidation[element] * quantity
-                else:
-                    continue
-                # break loop prematurely if process is finished
-                if len(dict_processing) == len(oxidation) + 1:
-                    (other_element,) = dict_processing.keys() - oxidation.keys()
-                    oxidation[other_element] = fractions.Fraction(sign, dict_processing[other_element])
-                    break
-            else:
-                remaining = dict_processing.keys() - oxidation.keys()
-                if 'O' in remaining:
-                    oxidation['O'] = -2
-                    sign -= (-2) * dict_processing['O']
-                    if len(remaining) == 2:
-                        (other_element,) = remaining - oxidation.keys()
-                        oxidation[other_element] = fractions.Fraction(sign, dict_processing[other_element])
-        return oxidation
+        return calculate_oxidations([self.molecular_formula])[0]
 
     def get_elements(self) -> list:
         """Return the ordered collection of elements present in the input string"""
@@ -331,10 +365,298 @@ class Molecule:
         ])
 
 
+class Polymer:
+    """Implementation of a polymer: a repeat unit repeated `count` times between end groups
+    count is an integer or a name ('n'); nothing is expanded, every value being linear in the count"""
+
+    def __init__(self, repeat_unit: dict, count, end_groups=None, raw_string=''):
+        self.formula_string = raw_string
+        self.repeat_unit = {element: quantity for element, quantity in repeat_unit.items() if element != 'sign'}
+        self.count = count
+        self.end_groups = {
+            element: quantity for element, quantity in (end_groups or {}).items() if element != 'sign' and quantity
+        }
+        self.elements = list(self.repeat_unit) + [
+            element for element in self.end_groups if element not in self.repeat_unit
+        ]
+        self.unit_mr = calculate_formula_mass(self.repeat_unit)
+        self.end_mr = calculate_formula_mass(self.end_groups)
+        self.latex_repeat_unit = ''.join(
+            f'{i}_{{{j}}}' if j != 1 else i for i, j in self.repeat_unit.items()
+        )
+
+    def __repr__(self) -> str:
+        return f"Polymer({self.repeat_unit}, {self.count!r}, end_groups={self.end_groups})"
+
+    @classmethod
+    def from_latex(cls, latex_string) -> 'Polymer':
+        """Construct a Polymer instance from a latex string such as H(C_2H_4)_{n}H"""
+        split = latex_parser.split_repeat_unit(latex_string)
+        if split is None:
+            raise ValueError(f"{latex_string}: no repeat unit with a symbolic or large count")
+        head, unit, count, tail = split
+        end_groups = collections.Counter()
+        for end_group in (head, tail):
+            if end_group:
+                end_groups.update(latex_parser.latex2chem(end_group))
+        return cls(latex_parser.latex2chem(unit), count, dict(end_groups), raw_string=latex_string)
+
+    @property
+    def is_symbolic(self) -> bool:
+        """Whether the count is a name rather than an integer"""
+        return isinstance(self.count, str)
+
+    def resolve_count(self, n):
+        """n, or the count of the polymer if it is an integer"""
+        if n is None:
+            if self.is_symbolic:
+                raise ValueError(f"{self.count} has no value: give n")
+            return self.count
+        return n
+
+    def composition(self, n=None) -> dict:
+        """Molecular formula of the polymer with n repeat units"""
+        n = self.resolve_count(n)
+        return {
+            element: self.repeat_unit.get(element, 0) * n + self.end_groups.get(element, 0)
+            for element in self.elements
+        }
+
+    def calculate_mr(self, n=None) -> float:
+        """Relative formula mass with n repeat units"""
+        return self.unit_mr * self.resolve_count(n) + self.end_mr
+
+    def calculate_percentages(self, n=None) -> dict:
+        """Percentage by mass of each element with n repeat units
+        With a symbolic count and no n, the limit for long chains (that of the repeat unit)"""
+        if n is None and self.is_symbolic:
+            return {
+                element: self.repeat_unit.get(element, 0) * relative_atomic_mass[element] / self.unit_mr * 100
+                for element in self.elements
+            }
+        mr = self.calculate_mr(n)
+        return {
+            element: quantity * relative_atomic_mass[element] / mr * 100
+            for element, quantity in self.composition(n).items()
+        }
+
+    def calculate_empirical_formula(self, n=None) -> dict:
+        """Empirical formula with n repeat units
+        With a symbolic count and no n, the limit for long chains (that of the repeat unit)"""
+        composition = self.repeat_unit if n is None and self.is_symbolic else self.composition(n)
+        divisor = gcd_multiple(*composition.values())
+        return {element: quantity // divisor for element, quantity in composition.items() if quantity}
+
+    def get_mr_latex(self) -> str:
+        """Relative formula mass as a function of the count, e.g. 28.054n+2.016"""
+        if not self.is_symbolic:
+            return str(self.calculate_mr())
+        return f"{self.unit_mr}{self.count}" + (f"+{self.end_mr}" if self.end_groups else '')
+
+    def evaluate(self, ns) -> dict:
+        """Mr and percentages by mass for many counts at once
+        Return {'n': array, 'mr': array, 'percentages': {element: array}}"""
+        ns = numpy.asarray(ns, dtype=float)
+        mr = self.unit_mr * ns + self.end_mr
+        return {
+            'n': ns,
+            'mr': mr,
+            'percentages': {
+                element: (self.repeat_unit.get(element, 0) * ns + self.end_groups.get(element, 0))
+                * relative_atomic_mass[element] / mr * 100
+                for element in self.elements
+            }
+        }
+
+
+def species_key(molecular_formula: dict, side: int) -> tuple:
+    """Hashable (side, sorted (element, quantity) pairs) of a species; side is 1 for reactants, -1 for products"""
+    return side, tuple(sorted((element, quantity) for element, quantity in molecular_formula.items() if quantity))
+
+
+class CompositionReduction:
+    """Row reduction of the composition matrix of a reaction (see Equation.build_composition_matrix) updated one
+    species at a time: a species typed onto an equation appends a column (and a row per new element) instead of
+    reducing the whole matrix again. Columns are in the order the species were added, which does not change
+    the smallest integer coefficients. Rows of elements that no species has any more stay, as zero rows."""
+
+    def __init__(self):
+        self.elements = {}  # element -> row
+        self.columns = []  # species key of each column
+        self.reduction = IncrementalRowReduction()
+
+    @classmethod
+    def from_species(cls, reactants: list, products: list) -> 'CompositionReduction':
+        """Reduction of the composition matrix of reactants and products (parsed molecular formulas)"""
+        reduction = cls()
+        entries = []
+        for column, (molecular_formula, side) in enumerate(
+                zip(reactants + products, [1] * len(reactants) + [-1] * len(products))):
+            key = species_key(molecular_formula, side)
+            for element, quantity in key[1]:
+                row = reduction.elements.setdefault(element, len(reduction.elements))
+                entries.append((row, column, side * quantity))
+            reduction.columns.append(key)
+        matrix = Matrix(len(reduction.elements), len(reduction.columns))
+        for row, column, value in entries:
+            matrix.assign_new_value(row, column, value)
+        reduction.reduction = IncrementalRowReduction.from_matrix(matrix)
+        return reduction
+
+    @property
+    def key(self) -> tuple:
+        """Sorted species keys: the same for any order of the species"""
+        return tuple(sorted(self.columns))
+
+    def copy(self) -> 'CompositionReduction':
+        """Independent copy, to update while keeping this one"""
+        reduction = CompositionReduction()
+        reduction.elements = dict(self.elements)
+        reduction.columns = list(self.columns)
+        reduction.reduction = self.reduction.copy()
+        return reduction
+
+    def add_species(self, molecular_formula: dict, side: int):
+        """Append the column of a species (side: 1 for a reactant, -1 for a product), in place"""
+        key = species_key(molecular_formula, side)
+        for element, _ in key[1]:
+            if element not in self.elements:
+                self.elements[element] = len(self.elements)
+                self.reduction.append_row([0] * len(self.columns))
+        column = [0] * len(self.elements)
+        for element, quantity in key[1]:
+            column[self.elements[element]] = side * quantity
+        self.reduction.append_column(column)
+        self.columns.append(key)
+
+    def remove_species(self, molecular_formula: dict, side: int):
+        """Remove the (last added) column of a species, in place"""
+        key = species_key(molecular_formula, side)
+        column = len(self.columns) - 1 - self.columns[::-1].index(key)
+        self.reduction.remove_column(column)
+        del self.columns[column]
+
+    def coefficient_vectors(self, reactants: list, products: list) -> list:
+        """Basis of the null space of the composition matrix, with the entries in the order of the species of
+        the reaction (which should have the same species as this reduction)"""
+        columns = collections.defaultdict(list)  # species key -> its columns, in order
+        for column, key in enumerate(self.columns):
+            columns[key].append(column)
+        order = [
+            columns[species_key(molecular_formula, side)].pop(0)
+            for molecular_formula, side in zip(reactants + products, [1] * len(reactants) + [-1] * len(products))
+        ]
+        return [Vector([vector.vector[column] for column in order]) for vector in self.reduction.null_space()]
+
+
+class ReductionCache:
+    """Recently used composition reductions (least recently used ones dropped), found for a reaction by its species
+    or from a neighbour with one species more, one less or one replaced, which is what a keystroke changes
+    A reaction missing from the cache is balanced the usual (modular) way, faster than building its reduction:
+    only its species are kept, and its reduction is built once a neighbour needs it."""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> CompositionReduction (never changed once cached) or (reactants, products) to build it from
+        self.reductions = collections.OrderedDict()
+        self.neighbours = collections.defaultdict(set)  # key with one species removed -> cached keys
+        self.counters = dict.fromkeys(['hits', 'neighbours', 'built', 'misses'], 0)
+
+    @staticmethod
+    def variants(key: tuple) -> dict:
+        """Keys with one species removed -> the species removed"""
+        return {key[:index] + key[index + 1:]: species for index, species in enumerate(key)}
+
+    def find(self, key: tuple) -> tuple:
+        """(key of the cached neighbour, species to add, species to remove) closest to key, or (None, None, None)"""
+        if key in self.reductions:
+            return key, None, None
+        variants = self.variants(key)
+        for variant, species in variants.items():  # one species added
+            if variant in self.reductions:
+                return variant, species, None
+        for neighbour in self.neighbours.get(key, ()):  # one species removed
+            return neighbour, None, self.variants(neighbour)[key]
+        for variant, species in variants.items():  # one species replaced
+            for neighbour in self.neighbours.get(variant, ()):
+                return neighbour, species, self.variants(neighbour)[variant]
+        return None, None, None
+
+    def put(self, key: tuple, reduction):
+        """Keep a reduction (or the species to build it from), dropping the least recently used one if the cache
+        is full; a built reduction replaces the species of its key"""
+        if key in self.reductions:
+            if isinstance(reduction, CompositionReduction):
+                self.reductions[key] = reduction
+            return
+        self.reductions[key] = reduction
+        for variant in self.variants(key):
+            self.neighbours[variant].add(key)
+        if len(self.reductions) > self.maxsize:
+            evicted, _ = self.reductions.popitem(last=False)
+            for variant in self.variants(evicted):
+                self.neighbours[variant].discard(evicted)
+                if not self.neighbours[variant]:
+                    del self.neighbours[variant]
+
+    def get(self, reactants: list, products: list):
+        """Reduction of a reaction, cached or updated from a cached neighbour (built from its species first if
+        needed); None if no neighbour is cached: the reaction is then to be balanced without one"""
+        key = tuple(sorted(
+            species_key(molecular_formula, side)
+            for molecular_formula, side in zip(reactants + products, [1] * len(reactants) + [-1] * len(products))
+        ))
+        with self.lock:
+            neighbour, added, removed = self.find(key)
+            reduction = self.reductions[neighbour] if neighbour is not None else None
+            if neighbour == key:
+                self.reductions.move_to_end(key)
+                if not isinstance(reduction, CompositionReduction):  # seen once: still not worth building
+                    self.counters['misses'] += 1
+                    return None
+                self.counters['hits'] += 1
+                return reduction
+            if reduction is None:
+                self.counters['misses'] += 1
+                self.put(key, (reactants, products))
+                return None
+            self.counters['neighbours'] += 1
+            if not isinstance(reduction, CompositionReduction):
+                self.counters['built'] += 1
+        if not isinstance(reduction, CompositionReduction):
+            reduction = CompositionReduction.from_species(*reduction)
+            with self.lock:
+                self.put(neighbour, reduction)
+        reduction = reduction.copy()
+        if removed is not None:
+            reduction.remove_species(dict(removed[1]), removed[0])
+        if added is not None:
+            reduction.add_species(dict(added[1]), added[0])
+        with self.lock:
+            self.put(key, reduction)
+        return reduction
+
+    def stats(self) -> dict:
+        """Counters of exact hits, reductions updated from a neighbour (after building it from its species),
+        and reactions balanced without a reduction"""
+        with self.lock:
+            return dict(self.counters, size=len(self.reductions))
+
+
+def edit_list(items, index: int, *replacement):
+    """Copy of a list with its item of index removed, or replaced by the replacement if given (None stays None)"""
+    return items[:index] + list(replacement) + items[index + 1:] if items is not None else None
+
+
 class Equation:
     """Implementation of a chemical equation"""
+    modular_threshold = 64  # composition matrices with at least this many entries are balanced modulo primes
 
-    def __init__(self, parsed_reactants: list, parsed_products: list, raw_reactants=None, raw_products=None):
+    def __init__(self, parsed_reactants: list, parsed_products: list, raw_reactants=None, raw_products=None,
+                 reduction=None):
+        """reduction: CompositionReduction of these species (e.g. from a ReductionCache) to balance with,
+        kept for add_species / remove_species; by default the composition matrix is reduced from scratch"""
         self.reactants = parsed_reactants
         self.products = parsed_products
         self.size = len(self.reactants + self.products)
@@ -342,6 +664,10 @@ class Equation:
         self.raw_reactants = raw_reactants
         self.raw_products = raw_products
 
+        # relative formula masses of all species, computed once for every mass <-> mole conversion
+        self.relative_formula_masses = [calculate_formula_mass(species) for species in self.reactants + self.products]
+
+        self.reduction = reduction
         self.coefficients = self.balance()
         assert isinstance(self.coefficients, list), "Reaction not feasible"
 
@@ -361,35 +687,37 @@ class Equation:
     def __getitem__(self, index: int) -> dict:
         return self.reactants[index] if index < len(self.reactants) else self.products[index - len(self.reactants)]
 
+    def build_composition_matrix(self) -> Matrix:
+        """Construct the composition matrix of this reaction in one pass over the atoms of each species
+        Each row corresponds to an element (or the charge, 'sign'), each column to a species;
+        reactant columns are positive and product columns negative"""
+        species_list = self.reactants + self.products
+        sides = [1] * len(self.reactants) + [-1] * len(self.products)  # side of each column
+        element_index = {}  # element -> row
+        entries = []
+        for column, (molecule, side) in enumerate(zip(species_list, sides)):
+            for element, quantity in molecule.items():
+                row = element_index.setdefault(element, len(element_index))
+                entries.append((row, column, side * quantity))
+        matrix = Matrix(len(element_index), len(species_list))
+        for row, column, value in entries:
+            matrix.assign_new_value(row, column, fractions.Fraction(value))
+        return matrix
+
     def balance(self):
         """construct a coefficient matrix based on reactants and reactants
         Return the smallest integer solution that makes the equation balanced"""
-
-        atoms_list_raw = self.reactants + self.products
-        atoms_list = []
-        for atom_dict in atoms_list_raw:
-            for atom in atom_dict.keys():
-                if atom not in atoms_list:
-                    atoms_list.append(atom)
-        # m = number of atoms, n = number of reactants + products
-        m = len(atoms_list)
-        n = len(self.reactants) + len(self.products)
-        matrix = Matrix(m, n)  # m by n matrix
-        for i in range(m):
-            reactants_list_copy = self.reactants.copy()
-            products_list_copy = self.products.copy()
-            for j in range(n):
-                atom = atoms_list[i]
-                molecule = atoms_list_raw[j]
-                atom_count = molecule[atom] if atom in molecule else 0
-                sign = 1 if molecule in reactants_list_copy else -1  # reactants positive, products negative
-                if sign == 1:
-                    reactants_list_copy.remove(molecule)
-                else:
-                    products_list_copy.remove(molecule)
-                matrix.assign_new_value(i, j, fractions.Fraction(sign * atom_count))
-        # list of linearly independent variables as solutions
-        solution_vectors = matrix.null_space()
+        if self.reduction is not None:
+            solution_vectors = self.reduction.coefficient_vectors(self.reactants, self.products)
+        else:
+            matrix = self.build_composition_matrix()
+            # m = number of atoms, n = number of reactants + products
+            m, n = matrix.size
+            # list of linearly independent variables as solutions
+            if m * n >= self.modular_threshold:
+                solution_vectors = matrix.null_space_modular()
+            else:
+                solution_vectors = matrix.null_space()
 
         if len(solution_vectors) != 1:
             raise ArithmeticError("not one single reaction")
@@ -406,6 +734,56 @@ class Equation:
 
         return solution
 
+    def composition_reduction(self) -> CompositionReduction:
+        """Row reduction of the composition matrix, computed once and kept to derive the neighbouring equations"""
+        if self.reduction is None:
+            self.reduction = CompositionReduction.from_species(self.reactants, self.products)
+        return self.reduction
+
+    def add_species(self, molecular_formula: dict, product=False, raw_string=None) -> 'Equation':
+        """This equation with one more reactant (or product, appended last), balanced by updating the reduction
+        raw_string: the string of the species, needed if this equation keeps those of its species"""
+        if (self.raw_reactants is not None or self.raw_products is not None) and raw_string is None:
+            raise ValueError("the string of the species is needed to keep the strings of the equation")
+        reduction = self.composition_reduction().copy()
+        reduction.add_species(molecular_formula, -1 if product else 1)
+        if product:
+            return Equation(self.reactants, self.products + [molecular_formula], self.raw_reactants,
+                            edit_list(self.raw_products, len(self.products), raw_string), reduction=reduction)
+        return Equation(self.reactants + [molecular_formula], self.products,
+                        edit_list(self.raw_reactants, len(self.reactants), raw_string), self.raw_products,
+                        reduction=reduction)
+
+    def remove_species(self, index: int) -> 'Equation':
+        """This equation without its species of index (reactants then products), balanced by updating the reduction"""
+        reduction = self.composition_reduction().copy()
+        is_product = index >= len(self.reactants)
+        reduction.remove_species(self[index], -1 if is_product else 1)
+        if is_product:
+            position = index - len(self.reactants)
+            return Equation(self.reactants, edit_list(self.products, position), self.raw_reactants,
+                            edit_list(self.raw_products, position), reduction=reduction)
+        return Equation(edit_list(self.reactants, index), self.products, edit_list(self.raw_reactants, index),
+                        self.raw_products, reduction=reduction)
+
+    def replace_species(self, index: int, molecular_formula: dict, raw_string=None) -> 'Equation':
+        """This equation with its species of index (reactants then products) replaced, balanced by updating the
+        reduction: the edit that leads from a balanced equation to another (adding or removing one species
+        leaves either several reactions or none)
+        raw_string: the string of the new species, needed if this equation keeps those of its species"""
+        if (self.raw_reactants is not None or self.raw_products is not None) and raw_string is None:
+            raise ValueError("the string of the species is needed to keep the strings of the equation")
+        reduction = self.composition_reduction().copy()
+        is_product = index >= len(self.reactants)
+        reduction.remove_species(self[index], -1 if is_product else 1)
+        reduction.add_species(molecular_formula, -1 if is_product else 1)
+        if is_product:
+            position = index - len(self.reactants)
+            return Equation(self.reactants, edit_list(self.products, position, molecular_formula), self.raw_reactants,
+                            edit_list(self.raw_products, position, raw_string), reduction=reduction)
+        return Equation(edit_list(self.reactants, index, molecular_formula), self.products,
+                        edit_list(self.raw_reactants, index, raw_string), self.raw_products, reduction=reduction)
+
     def calculate_extent_from_moles(self, moles: list) -> float:
         """Calculate the extent of reaction (in moles) based on the input list of  moles
         The moles taken as input should be in the order of the reactants and products"""
@@ -439,28 +817,77 @@ class Equation:
 
     def calculate_relative_formula_masses(self) -> list:
         """Calculate the relative formula masses of the chemicals participating in this reaction"""
-        return [Molecule(self[i]).mr for i in range(self.size)]
+        return list(self.relative_formula_masses)
 
     def convert_mass_to_mole(self, masses: list) -> list:
         """Convert the input masses to moles"""
         assert len(masses) == self.size, "Size of input does not agree with equation"
         return [
-            Molecule(
-                self[i],
-                mass=masses[i]
-            ).mole for i in range(self.size)
+            masses[i] / self.relative_formula_masses[i] if masses[i] else None for i in range(self.size)
         ]
 
     def convert_mole_to_mass(self, moles: list) -> list:
         """Convert the input moles to masses"""
         assert len(moles) == self.size, "Size of input does not agree with equation"
         return [
-            Molecule(
-                self[i],
-                mole=moles[i]
-            ).mass for i in range(self.size)
+            moles[i] * self.relative_formula_masses[i] if moles[i] else None for i in range(self.size)
         ]
 
+    def sweep(self, masses=None, moles=None) -> dict:
+        """Stoichiometry of many scenarios at once
+        masses and moles are 2-D arrays (scenarios x species, in the order of the reactants and products);
+        unknown quantities are given as 0 or NaN. For each scenario, the extent of reaction is limited by
+        the species with the smallest available moles / coefficient, as in calculate_extent_from_moles.
+        Return a dictionary of arrays:
+            extent (scenarios), limiting (scenarios; index of the limiting species, -1 if nothing is given),
+            moles and masses (scenarios x species) of all reactants and products at that extent"""
+        available = []
+        if masses is not None:
+            available.append(numpy.asarray(masses, dtype=float) / numpy.asarray(self.relative_formula_masses))
+        if moles is not None:
+            available.append(numpy.asarray(moles, dtype=float))
+        if not available:
+            raise ValueError("masses or moles should be given")
+        for array in available:
+            if array.ndim != 2 or array.shape[1] != self.size:
+                raise ValueError("Size of input does not agree with equation")
+
+        coefficients = numpy.asarray(self.coefficients, dtype=float)
+        ratios = numpy.concatenate([array / coefficients for array in available], axis=1)
+        ratios[numpy.isnan(ratios) | (ratios == 0)] = numpy.inf
+        limiting = numpy.argmin(ratios, axis=1)
+        extent = ratios[numpy.arange(len(ratios)), limiting]
+        limiting = numpy.where(numpy.isinf(extent), -1, limiting % self.size)
+
+        reaction_moles = extent[:, numpy.newaxis] * coefficients
+        return {
+            'extent': extent,
+            'limiting': limiting,
+            'moles': reaction_moles,
+            'masses': reaction_moles * numpy.asarray(self.relative_formula_masses)
+        }
+
+    def calculate_oxidations(self) -> list:
+        """Return the oxidation numbers of every reactant and product (one dictionary each)"""
+        return calculate_oxidations(self.reactants + self.products)
+
+    def is_redox(self) -> bool:
+        """Determine if any element changes oxidation number between the reactants and the products
+        An element on its own has the oxidation number 0; one known on one side only (unresolved on the other,
+        such as Cu in CuSO4 for Zn + CuSO4 -> ZnSO4 + Cu) counts as changed"""
+        reactant_states, product_states = {}, {}
+        for index, (species, oxidation) in enumerate(zip(self.reactants + self.products, self.calculate_oxidations())):
+            states = reactant_states if index < len(self.reactants) else product_states
+            elements = [element for element, quantity in species.items() if element != 'sign' and quantity]
+            for element in elements:
+                alone = len(elements) == 1 and not species.get('sign')
+                states.setdefault(element, set()).add(0 if alone else oxidation.get(element))  # None: unresolved
+        for element in reactant_states.keys() & product_states.keys():
+            reactant_known, product_known = reactant_states[element] - {None}, product_states[element] - {None}
+            if reactant_known != product_known and (reactant_known or product_known):
+                return True
+        return False
+
     def get_balanced_string(self):
         """Return a string representation of the balanced equation"""
         solution = self.coefficients
@@ -495,14 +922,12 @@ class Equation:
                     products.pop(i - len(reactants))
         if len(reactants) == len(products) == 1 or not len(reactants) or not len(products):
             reaction_type = "NOT A REACTION"
-        elif len(reactants) == len(products) == 2:
-            pass
         elif len(reactants) == 1 and len(products) >= 2:
             reaction_type = "Decomposition"
         elif len(reactants) >= 2 and len(products) == 1:
             reaction_type = "Synthesis"
-        else:
-            pass
+        elif self.is_redox():
+            reaction_type = "Redox"
         return reaction_type
 
 
@@ -595,14 +1020,11 @@ class StraightChainAlkane(FunctionalGroup):
 
     def calculate_isomer_numbers(self) -> int:
         """Return the number of different structural isomers of the alkane"""
-        if self.size <= 2:
-            count = 1
-        else:
-            count = sum([partition(self.size - 2, k + 1) for k in range(self.size - 2)])  # TODO correct this
-        # the number of partitions of n into k non-negative (including zero) parts is
-        # equivalent to number of partitions of n + k into k non-zero parts
-        # where n, k = self.size - s - 3, s + 1 (hence n + k = self.size - 2)
-        return count
+        return count_alkane_isomers(self.size)
+
+    def generate_isomers(self, after=None):
+        """Yield every structural isomer of the alkane (see isomers.alkane_isomers)"""
+        return alkane_isomers(self.size, after=after)
 
     def get_condensed_structural_formula(self) -> str:
         """Return a string of the condensed structural formula"""
@@ -667,22 +1089,29 @@ class StraightChainPrimaryAlcohol(FunctionalGroup):
         ])  # yes yes I did copy paste ... so to make it not so obvious I did a little formatting :D
 
 
-class Solution:  # TODO: refactor this. totally wrong
-    """A homogeneous mixture of one (or more, but not supported ]:) ) solute"""
+# millilitres in one unit of volume; concentrations are in mol dm^-3 (or g dm^-3)
+VOLUME_UNITS = {'mL': 1, 'cm^3': 1, 'L': 1000, 'dm^3': 1000, 'm^3': 1000000}
+KW = 1e-14  # ionic product of water at 25 °C
+PH_ITERATIONS = 100
+PH_TOLERANCE = 1e-10  # on ln [H+]
+
+
+class Solution:
+    """A homogeneous mixture of one solute (volume in mL, solute as [Molecule, moles])"""
     def __init__(self, volume: float, solute: Molecule, concentration: float, unit='mL'):
-        """Initiate a solution of `volume` mL with `solute` of `concentration` dissolved"""
+        """Initiate a solution of `volume` (in `unit`) with `solute` at `concentration` mol dm^-3"""
         self.volume = self.convert_to_ml(unit, volume)
-        self.solute = [solute, concentration * self.volume]
+        self.solute = [solute, concentration * self.volume / 1000]
 
     @classmethod
     def from_volume_and_solute_mass(cls, volume: float, solute: Molecule, mass: float, unit='mL') -> 'Solution':
-        """Initiate a solution of `volume` mL with `mass` grams of `solute` dissolved"""
+        """Initiate a solution of `volume` (in `unit`) with `mass` grams of `solute` dissolved"""
         mole = solute.calculate_mole(mass)
         return cls.from_volume_and_solute_mole(volume, solute, mole, unit=unit)
 
     @classmethod
     def from_volume_and_solute_mole(cls, volume: float, solute: Molecule, mole: float, unit='mL') -> 'Solution':
-        """Initiate a solution of `volume` mL with `mole` moles of `solute` dissolved"""
+        """Initiate a solution of `volume` (in `unit`) with `mole` moles of `solute` dissolved"""
         S = cls(volume, solute, 0, unit=unit)
         S.solute[1] = mole
         return S
@@ -690,21 +1119,267 @@ class Solution:  # TODO: refactor this. totally wrong
     @staticmethod
     def convert_to_ml(unit: string, value: float) -> float:
         """Convert the value in the given unit to millilitres (mL)"""
-        return value * {
-            'mL': 1,
-            'L': 1000,
-            'cm^3': 0.001,
-            'dm^3': 1,
-            'm^3': 1000
-        }[unit]
+        return value * VOLUME_UNITS[unit]
 
     def calculate_concentration_mol_per_decimeter_cubed(self) -> float:
         """Calculate the concentration of the solute in mol dm^-3"""
-        return self.solute[1] / self.volume
+        return self.solute[1] / self.volume * 1000
 
     def calculate_concentration_gram_per_decimeter_cubed(self) -> float:
-        """Calculate the concentration of the solute in mol dm^-3"""
-        return self.solute[0].calculate_mass(self.solute[1]) / self.volume
+        """Calculate the concentration of the solute in g dm^-3"""
+        return self.solute[0].calculate_mass(self.solute[1]) / self.volume * 1000
+
+    def dilute(self, volume: float, unit='mL') -> 'Solution':
+        """This solution made up to `volume` (in `unit`) with the solvent"""
+        return Solution.from_volume_and_solute_mole(volume, self.solute[0], self.solute[1], unit=unit)
+
+
+def water_balance_h(excess_acid, kw=KW):
+    """[H+] of water with a strong acid excess (negative for a base) of excess_acid mol dm^-3: [H+] - [OH-] = excess
+    (the root of the quadratic is taken in the form that does not cancel)"""
+    root = numpy.sqrt(excess_acid * excess_acid + 4 * kw)
+    return numpy.where(excess_acid > 0, (excess_acid + root) / 2, 2 * kw / (root - excess_acid))
+
+
+def charge_balance_ph(strong_base, strong_acid, weak_acid=0, ka=1, weak_base=0, kb=1, kw=KW):
+    """pH solving the charge balance of mixtures, element-wise over broadcast arrays of concentrations (mol dm^-3):
+        [H+] + strong base + [BH+] = [OH-] + strong acid + [A-]
+    with monoprotic weak acids HA (total weak_acid, constant ka) and weak bases B (total weak_base, constant kb)
+    The balance increases with [H+] and its root lies between those with the weak species fully dissociated
+    and not at all; it is found by Newton steps on ln [H+] within that bracket, bisecting instead when a step
+    would leave the bracket or converge slower than bisection. Only the points not converged yet are iterated."""
+    arrays = numpy.broadcast_arrays(*[numpy.asarray(array, dtype=float) for array in (
+        numpy.subtract(strong_base, strong_acid), weak_acid, ka, weak_base, numpy.divide(kw, kb)
+    )])
+    shape = arrays[0].shape
+    strong, weak_acid, ka, weak_base, kb_conjugate = [array.ravel() for array in arrays]
+    low = numpy.log(water_balance_h(-strong - weak_base, kw))  # ln [H+]
+    high = numpy.log(water_balance_h(weak_acid - strong, kw))
+    x = (low + high) / 2
+    step, previous_step = high - low, high - low
+    active = numpy.arange(len(x))
+    for _ in range(PH_ITERATIONS):
+        x_active = x[active]
+        h = numpy.exp(x_active)
+        acid_fraction = ka[active] / (ka[active] + h)
+        base_fraction = h / (h + kb_conjugate[active])
+        balance = h + strong[active] + weak_base[active] * base_fraction - kw / h - weak_acid[active] * acid_fraction
+        slope = h + kw / h + weak_base[active] * base_fraction * (1 - base_fraction) + \
+            weak_acid[active] * acid_fraction * (1 - acid_fraction)
+        below = balance < 0
+        low_active = numpy.where(below, x_active, low[active])
+        high_active = numpy.where(below, high[active], x_active)
+        newton = x_active - balance / slope
+        use_newton = (newton >= low_active) & (newton <= high_active) & (
+            numpy.abs(2 * balance) <= numpy.abs(previous_step[active] * slope))
+        x_next = numpy.where(use_newton, newton, (low_active + high_active) / 2)
+        previous_step[active] = step[active]
+        step[active] = x_next - x_active
+        low[active], high[active], x[active] = low_active, high_active, x_next
+        active = active[numpy.abs(x_next - x_active) >= PH_TOLERANCE]
+        if not len(active):
+            break
+    return (-x / math.log(10)).reshape(shape)
+
+
+class SolutionArray:
+    """Many solutions of one solute, as numpy arrays of volumes (mL) and amounts (mol) broadcast together,
+    for concentrations, dilutions and titration curves in one call each"""
+
+    def __init__(self, volumes, solute: Molecule, concentrations, unit='mL'):
+        """Solutions of `volumes` (in `unit`) with `solute` at `concentrations` mol dm^-3"""
+        self.solute = solute
+        volumes, concentrations = numpy.broadcast_arrays(
+            numpy.atleast_1d(numpy.asarray(volumes, dtype=float) * VOLUME_UNITS[unit]),
+            numpy.atleast_1d(numpy.asarray(concentrations, dtype=float))
+        )
+        self.volumes = volumes.copy()
+        self.moles = concentrations * volumes / 1000
+
+    @classmethod
+    def from_volume_and_solute_mole(cls, volumes, solute: Molecule, moles, unit='mL') -> 'SolutionArray':
+        """Solutions of `volumes` (in `unit`) with `moles` moles of `solute` dissolved"""
+        volumes = numpy.asarray(volumes, dtype=float) * VOLUME_UNITS[unit]
+        return cls(volumes, solute, numpy.asarray(moles, dtype=float) / volumes * 1000)
+
+    @classmethod
+    def from_volume_and_solute_mass(cls, volumes, solute: Molecule, masses, unit='mL') -> 'SolutionArray':
+        """Solutions of `volumes` (in `unit`) with `masses` grams of `solute` dissolved"""
+        return cls.from_volume_and_solute_mole(volumes, solute, numpy.asarray(masses, dtype=float) / solute.mr, unit)
+
+    @classmethod
+    def from_solutions(cls, solutions: list) -> 'SolutionArray':
+        """Array of Solution objects of the same solute"""
+        return cls.from_volume_and_solute_mole(
+            [solution.volume for solution in solutions], solutions[0].solute[0],
+            [solution.solute[1] for solution in solutions]
+        )
+
+    def __len__(self) -> int:
+        return len(self.volumes)
+
+    def __getitem__(self, index) -> Solution:
+        return Solution.from_volume_and_solute_mole(float(self.volumes[index]), self.solute, float(self.moles[index]))
+
+    def concentrations(self):
+        """Concentrations of the solute in mol dm^-3"""
+        return self.moles / self.volumes * 1000
+
+    def mass_concentrations(self):
+        """Concentrations of the solute in g dm^-3"""
+        return self.concentrations() * self.solute.mr
+
+    def dilute(self, volumes, unit='mL') -> 'SolutionArray':
+        """These solutions made up to `volumes` (in `unit`) with the solvent"""
+        return SolutionArray.from_volume_and_solute_mole(
+            numpy.asarray(volumes, dtype=float) * VOLUME_UNITS[unit], self.solute, self.moles
+        )
+
+    def volumes_to_dilute(self, concentrations, volumes):
+        """Volumes of these solutions to make up to `volumes` (in the same unit) for `concentrations` mol dm^-3
+        (C1V1 = C2V2)"""
+        return numpy.asarray(concentrations, dtype=float) * numpy.asarray(volumes, dtype=float) / self.concentrations()
+
+    def equivalence_volumes(self, titrant_concentrations, unit='mL'):
+        """Volumes (in `unit`) of a monoprotic titrant of `titrant_concentrations` mol dm^-3 neutralizing the solute"""
+        return self.moles * 1000 / numpy.asarray(titrant_concentrations, dtype=float) / VOLUME_UNITS[unit]
+
+    def titration_curves(self, titrant_concentrations, added_volumes, ka=None, kb=None, base=False, unit='mL'):
+        """pH of each solution (rows) after adding each of `added_volumes` (columns, in `unit`) of a strong
+        monoprotic titrant of `titrant_concentrations` mol dm^-3 (one for all or one per solution)
+        The solute is a monoprotic acid titrated with a strong base, or a base titrated with a strong acid if base;
+        it is weak with the dissociation constant ka (or kb for a base, one for all or one per solution), strong
+        if it is None"""
+        if (ka is not None and base) or (kb is not None and not base):
+            raise ValueError("ka is for an acid, kb for a base")
+        added = numpy.asarray(added_volumes, dtype=float)[numpy.newaxis, :] * VOLUME_UNITS[unit]
+        volumes = self.volumes[:, numpy.newaxis] + added
+        analyte = self.moles[:, numpy.newaxis] * 1000 / volumes
+        titrant = numpy.asarray(titrant_concentrations, dtype=float).reshape(-1, 1) * added / volumes
+        constant = ka if not base else kb
+        constant = None if constant is None else numpy.asarray(constant, dtype=float).reshape(-1, 1)
+        if base:
+            if constant is None:
+                return charge_balance_ph(analyte, titrant)
+            return charge_balance_ph(0, titrant, weak_base=analyte, kb=constant)
+        if constant is None:
+            return charge_balance_ph(titrant, analyte)
+        return charge_balance_ph(titrant, 0, weak_acid=analyte, ka=constant)
+
+
+def calculate_empirical_formulas(quantities: list, latex=False, tolerance=0.1, max_multiplier=12, parsed=None) -> list:
+    """Calculate the empirical formulas of many compounds at once
+    Each item of quantities maps a chemical (element or formula) to its mass or percentage by mass;
+    parsed optionally maps chemicals to their molecular formulas already parsed (e.g. by pipeline.parse).
+    Mole ratios are divided by the smallest one, then multiplied by the smallest integer (up to max_multiplier)
+    bringing every ratio within tolerance of an integer; if there is none, the multiplier with the smallest
+    deviation is used. Nothing global (e.g. decimal contexts) is touched, so this is safe in threads.
+    Return a list of molecular formula dictionaries"""
+    chemicals = []  # union of the chemicals of all compounds, each parsed once
+    for quantity in quantities:
+        chemicals.extend(chemical for chemical in quantity if chemical not in chemicals)
+    if not chemicals:
+        return [{'sign': 0} for _ in quantities]
+    column = {chemical: index for index, chemical in enumerate(chemicals)}
+    parsed = parsed or {}
+    formula_masses = numpy.array([
+        calculate_formula_mass(parsed[chemical]) if chemical in parsed
+        else (Molecule.from_latex(chemical) if latex else Molecule.from_string(chemical)).mr
+        for chemical in chemicals
+    ])
+
+    weights = numpy.zeros((len(quantities), len(chemicals)))
+    for row, quantity in enumerate(quantities):
+        for chemical, weight in quantity.items():
+            weights[row, column[chemical]] = weight
+    ratios = weights / formula_masses
+    smallest = numpy.where(ratios > 0, ratios, numpy.inf).min(axis=1, keepdims=True)
+    ratios = numpy.divide(ratios, smallest, out=numpy.zeros_like(ratios), where=numpy.isfinite(smallest))
+
+    multipliers = numpy.arange(1, max_multiplier + 1)
+    scaled = ratios[:, numpy.newaxis, :] * multipliers[:, numpy.newaxis]  # compounds x multipliers x chemicals
+    deviation = numpy.abs(scaled - numpy.round(scaled)).max(axis=2)
+    within = deviation <= tolerance
+    best = numpy.where(within.any(axis=1), within.argmax(axis=1), deviation.argmin(axis=1))
+    counts = numpy.round(scaled[numpy.arange(len(quantities)), best]).astype(int)
+
+    formulas = []
+    for row, quantity in enumerate(quantities):
+        formula = {chemical: int(counts[row, column[chemical]]) for chemical in quantity}
+        formula['sign'] = 0
+        formulas.append(formula)
+    return formulas
+
+
+def search_molecular_formulas(target: float, tolerance: float, element_ranges: dict, charge=0, min_dbe=None,
+                              even_electron=None):
+    """Generate the molecular formulas whose relative formula mass is within tolerance of target
+    element_ranges maps each allowed element to its (minimum, maximum) count.
+    Elements are tried from the heaviest: the counts that cannot reach the target (even with the lightest or the
+    heaviest choice for the remaining elements) are never visited, so only branches that can match are explored.
+    Filters (on the valences of VALENCES): min_dbe, the smallest double bond equivalent allowed (e.g. 0), and
+    even_electron, True for closed-shell species only (integer DBE when neutral), False for radicals only
+    Yield molecular formula dictionaries (with 'sign' set to charge) in no particular order"""
+    elements = sorted(element_ranges, key=lambda element: relative_atomic_mass[element], reverse=True)
+    masses = [relative_atomic_mass[element] for element in elements]
+    if any(mass <= 0 for mass in masses):
+        raise ValueError("every element should have a positive relative atomic mass")
+    ranges = [element_ranges[element] for element in elements]
+    filtered = min_dbe is not None or even_electron is not None
+    if filtered and any(element not in VALENCES for element in elements):
+        raise ValueError(f"no valence known for {[element for element in elements if element not in VALENCES]}")
+    # twice the DBE stays an integer: 2 + sum of count * (valence - 2)
+    dbe_steps = [VALENCES[element] - 2 if filtered else 0 for element in elements]
+
+    # bounds of what the elements from index i onwards can add
+    rest_min, rest_max, rest_dbe = [0.0] * (len(elements) + 1), [0.0] * (len(elements) + 1), [0] * (len(elements) + 1)
+    for i in reversed(range(len(elements))):
+        (low, high), mass, step = ranges[i], masses[i], dbe_steps[i]
+        rest_min[i] = rest_min[i + 1] + low * mass
+        rest_max[i] = rest_max[i + 1] + high * mass
+        rest_dbe[i] = rest_dbe[i + 1] + max(low * step, high * step)
+    lowest, highest = target - tolerance, target + tolerance
+    epsilon = 1e-9 * max(target, 1)
+
+    counts = [0] * len(elements)
+    positions = {element: i for i, element in enumerate(elements)}
+
+    last = len(elements) - 1
+
+    def branch(i: int, mass: float, dbe2: int):
+        """Try every count of element i compatible with the target, then the following elements
+        The counts of the last element are computed in the loop over the element before it (most candidates have
+        none) rather than in one more call per candidate"""
+        low, high = ranges[i]
+        low = max(low, math.ceil((lowest - mass - rest_max[i + 1]) / masses[i] - epsilon))
+        high = min(high, math.floor((highest - mass - rest_min[i + 1]) / masses[i] + epsilon))
+        for count in range(low, high + 1):
+            new_dbe2 = dbe2 + count * dbe_steps[i]
+            if min_dbe is not None and new_dbe2 + rest_dbe[i + 1] < 2 * min_dbe:
+                continue
+            counts[i] = count
+            if i + 1 < last:
+                yield from branch(i + 1, mass + count * masses[i], new_dbe2)
+                continue
+            if i + 1 == last:
+                last_mass = mass + count * masses[i]
+                last_low = max(ranges[last][0], math.ceil((lowest - last_mass) / masses[last] - epsilon))
+                last_high = min(ranges[last][1], math.floor((highest - last_mass) / masses[last] + epsilon))
+            else:  # a single element
+                last_low = last_high = count
+            for last_count in range(last_low, last_high + 1):
+                last_dbe2 = new_dbe2 + (last_count * dbe_steps[last] if i < last else 0)
+                if min_dbe is not None and last_dbe2 < 2 * min_dbe:
+                    continue
+                if even_electron is not None and ((last_dbe2 - charge) % 2 == 0) != even_electron:
+                    continue
+                counts[last] = last_count
+                formula = {element: counts[positions[element]] for element in element_ranges}
+                formula = {element: count for element, count in formula.items() if count}
+                formula['sign'] = charge
+                yield formula
+
+    return branch(0, 0.0, 2) if elements else iter(())
 
 
 def debug():
@@ -724,80 +1399,96 @@ def debug():
             StraightChainAlkane(6).calculate_isomer_numbers()
         ),
         # ---Debugging 5 - determine empirical formula
-        {'K': 1, 'I': 1, 'O': 3} == Molecule.from_ratio({'K': 1.82, 'I': 5.93, 'O': 2.24}).molecular_formula
+        {'K': 1, 'I': 1, 'O': 3, 'sign': 0} == Molecule.from_ratio(
+            {'K': 1.82, 'I': 5.93, 'O': 2.24}
+        ).molecular_formula,
+        # ---Debugging 6 - balancing from the reduction of a neighbouring equation (propane from methane in a
+        # ReductionCache), as a full re-balance does
+        Equation.from_string("C3H8 + O2 -> CO2 + H2O").coefficients == [
+            Equation(
+                equation.reactants, equation.products, reduction=reductions.get(equation.reactants, equation.products)
+            )
+            for reductions in [ReductionCache()]
+            for equation in [Equation.from_string(f"{alkane} + O2 -> CO2 + H2O") for alkane in ("CH4", "C3H8")]
+        ][-1].coefficients,
+        # ---Debugging 7 - composition matrix: a row per element (here the charge first), product columns negative
+        [[-1, 2, 1, -2, -3, 0], [1, 0, 0, -1, 0, 0], [4, 0, 0, 0, 0, -1], [0, 1, 0, 0, -1, 0], [0, 0, 1, 0, 0, -2]] ==
+        Equation.from_string("MnO4^- + Fe^2+ + H^+ -> Mn^2+ + Fe^3+ + H2O").build_composition_matrix().matrix,
+        # ---Debugging 8 - redox: detected from known oxidation numbers, from an element on its own against an
+        # unresolved one (Cu in CuSO4), and no change in a neutralisation
+        ["Redox", "Redox", False] == [
+            Equation.from_string("Zn + CuO -> ZnO + Cu").get_reaction_type(),
+            Equation.from_string("Zn + CuSO4 -> ZnSO4 + Cu").get_reaction_type(),
+            Equation.from_string("NaOH + HCl -> NaCl + H2O").is_redox()
+        ],
+        # ---Debugging 9 - alkane isomer counts of CnH2n+2 for n = 1 to 15 (OEIS A000602), and as many generated
+        [1, 1, 1, 2, 3, 5, 9, 18, 35, 75, 159, 355, 802, 1858, 4347] == [
+            count_alkane_isomers(n) for n in range(1, 16)
+        ] == [len(set(isomer.encoding for isomer in alkane_isomers(n))) for n in range(1, 16)],
+        # ---Debugging 10 - resuming after the (JSON) cursor of any isomer yields the rest of the sequence
+        all(
+            list(alkane_isomers(n, after=json.loads(json.dumps(isomer.cursor)))) == list(alkane_isomers(n))[index + 1:]
+            for n in (7, 8) for index, isomer in enumerate(alkane_isomers(n))
+        ),
+        # ---Debugging 11 - isomers generated in parallel chunks: the serial ones
+        sorted(isomer[:2] for isomer in alkane_isomers(12)) == sorted(
+            pair for _, _, isomers in parallel_alkane_isomers(12, processes=2, chunk_size=50) for pair in isomers
+        ),
+        # ---Debugging 12 - isotope patterns of Cl2 (about 100:64:10) and Br2 (about 51:100:49), 2 Da apart
+        [[(69.938, 100), (71.935, 64), (73.932, 10)], [(157.837, 51), (159.835, 100), (161.833, 49)]] == [
+            [(round(mass, 3), round(intensity)) for mass, intensity in
+             Molecule.from_string(halogen).calculate_isotope_pattern(threshold=1e-3)] for halogen in ("Cl2", "Br2")
+        ],
+        # ---Debugging 13 - isotope patterns computed in one batch: those computed one by one
+        [isotope_pattern(Molecule.from_string(formula).molecular_formula) for formula in ("CH2Cl2", "C6H12O6")] ==
+        isotope_patterns([Molecule.from_string(formula).molecular_formula for formula in ("CH2Cl2", "C6H12O6")]),
+        # ---Debugging 14 - formula search around glucose (C6H12O6): every CHO formula within 0.045 of 180.18
+        sorted((formula.get('C', 0), formula.get('H', 0), formula.get('O', 0)) for formula in search_molecular_formulas(
+            180.18, 0.045, {'C': (0, 10), 'H': (0, 20), 'O': (0, 10)}
+        )) == [
+            (c, h, o) for c in range(11) for h in range(21) for o in range(11)
+            if abs(calculate_formula_mass({'C': c, 'H': h, 'O': o}) - 180.18) <= 0.045
+        ],
+        # ---Debugging 15 - formula search of closed-shell species only: a DBE (C - H / 2 + 1) integer and not negative
+        sorted((formula.get('C', 0), formula.get('H', 0), formula.get('O', 0)) for formula in search_molecular_formulas(
+            180.18, 0.045, {'C': (0, 10), 'H': (0, 20), 'O': (0, 10)}, min_dbe=0, even_electron=True
+        )) == [
+            (c, h, o) for c in range(11) for h in range(0, 21, 2) for o in range(11)
+            if abs(calculate_formula_mass({'C': c, 'H': h, 'O': o}) - 180.18) <= 0.045 and c - h // 2 + 1 >= 0
+        ],
+        # ---Debugging 16 - editing a species through the reduction keeps the strings of the species
+        Equation.from_string("C3H8 + O2 -> CO2 + H2O").get_balanced_string() ==
+        Equation.from_string("CH4 + O2 -> CO2 + H2O").replace_species(
+            0, Molecule.from_string("C3H8").molecular_formula, raw_string="C3H8"
+        ).get_balanced_string(),
+        # ---Debugging 17 - strong acid (or base) titrated by a strong base (or acid): pH 7 at equivalence
+        [[1.0, 7.0, 12.52], [13.0, 7.0]] == [
+            [round(float(ph), 2) for ph in SolutionArray(25, Molecule.from_string(solute), 0.1).titration_curves(
+                0.1, added_volumes, base=base
+            )[0]] for solute, added_volumes, base in (("HCl", [0, 25, 50], False), ("NaOH", [0, 25], True))
+        ],
+        # ---Debugging 18 - weak acid: pH = pKa at half equivalence, 8.72 at equivalence for 0.1 M acetic acid,
+        # and the curves of a batch of acids with their own Ka those computed one by one
+        numpy.allclose(SolutionArray(25, Molecule.from_string("C2H4O2"), 0.1).titration_curves(
+            0.1, [12.5, 25], ka=1.8e-5
+        ), [[-math.log10(1.8e-5), 8.72]], atol=0.005) and numpy.allclose(
+            SolutionArray([25, 20], Molecule.from_string("C2H4O2"), [0.1, 0.05]).titration_curves(
+                0.1, [0, 5, 10, 20], ka=[1.8e-5, 6.3e-5]
+            ), numpy.vstack([SolutionArray(volume, Molecule.from_string("C2H4O2"), concentration).titration_curves(
+                0.1, [0, 5, 10, 20], ka=ka
+            ) for volume, concentration, ka in ((25, 0.1, 1.8e-5), (20, 0.05, 6.3e-5))])
+        )
     ]
     invalid = [index + 1 for index, func in enumerate(valid) if not func]
     if any(invalid):
         print(f"Warning: Bug detected.\nContact developers (via github): reference code {invalid}\n")
 
 
-def launch_shell():
-    """Interactive shell"""
-    while True:
-        print("===START===")
-        formula = input("Enter a formula or equation to balance (enter if you don't): ")
-        start = time.process_time()
-        if '->' in formula:
-            equation = Equation.from_string(formula)
-            print(equation.get_balanced_string())
-            more_calculations = input("Proceed to calculate mass / mole? [Y / n] ") is 'Y'
-            if more_calculations:
-                moles = []
-                for index, chemical in enumerate(equation.raw_reactants + equation.raw_products):
-                    mass_input = input(f"Mass (g) of {chemical}: ")
-                    if not mass_input:
-                        mole_input = input(f"Mole (mol) of {chemical}: ")
-                        mole = simple_eval(mole_input) if mole_input else None
-                    else:
-                        mass = simple_eval(mass_input)
-                        mole = Molecule(
-                            equation[index],
-                            mass=mass
-                        ).mole
-                    moles.append(mole)
-                start = time.process_time()
-                reaction_extent = equation.calculate_extent_from_moles(moles)
-                reaction_moles = equation.calculate_moles_from_extent(reaction_extent)
-                reaction_masses = equation.calculate_masses_from_extent(reaction_extent)
-                print('\n'.join([
-                    f"{chemical}: {reaction_masses[index]} g <=> {reaction_moles[index]} mol"
-                    for index, chemical in enumerate(equation.raw_reactants + equation.raw_products)
-                ]))
-        elif "alkane" in formula.lower():
-            formula = formula.replace(" ", "")
-            if ":" not in formula:
-                print("expected input format: 'Alkane: <size>'")
-            else:
-                size = int(formula.split(":")[1])
-                alkane = StraightChainAlkane(size)
-                print(alkane)
-        elif formula:
-            mass_input = input("Mass (g): ")
-            mole_input = None
-            if not mass_input:
-                mole_input = input("Mole (mol): ")
-            start = time.process_time()
-            mass = simple_eval(mass_input) if mass_input else None
-            mole = simple_eval(mole_input) if mole_input else None
-            molecule = Molecule.from_string(formula, mass=mass, mole=mole)
-            print(molecule)
-        else:
-            elements = {}
-            print("Enter elements and their associated mass / percentage; enter to end")
-            while True:
-                ele = input("Element: ")
-                if ele == '':
-                    break
-                weight = input(ele + " (" + str(relative_atomic_mass[ele]) + "): ")
-                elements[ele] = simple_eval(weight)
-            start = time.process_time()
-            result = Molecule.from_ratio(elements)
-            print(result)
-        time_end = time.process_time()
-        time_taken = round(time_end - start, 6)
-        print("===END:", time_taken, "seconds===\n")
-
-
 if __name__ == '__main__':
-    debug()
-    launch_shell()
+    parser = argparse.ArgumentParser(description="CHEMaths interactive shell")
+    parser.add_argument('--profile', metavar='DIR', help="write cProfile stats and collapsed stacks per input to DIR")
+    arguments = parser.parse_args()
+    with Profile(arguments.profile, label="debug"):
+        debug()
+    import pipeline  # imported here: pipeline depends on this module
+    pipeline.launch_shell(profile_dir=arguments.profile)
@@ -1,92 +1,253 @@
 # -*- coding: utf-8 -*-
 """Web version for CHEMaths"""
 from ast import literal_eval
-from flask import Flask, jsonify, render_template, request
-from latex_parser import latex_valid, determine_mode, eval_latex
-from CHEMaths import Molecule, Equation
+from flask import Flask, g, jsonify, render_template, request, send_from_directory, url_for
+from latex_parser import eval_latex
+import gzip
+import mimetypes
+import os
+import build_assets
+import coalescing
+import pipeline
 import string
+import tempfile
+import time
+import profiling
+import result_store
+import scheduler
+import shared_cache
+import traffic
 
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+# fingerprinted assets (see build_assets.py) never change under the same name, so they are cached for a year
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+app.config['ASSET_DIR'] = os.path.join(app.root_path, build_assets.DIST_DIR)
+assets = build_assets.load_manifest()
+DEFAULT_PRECISION = 2  # decimals shown until a precision slider is moved
+# profiling is off unless a directory is configured; requests are then sampled at PROFILE_SAMPLE_RATE
+# or profiled on demand with the PROFILE_HEADER header set to PROFILE_TOKEN (no token: sampling only),
+# and the directory keeps the PROFILE_MAX_FILES latest profiles
+app.config['PROFILE_DIR'] = os.environ.get('CHEMATHS_PROFILE_DIR')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('CHEMATHS_PROFILE_RATE', 0))
+app.config['PROFILE_HEADER'] = 'X-CHEMaths-Profile'
+app.config['PROFILE_TOKEN'] = os.environ.get('CHEMATHS_PROFILE_TOKEN')
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('CHEMATHS_PROFILE_MAX_FILES', profiling.MAX_PROFILES))
+# traffic recording for replay load tests (see traffic.py) is off unless a file is configured
+recorder = traffic.TrafficRecorder(os.environ['CHEMATHS_RECORD_FILE']) \
+    if os.environ.get('CHEMATHS_RECORD_FILE') else None
+# results shared by all the workers of the host (see shared_cache.py) are off unless a file is configured
+cache = shared_cache.SharedCache(
+    os.environ['CHEMATHS_SHARED_CACHE'],
+    slots=int(os.environ.get('CHEMATHS_SHARED_CACHE_SLOTS', 4096)),
+    slot_size=int(os.environ.get('CHEMATHS_SHARED_CACHE_SLOT_SIZE', 4096)),
+    version=shared_cache.content_version('static/data.json', 'CHEMaths.py', 'latex_parser.py', 'pipeline.py')
+) if os.environ.get('CHEMATHS_SHARED_CACHE') else None
+# analyses persisted across deploys (see result_store.py) are off unless a file is configured;
+# the inputs of the warm-up list are then loaded into memory before the first request
+store = result_store.ResultStore(os.environ['CHEMATHS_RESULT_STORE']) \
+    if os.environ.get('CHEMATHS_RESULT_STORE') else None
+# expensive previews (see scheduler.py) run on a process pool of each worker, cheap ones inline;
+# CHEMATHS_HEAVY_PROCESSES=0 runs everything inline
+previews = scheduler.Scheduler(
+    processes=int(os.environ.get('CHEMATHS_HEAVY_PROCESSES', 1)),
+    max_pending=int(os.environ.get('CHEMATHS_HEAVY_QUEUE', 8)),
+    timeout=float(os.environ.get('CHEMATHS_HEAVY_TIMEOUT', 30))
+)
+# identical previews requested at the same time (a class typing the projected example) are computed once
+flights = coalescing.SingleFlight()
+if store is not None:
+    result_store.warm_up(
+        store, result_store.read_warm_up_list(os.environ.get('CHEMATHS_WARMUP_FILE', 'warmup.txt')), cache=cache
+    )
+
+
+@app.template_global()
+def asset_url(path: str) -> str:
+    """URL of a static file, fingerprinted if the assets have been built"""
+    return url_for('static', filename=assets.get(path, path))
+
+
+@app.before_request
+def start_profiling():
+    """Start profiling sampled requests (only when profiling is configured)"""
+    directory = app.config['PROFILE_DIR']
+    if directory and profiling.should_sample(
+            app.config['PROFILE_SAMPLE_RATE'], request.headers.get(app.config['PROFILE_HEADER']),
+            token=app.config['PROFILE_TOKEN']
+    ):
+        g.profile = profiling.Profile(
+            directory, label=request.endpoint or 'unknown', max_profiles=app.config['PROFILE_MAX_FILES']
+        ).__enter__()
+
+
+@app.before_request
+def start_recording():
+    """Remember when the request started if traffic is recorded"""
+    if recorder is not None:
+        g.record_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """Log the request body and timing for replay (static files are left out)"""
+    if recorder is not None and request.endpoint not in ('static', 'built_asset') and 'record_start' in g:
+        recorder.record(
+            request.path, request.method,
+            args=request.args.to_dict(flat=False),
+            form=request.form.to_dict(flat=False),
+            body=request.get_json(silent=True),
+            status=response.status_code,
+            duration=time.perf_counter() - g.record_start
+        )
+    return response
+
+
+@app.teardown_request
+def stop_profiling(_):
+    """Write the profile of the current request, if any"""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+
+
+def round_numbers(num_array: list, precision: int) -> list:
+    """Numbers formatted with the given number of decimals"""
+    return [format(round(i, precision), f'.{precision}f') for i in num_array]
+
+
+def molecule_mass_mole(molecule_latex: str, mass='', mole='') -> dict:
+    """Mass from the mole latex or mole from the mass latex of a molecule (see /mass_mole)"""
+    mr = pipeline.molecule_mr(molecule_latex)
+    result = {
+        'mass': None,
+        'mole': None,
+        'error': None,
+        'correct': None
+    }
+    if mole:
+        try:
+            result['mass'] = eval_latex(mole) * mr
+        except ValueError:  # invalid character(s)
+            result['correct'] = ''.join([i for i in mole if i not in string.ascii_letters])
+            result['error'] = 'Invalid character in mole input'
+    elif mass:
+        try:
+            result['mole'] = eval_latex(mass) / mr
+        except ValueError:
+            result['correct'] = ''.join([i for i in mass if i not in string.ascii_letters])
+            result['error'] = 'Invalid character in mass input'
+    return result
+
+
+def equation_mass_mole(components: list, masses_array: list, moles_array: list) -> dict:
+    """Masses and moles of every species for the limiting mass or mole latex (see /mass_mole_equation),
+    with the coefficients the pipeline balanced (or stored) for the preview"""
+    reactants, products = components
+    masses = [eval_latex(mass) if mass else None for mass in masses_array]
+    moles = [eval_latex(mole) if mole else None for mole in moles_array]
+    record, _ = pipeline.reaction(reactants, products, store=store)
+    return pipeline.equation_amounts(record, masses, moles)
+
+
+def preview(latex: str) -> dict:
+    """Response of /live_preview, shared with the concurrent requests of the same normalized input"""
+    return flights.do(pipeline.normalize(latex), previews.run, latex, cache=cache, store=store)
+
+
+def initial_state(data: dict) -> dict:
+    """Response of /live_preview for the input of a permalink, with what the page would request next
+    (values rounded to the default precision, mass / mole results) so that it renders without any request"""
+    result = dict(preview(data['Input']))
+    inputs = data['inputs'] if isinstance(data['inputs'], dict) else {}
+    if result['mode'] == 'molecule' and not result['error']:
+        percentages = result['info']['element_percentages']
+        result['rounded'] = {
+            'mr': round_numbers([result['info']['mr']], DEFAULT_PRECISION)[0],
+            'element_percentages': dict(zip(percentages, round_numbers(percentages.values(), DEFAULT_PRECISION)))
+        }
+    try:
+        if result['mode'] == 'molecule' and not result['error'] and (inputs.get('mass') or inputs.get('mole')):
+            result['mass_mole'] = molecule_mass_mole(data['Input'], mass=inputs.get('mass'), mole=inputs.get('mole'))
+        elif result['mode'] == 'equation' and not result['error']:
+            size = len(result['coefficients'])
+            masses, moles = inputs.get('masses') or [''] * size, inputs.get('moles') or [''] * size
+            if len(masses) == len(moles) == size and any(masses + moles):
+                result['mass_mole'] = equation_mass_mole(result['parsed'], masses, moles)
+    except (ValueError, SyntaxError, ArithmeticError):  # invalid mass or mole latex (see eval_latex): left to the page
+        pass
+    return result
+
+
+def renders_inline(latex: str) -> bool:
+    """Whether the preview of a permalink is cheap or already cached, and so computed before serving the page"""
+    latex = pipeline.normalize(latex)
+    return scheduler.estimate_cost(latex) == scheduler.CHEAP or \
+        (cache is not None and cache.get(f"run:{latex}") is not None)
 
 
 @app.route("/", methods=['GET'])
 def home():
-    """renders home page of CHEMaths"""
+    """renders home page of CHEMaths, with the analysis of the input of the permalink"""
     raw_data = request.args
     data = {
         'mode': raw_data.get('mode', 'this'),
         'Input': raw_data.get('Input', ''),
         'inputs': raw_data.get('inputs', {}, literal_eval)
     }
-    print(data)
-    return render_template('index.html', name="homepage", data=data)
+    initial = None  # an expensive preview is left to the request of the page, as when the user types it
+    if renders_inline(data['Input']):
+        try:
+            initial = initial_state(data)
+        except scheduler.Overloaded:  # evicted from the cache meanwhile and the pool is full: the page requests it
+            pass
+    return render_template('index.html', name="homepage", data=data, initial=initial)
+
+
+@app.route('/static/dist/<path:filename>', methods=['GET'])
+def built_asset(filename):
+    """Serve a fingerprinted asset with immutable caching, precompressed if the client accepts it"""
+    directory = app.config['ASSET_DIR']
+    accepted = request.accept_encodings
+    for suffix, encoding in (('.br', 'br'), ('.gz', 'gzip')):
+        if accepted[encoding] and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(
+                directory, filename + suffix, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            )
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    return response
 
 
 @app.route("/live_preview", methods=['POST'])
 def live_process():
-    """processes input dynamically"""
-    latex = request.values.get(
-        'latex'
-    ).replace("\\ ", '').replace(" ", '').replace("\\left(", '(').replace(r"\right)", ')')
-    mode = determine_mode(latex)
-    syntax_check = latex_valid(latex, mode)
-    error = syntax_check[1] if not syntax_check[0] else None
-    if mode == 'this':
-        return jsonify({
-            'mode': mode,
-            'syntax': syntax_check[0],
-            'error': syntax_check[1]
+    """processes input dynamically (expensive inputs on the scheduler's pool, refused with 503 when it is full)"""
+    latex = request.values.get('latex')
+    try:
+        return jsonify(preview(latex))
+    except scheduler.Overloaded as error:
+        response = jsonify({
+            'error': str(error), 'mode': pipeline.detect_mode(pipeline.normalize(latex)), 'syntax': True
         })
-    elif mode == 'molecule':
-        if not error:
-            parsed_molecule = syntax_check[1]
-            molecule = Molecule(parsed_molecule, raw_string=latex)
-            return jsonify({
-                'error': error,
-                'mode': mode,
-                'syntax': syntax_check[0],
-                'molecule': parsed_molecule,
-                'info': {
-                    'mr': molecule.mr,
-                    'element_percentages': molecule.calculate_percentages(),
-                    'oxidation': {
-                        element: str(molecule.calculate_oxidation()[element])
-                        for element in molecule.calculate_oxidation().keys()
-                    }
-                }
-            })
-    elif mode == 'equation':
-        if not error:
-            parsed, reactants, products, equation = syntax_check[1]
-            return jsonify({
-                'mode': mode,
-                'syntax': syntax_check[0],
-                'parsed': parsed,
-                'reaction_type': equation.get_reaction_type(),
-                'reactants': reactants,
-                'products': products,
-                'coefficients': equation.balance(),
-                'mr': equation.calculate_relative_formula_masses(),
-                'error': error
-            })
-    elif mode == 'organic':
-        if not error:
-            functional_group = syntax_check[1]
-            return jsonify({
-                'organic-name': functional_group.get_name().capitalize(),
-                'molecular-formula': functional_group.molecule.latex_molecular_formula,
-                'condensed-structural-formula': functional_group.get_condensed_structural_formula(),
-                'isomers-number': functional_group.calculate_isomer_numbers(),
-                'combustion-enthalpy': str(functional_group.calculate_combustion_enthalpy()) + " kJ mol<sup>-1</sup>",
-                'lewis-structure': functional_group.get_lewis(sep='<br/>'),
-                'mode': mode,
-                'syntax': syntax_check[0]
-            })
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Counters of the worker process serving the request"""
     return jsonify({
-        'error': error,
-        'mode': mode,
-        'syntax': syntax_check[0]
+        'pid': os.getpid(),
+        'shared_cache': cache.stats() if cache is not None else None,
+        'result_store': store.stats() if store is not None else None,
+        'scheduler': previews.stats(),
+        'coalescing': flights.stats(),
+        'reductions': pipeline.REDUCTIONS.stats()
     })
 
 
@@ -95,63 +256,65 @@ def python_round():
     """Round the input number to the input precision from the request,
     simply because rounding in javascript is AWFUL."""
     num_array = request.form.getlist("num_array[]", type=float)
-    precision = int(request.values.get('precision', 2))
+    precision = int(request.values.get('precision', DEFAULT_PRECISION))
     return jsonify({
-        'result': [format(round(i, precision), f'.{precision}f') for i in num_array]
+        'result': round_numbers(num_array, precision)
     })
 
 
 @app.route('/mass_mole', methods=['POST'])
 def mass_mole_calculation():
     """mole <-> mass calculation for Molecule"""
-    mole = request.form.get('mole')
-    mass = request.form.get('mass')
-    molecule_latex = request.form.get('molecule_latex')
-
-    m = Molecule.from_latex(molecule_latex)
-    result = {
-        'mass': None,
-        'mole': None,
-        'error': None,
-        'correct': None
-    }
-    if mole:
-        try:
-            result['mass'] = m.calculate_mass(eval_latex(mole))
-        except ValueError:  # invalid character(s)
-            result['correct'] = ''.join([i for i in mole if i not in string.ascii_letters])
-            result['error'] = 'Invalid character in mole input'
-    elif mass:
-        try:
-            result['mole'] = m.calculate_mole(eval_latex(mass))
-        except ValueError:
-            result['correct'] = ''.join([i for i in mass if i not in string.ascii_letters])
-            result['error'] = 'Invalid character in mass input'
-    return jsonify(result)
+    return jsonify(molecule_mass_mole(
+        request.form.get('molecule_latex'), mass=request.form.get('mass'), mole=request.form.get('mole')
+    ))
 
 
 @app.route("/mass_mole_equation", methods=['POST'])
 def mass_mole_calculation_equation():
     """mass <-> mole calculation for Equation"""
     data = request.get_json()
-    reactants, products = data['components']
-    masses_array = data['mass_array']
-    moles_array = data['mole_array']
-
-    masses = [eval_latex(mass) if mass else None for mass in masses_array]
-    moles = [eval_latex(mole) if mole else None for mole in moles_array]
+    return jsonify(equation_mass_mole(data['components'], data['mass_array'], data['mole_array']))
 
-    reaction = Equation(reactants, products)
 
-    extent_masses = reaction.calculate_extent_from_masses(masses)
-    extent_moles = reaction.calculate_extent_from_moles(moles)
-    extent = min(extent_masses, extent_moles)
-
-    return jsonify({
-        'reaction_masses': reaction.calculate_masses_from_extent(extent),
-        'reaction_moles': reaction.calculate_moles_from_extent(extent)
-    })
+def debug():
+    """Test the serving of built assets, on a build of a sample script in a temporary directory"""
+    script = b'document.getElementById("preview").textContent = "CHEMaths";\n' * 50
+    asset_dir = app.config['ASSET_DIR']
+    with tempfile.TemporaryDirectory() as directory:
+        static_dir = os.path.join(directory, build_assets.STATIC_DIR)
+        os.makedirs(static_dir)
+        with open(os.path.join(static_dir, 'ChemInput.js'), 'wb') as asset:
+            asset.write(script)
+        url = '/static/' + build_assets.build(static_dir=static_dir)['ChemInput.js']
+        app.config['ASSET_DIR'] = os.path.join(static_dir, 'dist')
+        try:
+            client = app.test_client()
+            responses = {  # buffered: read before the temporary directory goes
+                encoding: client.get(url, headers={'Accept-Encoding': encoding}, buffered=True)
+                for encoding in ('br', 'gzip', 'identity')
+            }
+        finally:
+            app.config['ASSET_DIR'] = asset_dir
+    valid = [
+        # ---Debugging 1 - the gzip variant to clients accepting it, as javascript
+        responses['gzip'].headers.get('Content-Encoding') == 'gzip' and
+        gzip.decompress(responses['gzip'].get_data()) == script and 'javascript' in responses['gzip'].mimetype,
+        # ---Debugging 2 - the brotli variant if it was built (the original otherwise)
+        responses['br'].headers.get('Content-Encoding') == 'br' if build_assets.brotli is not None else
+        responses['br'].headers.get('Content-Encoding') is None and responses['br'].get_data() == script,
+        # ---Debugging 3 - the original to other clients, every response cached for good and varying by encoding
+        responses['identity'].headers.get('Content-Encoding') is None and responses['identity'].get_data() == script and
+        all(
+            'immutable' in response.headers['Cache-Control'] and response.headers['Vary'] == 'Accept-Encoding'
+            for response in responses.values()
+        )
+    ]
+    invalid = [index + 1 for index, func in enumerate(valid) if not func]
+    if any(invalid):
+        print(f"Warning: Bug detected.\nContact developers (via github): reference code {invalid}\n")
 
 
 if __name__ == "__main__":
+    debug()
     app.run()
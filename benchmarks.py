@@ -0,0 +1,233 @@
+# coding=utf-8
+"""Microbenchmarks of the maths kernels
+Usage: python benchmarks.py matrix [--sizes 10 25 50 100 200] [--density 0.1] [--repeat 3]
+    matrix: each matrix is (n - 1) x n with random small fractions, so that it has a null space
+    like a composition matrix
+    matrix-float: the same with floats, row reduced by the pure Python and the numpy backends
+    vector: dot product, addition and norm of float vectors of n entries, on lists and through numpy arrays
+    isomers: generation of the alkane isomers of n carbons (python benchmarks.py isomers --sizes 10 15 20)
+    isotopes: isotope patterns of batches of n random peptide-like formulas (python benchmarks.py isotopes)
+    formulas: CHNOPS formulas within 0.005 of a target mass (python benchmarks.py formulas --sizes 200 500 1000)
+    titration: curves of n weak acid samples over 5000 added volumes each (python benchmarks.py titration)"""
+import argparse
+import fractions
+import random
+import time
+import isomers
+import isotopes
+import numpy
+from CHEMaths import Molecule, SolutionArray, search_molecular_formulas
+from linear_algebra import Matrix, Vector
+
+
+def random_rational_matrix(m: int, n: int, density: float, seed=0) -> Matrix:
+    """Random m x n matrix of fractions with small numerators and denominators, density being the share of non-zeros"""
+    generator = random.Random(seed)
+    return Matrix.from_nested_list([
+        [
+            fractions.Fraction(generator.randint(-9, 9), generator.randint(1, 4))
+            if generator.random() < density else fractions.Fraction(0) for _ in range(n)
+        ] for _ in range(m)
+    ])
+
+
+def best_time(function, repeat: int) -> float:
+    """Smallest wall time of several runs of function(), in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_matrix(sizes: list, density: float, repeat: int) -> list:
+    """Time row reduction and the operations reusing it; return one row of timings (ms) per size"""
+    results = []
+    for n in sizes:
+        matrix = random_rational_matrix(n - 1, n, density, seed=n)
+
+        def cold(operation):
+            """Run an operation on a fresh copy, so that the row reduction is computed again"""
+            return lambda: getattr(Matrix.from_nested_list(matrix.matrix), operation)()
+
+        def warm():
+            """rank, solve and null_space on one matrix: the row reduction is computed once"""
+            A = Matrix.from_nested_list(matrix.matrix)
+            A.rank(), A.solve(), A.null_space()
+
+        results.append({
+            'size': f"{n - 1}x{n}",
+            'rref': best_time(cold('rref'), repeat) * 1000,
+            'rank': best_time(cold('rank'), repeat) * 1000,
+            'null_space': best_time(cold('null_space'), repeat) * 1000,
+            'null_space_modular': best_time(cold('null_space_modular'), repeat) * 1000,
+            'rank+solve+null_space': best_time(warm, repeat) * 1000
+        })
+    return results
+
+
+def benchmark_float_matrix(sizes: list, density: float, repeat: int) -> list:
+    """Time the row reduction of float matrices on both backends, with the largest difference between them"""
+    results = []
+    for n in sizes:
+        matrix = random_rational_matrix(n - 1, n, density, seed=n)
+        rows = [[float(entry) for entry in row] for row in matrix.matrix]
+        threshold = Matrix.numpy_threshold
+        try:
+            Matrix.numpy_threshold = float('inf')
+            python_time = best_time(lambda: Matrix.from_nested_list(rows).rref(), repeat)
+            python_rref = Matrix.from_nested_list(rows).rref()
+            Matrix.numpy_threshold = 0
+            numpy_time = best_time(lambda: Matrix.from_nested_list(rows).rref(), repeat)
+            numpy_rref = Matrix.from_nested_list(rows).rref()
+        finally:
+            Matrix.numpy_threshold = threshold
+        results.append({
+            'size': f"{n - 1}x{n}",
+            'python': python_time * 1000,
+            'numpy': numpy_time * 1000,
+            'max difference': float(max(
+                abs(a - b) for python_row, numpy_row in zip(python_rref, numpy_rref)
+                for a, b in zip(python_row, numpy_row)
+            ))
+        })
+    return results
+
+
+def benchmark_vector(sizes: list, density: float, repeat: int) -> list:
+    """Time Vector operations against the same operations through numpy, converting from and to lists as a numpy
+    backend of Vector would (times of 1000 operations)"""
+    results = []
+    for n in sizes:
+        generator = random.Random(n)
+        v, w = (Vector([generator.random() for _ in range(n)]) for _ in range(2))
+
+        def thousand(operation):
+            """Run an operation 1000 times"""
+            return lambda: [operation() for _ in range(1000)]
+
+        results.append({
+            'size': n,
+            'dot python': best_time(thousand(lambda: v.dot_product(w)), repeat) * 1000,
+            'dot numpy': best_time(thousand(lambda: float(numpy.dot(v.vector, w.vector))), repeat) * 1000,
+            'add python': best_time(thousand(lambda: v + w), repeat) * 1000,
+            'add numpy': best_time(thousand(
+                lambda: Vector((numpy.array(v.vector) + numpy.array(w.vector)).tolist())
+            ), repeat) * 1000,
+            'norm python': best_time(thousand(v.norm), repeat) * 1000,
+            'norm numpy': best_time(thousand(lambda: float(numpy.linalg.norm(v.vector))), repeat) * 1000
+        })
+    return results
+
+
+def benchmark_isomers(sizes: list, density: float, repeat: int) -> list:
+    """Time the enumeration of alkane skeletons and the generation of isomers with their formulas"""
+    results = []
+    for n in sizes:
+        count = isomers.count_alkane_isomers(n)
+        skeleton_time = best_time(lambda: sum(1 for _ in isomers.skeletons(n)), repeat)
+        isomer_time = best_time(lambda: sum(1 for _ in isomers.alkane_isomers(n)), repeat)
+        results.append({
+            'size': f"C{n}H{2 * n + 2}",
+            'isomers': count,
+            'skeletons ms': skeleton_time * 1000,
+            'isomers ms': isomer_time * 1000,
+            'isomers per s': count / isomer_time if isomer_time else float('inf')
+        })
+    return results
+
+
+def benchmark_isotopes(sizes: list, density: float, repeat: int) -> list:
+    """Time isotope patterns of batches of random CcHhNnOoSs formulas of up to a few hundred atoms each"""
+    results = []
+    for n in sizes:
+        generator = random.Random(n)
+        formulas = [{
+            'C': generator.randint(1, 300), 'H': generator.randint(1, 500), 'N': generator.randint(0, 80),
+            'O': generator.randint(0, 90), 'S': generator.randint(0, 8), 'sign': 0
+        } for _ in range(n)]
+        batch_time = best_time(lambda: isotopes.isotope_patterns(formulas), repeat)
+        single_time = best_time(lambda: [isotopes.isotope_pattern(formula) for formula in formulas], repeat)
+        results.append({
+            'formulas': n,
+            'batch ms': batch_time * 1000,
+            'one by one ms': single_time * 1000,
+            'ms per formula': batch_time * 1000 / n
+        })
+    return results
+
+
+def benchmark_formula_search(sizes: list, density: float, repeat: int) -> list:
+    """Time the search of CHNOPS formulas by target mass, with the counts bounded by what fits in the mass"""
+    results = []
+    for target in sizes:
+        ranges = {
+            'C': (0, target // 12), 'H': (0, target // 6), 'N': (0, target // 50), 'O': (0, target // 33),
+            'P': (0, min(5, target // 100)), 'S': (0, min(5, target // 100))
+        }
+        count = sum(1 for _ in search_molecular_formulas(target + 0.5, 0.005, ranges))
+        filtered_count = sum(1 for _ in search_molecular_formulas(
+            target + 0.5, 0.005, ranges, min_dbe=0, even_electron=True
+        ))
+        results.append({
+            'target': f"{target + 0.5}",
+            'formulas': count,
+            'search ms': best_time(lambda: sum(1 for _ in search_molecular_formulas(
+                target + 0.5, 0.005, ranges
+            )), repeat) * 1000,
+            'DBE-filtered formulas': filtered_count,
+            'filtered search ms': best_time(lambda: sum(1 for _ in search_molecular_formulas(
+                target + 0.5, 0.005, ranges, min_dbe=0, even_electron=True
+            )), repeat) * 1000
+        })
+    return results
+
+
+def benchmark_titration(sizes: list, density: float, repeat: int) -> list:
+    """Time the titration curves of samples of acetic acid-like weak acids (random Ka) with 0.1 M NaOH"""
+    results = []
+    added_volumes = numpy.linspace(0, 50, 5000)
+    for n in sizes:
+        generator = numpy.random.RandomState(n)
+        samples = SolutionArray(
+            numpy.full(n, 25.0), Molecule.from_string('C2H4O2'), generator.uniform(0.01, 0.2, n)
+        )
+        ka = 10 ** generator.uniform(-7, -2, n)
+        weak_time = best_time(lambda: samples.titration_curves(0.1, added_volumes, ka=ka), repeat)
+        strong_time = best_time(lambda: samples.titration_curves(0.1, added_volumes), repeat)
+        results.append({
+            'samples': n,
+            'points': n * len(added_volumes),
+            'weak acid ms': weak_time * 1000,
+            'strong acid ms': strong_time * 1000,
+            'us per weak point': weak_time * 1e6 / (n * len(added_volumes))
+        })
+    return results
+
+
+def format_results(results: list) -> str:
+    """Tabulate benchmark results"""
+    columns = list(results[0].keys()) if results else []
+    lines = [''.join(f"{column:>24}" for column in columns)]
+    for row in results:
+        lines.append(''.join(f"{row[column]:>24.3g}" if isinstance(row[column], float) else f"{row[column]:>24}"
+                             for column in columns))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmarks of CHEMaths maths kernels (times in ms)")
+    parser.add_argument('kernel', choices=[
+        'matrix', 'matrix-float', 'vector', 'isomers', 'isotopes', 'formulas', 'titration'
+    ])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 50, 100, 200])
+    parser.add_argument('--density', type=float, default=0.1, help="share of non-zero entries")
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+    benchmark = {
+        'matrix': benchmark_matrix, 'matrix-float': benchmark_float_matrix, 'vector': benchmark_vector,
+        'isomers': benchmark_isomers,
+        'isotopes': benchmark_isotopes, 'formulas': benchmark_formula_search, 'titration': benchmark_titration
+    }[arguments.kernel]
+    print(format_results(benchmark(arguments.sizes, arguments.density, arguments.repeat)))
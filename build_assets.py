@@ -0,0 +1,154 @@
+# coding=utf-8
+"""Build step of the static assets: fingerprinted copies and precompressed variants in static/dist
+Every file of static/ is copied to static/dist/ with the digest of its content in its name
+(ChemInput.js -> dist/ChemInput.1a2b3c4d5e6f.js), so that it can be cached forever: a new version gets a new name.
+References between assets (url(...) in stylesheets) are rewritten to the fingerprinted names first.
+Text assets also get .gz and (with the optional brotli package) .br variants, compressed once here instead of
+on every request. manifest.json maps the original paths to the fingerprinted ones, for the asset_url template helper.
+Usage: python build_assets.py [--clean] (run by bin/post_compile on deploy)"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+try:
+    import brotli
+except ImportError:  # gzip variants only
+    brotli = None
+
+STATIC_DIR = 'static'
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.txt', '.ttf', '.otf', '.eot')
+CSS_URL = re.compile(r"url\((['\"]?)(?!data:|https?:|/)([^'\")?#]+)([^'\")]*)\1\)")
+
+
+def fingerprinted_name(path: str, content: bytes) -> str:
+    """Path with the digest of the content before the extension"""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+
+def source_paths(static_dir=STATIC_DIR) -> list:
+    """Paths of the static files relative to static_dir (stylesheets last: they refer to the others)"""
+    paths = []
+    for directory, directories, files in os.walk(static_dir):
+        if os.path.abspath(directory) == os.path.abspath(os.path.join(static_dir, 'dist')):
+            directories[:] = []
+            continue
+        directories.sort()
+        paths.extend(
+            os.path.relpath(os.path.join(directory, name), static_dir).replace(os.sep, '/') for name in sorted(files)
+        )
+    return sorted(paths, key=lambda path: path.endswith('.css'))
+
+
+def rewrite_css(path: str, content: bytes, manifest: dict) -> bytes:
+    """Point the relative url(...) of a stylesheet to the fingerprinted assets
+    (or to the original location when the asset is not in static/, as the stylesheet moves to dist/)"""
+    def replace(match):
+        quote, reference, suffix = match.groups()
+        target = os.path.normpath(os.path.join(os.path.dirname(path), reference)).replace(os.sep, '/')
+        url = f"/{STATIC_DIR}/{manifest[target]}" if target in manifest else f"/{STATIC_DIR}/{target}"
+        return f"url({quote}{url}{suffix}{quote})"
+    return CSS_URL.sub(replace, content.decode()).encode()
+
+
+def compress(path: str, content: bytes) -> list:
+    """Write the .gz and .br variants of an asset that are smaller than it; return their paths"""
+    written = []
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]  # mtime=0: reproducible builds
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as variant:
+                variant.write(compressed)
+            written.append(path + suffix)
+    return written
+
+
+def build(clean=True, static_dir=STATIC_DIR) -> dict:
+    """Fingerprint and compress every file of static_dir into its dist directory; return (and save) the manifest"""
+    dist_dir = os.path.join(static_dir, 'dist')
+    if clean and os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    manifest = {}
+    for path in source_paths(static_dir):
+        with open(os.path.join(static_dir, path), 'rb') as source:
+            content = source.read()
+        if path.endswith('.css'):
+            content = rewrite_css(path, content, manifest)
+        manifest[path] = 'dist/' + fingerprinted_name(path, content)
+        destination = os.path.join(static_dir, manifest[path])
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as output:
+            output.write(content)
+        if path.endswith(COMPRESSIBLE):
+            compress(destination, content)
+    os.makedirs(dist_dir, exist_ok=True)
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(path=MANIFEST) -> dict:
+    """Manifest of the last build, empty if the assets have not been built (the originals are then served)"""
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def debug():
+    """Test the functionality of functions, on a build of sample assets in a temporary directory"""
+    script = b'document.getElementById("preview").textContent = "CHEMaths";\n' * 50
+    with tempfile.TemporaryDirectory() as directory:
+        static_dir = os.path.join(directory, STATIC_DIR)
+        os.makedirs(os.path.join(static_dir, 'fonts'))
+        for path, content in (('ChemInput.js', script), ('fonts/math.ttf', b'\0\1'),
+                              ('ChemInput.css', b'@font-face { src: url("fonts/math.ttf?v=2"); }')):
+            with open(os.path.join(static_dir, path), 'wb') as asset:
+                asset.write(content)
+        manifest = build(static_dir=static_dir)
+        dist_dir = os.path.join(static_dir, 'dist')
+
+        def read(path: str) -> bytes:
+            """Content of a built file"""
+            with open(os.path.join(static_dir, path), 'rb') as built:
+                return built.read()
+
+        valid = [
+            # ---Debugging 1 - fingerprinted copies: the digest of the content in the name, the same content
+            manifest['ChemInput.js'] == 'dist/' + fingerprinted_name('ChemInput.js', script) and
+            read(manifest['ChemInput.js']) == script,
+            # ---Debugging 2 - stylesheets point to the fingerprinted assets, query string kept
+            read(manifest['ChemInput.css']).decode() ==
+            f'@font-face {{ src: url("/static/{manifest["fonts/math.ttf"]}?v=2"); }}',
+            # ---Debugging 3 - precompressed variants only when smaller: gzip of the script, none of the tiny font
+            gzip.decompress(read(manifest['ChemInput.js'] + '.gz')) == script and
+            not os.path.exists(os.path.join(static_dir, manifest['fonts/math.ttf'] + '.gz')),
+            # ---Debugging 4 - the saved manifest is the one returned, and the dist directory is not an asset
+            load_manifest(os.path.join(dist_dir, 'manifest.json')) == manifest and
+            sorted(manifest) == ['ChemInput.css', 'ChemInput.js', 'fonts/math.ttf']
+        ]
+    invalid = [index + 1 for index, func in enumerate(valid) if not func]
+    if any(invalid):
+        print(f"Warning: Bug detected.\nContact developers (via github): reference code {invalid}\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the static assets into static/dist")
+    parser.add_argument('--clean', action='store_true', help="only remove static/dist")
+    arguments = parser.parse_args()
+    debug()
+    if arguments.clean:
+        shutil.rmtree(DIST_DIR, ignore_errors=True)
+    else:
+        built = build()
+        print(f"{len(built)} assets fingerprinted into {DIST_DIR}" + ("" if brotli else " (no brotli: gzip only)"))
@@ -0,0 +1,59 @@
+# coding=utf-8
+"""Coalescing of identical concurrent computations within a worker (single-flight)
+When a class types the same example at the same moment, the first request for a key computes it and the others
+arriving while it runs wait for its result instead of computing it again. Nothing is kept once the computation
+is done: caching finished results is the job of shared_cache / result_store.
+The share of coalesced calls is counted for /stats."""
+import concurrent.futures
+import threading
+
+
+class SingleFlight:
+    """Run one computation at a time per key; concurrent callers with the same key share its result (or error)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> Future of the computation in flight
+        self.counters = dict.fromkeys(['calls', 'coalesced', 'errors'], 0)
+        self.max_waiting = 0
+        self.waiting = {}  # key -> number of callers waiting on the flight
+
+    def do(self, key, function, *args, **kwargs):
+        """Result of function(*args, **kwargs), computed by this call or by a concurrent one with the same key
+        An exception raised by the computation is raised to every caller sharing it."""
+        with self.lock:
+            self.counters['calls'] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = concurrent.futures.Future()
+                self.waiting[key] = 0
+            else:
+                self.counters['coalesced'] += 1
+                self.waiting[key] += 1
+                self.max_waiting = max(self.max_waiting, self.waiting[key])
+        if not leader:
+            return flight.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as error:
+            with self.lock:
+                self.counters['errors'] += 1
+                del self.flights[key], self.waiting[key]
+            flight.set_exception(error)
+            raise
+        with self.lock:
+            del self.flights[key], self.waiting[key]
+        flight.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        """Calls, coalesced calls and their share, flights in progress and the most callers sharing one"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'coalescing_rate': self.counters['coalesced'] / self.counters['calls'] if self.counters['calls'] else 0,
+                'in_flight': len(self.flights),
+                'max_waiting': self.max_waiting
+            })
+        return stats
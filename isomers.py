@@ -0,0 +1,339 @@
+# coding=utf-8
+"""Constitutional isomers of alkanes CnH2n+2, generated one at a time
+A carbon skeleton is a tree of n carbons with at most 4 neighbours each. Every tree is generated once, from its
+centroid: either one carbon whose branches all have at most (n - 1) // 2 carbons (up to 4 branches), or, for even n,
+a bond between two alkyl radicals of n / 2 carbons each.
+Alkyl radicals (rooted trees whose root has at most 3 children) are numbered by size, and a branch multiset is
+a non-decreasing tuple of radical numbers, so isomers come out in a fixed order: the tuple of an isomer is its
+cursor for resuming, and the first branch of the tuple splits the work into root partitions for parallel runs.
+Only the radicals of at most n / 2 carbons are kept in memory, whatever the number of isomers.
+Usage: python isomers.py <n> [--count] [--processes 4] [--after CURSOR]"""
+import argparse
+import collections
+import functools
+import itertools
+import json
+import multiprocessing
+import queue
+import sys
+import time
+
+Isomer = collections.namedtuple('Isomer', ['encoding', 'condensed_formula', 'cursor'])
+Isomer.__doc__ = """One constitutional isomer
+    encoding: canonical SMILES-like string of the carbon skeleton (e.g. 'C(C)(C)C' for isobutane)
+    condensed_formula: condensed structural formula along the longest chain (e.g. 'CH_3CH(CH_3)CH_3')
+    cursor: (kind, branches) position of the isomer, to resume after it with alkane_isomers(n, after=cursor)"""
+
+CHUNK_SIZE = 10000  # isomers a worker generates at a time in parallel runs (see parallel_alkane_isomers)
+
+
+class RadicalTable:
+    """Alkyl radicals of 1 to max_size carbons, numbered by size
+    children[g] is the non-decreasing tuple of radical numbers attached to the root of radical g"""
+
+    def __init__(self, max_size: int):
+        self.sizes = []
+        self.children = []
+        self.start = [0, 0]  # start[s]: number of the first radical of size s (start[s + 1] ends it)
+        self.encodings = {}
+        for size in range(1, max_size + 1):
+            for children in self.choose(size - 1, 3, 0, size - 1):
+                self.sizes.append(size)
+                self.children.append(children)
+            self.start.append(len(self.sizes))
+
+    def choose(self, total: int, slots: int, lowest: int, max_size: int, after=None):
+        """Yield non-decreasing tuples of at most `slots` radical numbers (each >= lowest, of at most max_size
+        carbons) whose sizes add up to total, in lexicographic order
+        after: only yield tuples coming after this one"""
+        if total == 0:
+            if after != ():
+                yield ()
+            return
+        if slots == 0 or lowest >= len(self.sizes):
+            return
+        first_size = self.sizes[lowest]
+        for size in range(first_size, min(total, max_size) + 1):
+            # the following radicals are at least as large: the rest is either empty or at least `size` again,
+            # and at most max_size for each of the remaining slots
+            if size != total and (total - size < size or (slots - 1) * max_size < total - size):
+                continue
+            begin = max(lowest, self.start[size])
+            if after:
+                if after[0] >= self.start[size + 1]:
+                    continue
+                begin = max(begin, after[0])
+            for g in range(begin, self.start[size + 1]):
+                rest_after = after[1:] if after and g == after[0] else None
+                for rest in self.choose(total - size, slots - 1, g, max_size, rest_after):
+                    yield (g,) + rest
+
+    def encoding(self, g: int) -> str:
+        """SMILES-like string of a radical, starting at its root"""
+        if g not in self.encodings:
+            self.encodings[g] = join_branches([self.encoding(child) for child in self.children[g]])
+        return self.encodings[g]
+
+
+def join_branches(branches: list) -> str:
+    """Carbon with branches: every branch but the last in parentheses"""
+    return 'C' + ''.join(f"({branch})" for branch in branches[:-1]) + (branches[-1] if branches else '')
+
+
+def radical_counts(max_size: int) -> list:
+    """Number of alkyl radicals of 0 to max_size carbons (counting, without generating them)"""
+    counts = [1]
+    for size in range(1, max_size + 1):
+        counts.append(count_multisets(counts, size - 1, 3, size - 1))
+    return counts
+
+
+def count_multisets(counts: list, total: int, slots: int, max_size: int) -> int:
+    """Number of multisets of at most `slots` radicals, of at most max_size carbons, whose sizes add up to total
+    counts[s] is the number of radicals of s carbons"""
+    ways = [[0] * (total + 1) for _ in range(slots + 1)]  # ways[j][t]: j radicals of t carbons
+    ways[0][0] = 1
+    for size in range(1, max_size + 1):
+        updated = [row.copy() for row in ways]
+        choices = 1
+        for copies in range(1, slots + 1):
+            if copies * size > total:
+                break
+            # multisets of `copies` radicals among counts[size]: C(counts[size] + copies - 1, copies), built up
+            # one copy at a time instead of through the factorials of the (huge) counts
+            choices = choices * (counts[size] + copies - 1) // copies
+            for j in range(copies, slots + 1):
+                for t in range(copies * size, total + 1):
+                    updated[j][t] += ways[j - copies][t - copies * size] * choices
+        ways = updated
+    return sum(ways[j][total] for j in range(slots + 1))
+
+
+def count_alkane_isomers(n: int) -> int:
+    """Number of constitutional isomers of CnH2n+2"""
+    if n < 1:
+        return 0
+    counts = radical_counts(n // 2)
+    centroid = count_multisets(counts, n - 1, 4, (n - 1) // 2)
+    bicentroid = counts[n // 2] * (counts[n // 2] + 1) // 2 if n % 2 == 0 else 0
+    return centroid + bicentroid
+
+
+def root_partitions(n: int) -> list:
+    """Keys splitting the isomers of CnH2n+2 into disjoint parts, for parallel runs:
+    ('centroid', first two branches) or ('bicentroid', (first radical,))"""
+    if n == 1:
+        return [('centroid', ())]
+    table = RadicalTable(n // 2)
+    max_size = (n - 1) // 2
+    partitions = []
+    for g1 in range(table.start[max_size + 1]):
+        for g2 in range(g1, table.start[max_size + 1]):
+            rest = n - 1 - table.sizes[g1] - table.sizes[g2]
+            if rest == 0 or table.sizes[g2] <= rest <= 2 * max_size:
+                partitions.append(('centroid', (g1, g2)))
+    if n % 2 == 0:
+        partitions += [('bicentroid', (g,)) for g in range(table.start[n // 2], table.start[n // 2 + 1])]
+    return partitions
+
+
+def skeletons(n: int, after=None, partition=None, table=None):
+    """Yield the cursor (kind, branches) of every isomer of CnH2n+2, in order (see alkane_isomers)
+    The branches of after may be any sequence (e.g. a list, for a cursor read back from JSON)"""
+    if n < 1:
+        return
+    table = table or RadicalTable(n // 2)
+    kind, prefix = partition if partition is not None else (None, None)
+    after_kind, after_branches = (after[0], tuple(after[1])) if after is not None else ('centroid', None)
+    if kind in (None, 'centroid') and after_kind == 'centroid':
+        max_size = (n - 1) // 2
+        if n == 1:
+            if after is None:
+                yield 'centroid', ()
+        elif prefix is None:
+            for branches in table.choose(n - 1, 4, 0, max_size, after_branches):
+                yield 'centroid', branches
+        elif after_branches is None or tuple(after_branches[:2]) <= prefix:
+            rest_after = tuple(after_branches[2:]) if after_branches and tuple(after_branches[:2]) == prefix else None
+            rest = n - 1 - table.sizes[prefix[0]] - table.sizes[prefix[1]]
+            for branches in table.choose(rest, 2, prefix[1], max_size, rest_after):
+                yield 'centroid', prefix + branches
+    if kind in (None, 'bicentroid') and n % 2 == 0:
+        half = n // 2
+        for g1 in range(table.start[half], table.start[half + 1]):
+            if prefix is not None and (g1,) != prefix:
+                continue
+            for g2 in range(g1, table.start[half + 1]):
+                if after_kind == 'bicentroid' and (g1, g2) <= tuple(after_branches):
+                    continue
+                yield 'bicentroid', (g1, g2)
+
+
+def alkane_isomers(n: int, after=None, partition=None, table=None):
+    """Yield every constitutional isomer of CnH2n+2 exactly once, as an Isomer
+    after: cursor of an isomer yielded before, to resume right after it
+    partition: one of root_partitions(n), to only yield that part"""
+    table = table or RadicalTable(n // 2)
+    for kind, branches in skeletons(n, after, partition, table):
+        yield make_isomer(table, kind, branches)
+
+
+def make_isomer(table: RadicalTable, kind: str, branches: tuple) -> Isomer:
+    """Isomer of a centroid with its branches, or of two radicals bonded together"""
+    if not branches:
+        return Isomer('C', 'CH_4', (kind, branches))
+    if kind == 'centroid':
+        root_branches = list(branches)
+    else:
+        g1, g2 = branches
+        root_branches = list(table.children[g1]) + [g2]
+    encoding = join_branches([table.encoding(g) for g in root_branches])
+    # expand the skeleton into an adjacency list: node 0 is the centroid (or the root of the first radical)
+    neighbours = [[]]
+    stack = [(0, root_branches)]
+    while stack:
+        node, radicals = stack.pop()
+        for g in radicals:
+            child = len(neighbours)
+            neighbours.append([node])
+            neighbours[node].append(child)
+            stack.append((child, table.children[g]))
+    return Isomer(encoding, condensed_formula(neighbours), (kind, branches))
+
+
+def farthest(neighbours: list, origin: int) -> tuple:
+    """Farthest carbon from origin and the parent of every carbon on the way (breadth-first search)"""
+    parents = {origin: None}
+    queue = [origin]
+    for node in queue:
+        for neighbour in neighbours[node]:
+            if neighbour not in parents:
+                parents[neighbour] = node
+                queue.append(neighbour)
+    return queue[-1], parents
+
+
+def condensed_formula(neighbours: list) -> str:
+    """Condensed structural formula of a carbon skeleton, written along its longest chain
+    Ex: CH_3CH(CH_3)CH_2CH_3, CH_3C(CH_3)_2CH_3"""
+    if len(neighbours) == 1:
+        return "CH_4"
+    end, _ = farthest(neighbours, 0)
+    start, parents = farthest(neighbours, end)
+    chain = [start]
+    while parents[chain[-1]] is not None:
+        chain.append(parents[chain[-1]])
+    on_chain = set(chain)
+    return ''.join(
+        CARBONS[len(neighbours[node])] + substituents([
+            group(neighbours, neighbour, node) for neighbour in neighbours[node] if neighbour not in on_chain
+        ], last_unwrapped=False) if len(neighbours[node]) > 2 else CARBONS[len(neighbours[node])]
+        for node in chain
+    )
+
+
+CARBONS = ("CH_4", "CH_3", "CH_2", "CH", "C")  # by number of carbons bonded
+
+
+def carbon(neighbours: list, node: int) -> str:
+    """CH_3, CH_2, CH or C depending on the number of carbons bonded to this one"""
+    return CARBONS[len(neighbours[node])]
+
+
+def group(neighbours: list, node: int, parent: int) -> str:
+    """Condensed formula of the substituent starting at node (away from parent)"""
+    children = sorted(group(neighbours, child, node) for child in neighbours[node] if child != parent)
+    return carbon(neighbours, node) + substituents(children, last_unwrapped=True)
+
+
+def substituents(groups: list, last_unwrapped: bool) -> str:
+    """Parenthesized substituents, identical ones grouped as (CH_3)_2
+    With last_unwrapped, a group different from the others continues the chain without parentheses"""
+    if not groups:
+        return ''
+    tail = ''
+    if last_unwrapped and (len(groups) == 1 or groups[-1] != groups[0]):
+        tail = groups.pop()
+    counted = collections.Counter(groups)
+    return ''.join(
+        f"({name})" + (f"_{counted[name]}" if counted[name] > 1 else '') for name in sorted(counted)
+    ) + tail
+
+
+@functools.lru_cache(maxsize=4)
+def radical_table(max_size: int) -> RadicalTable:
+    """RadicalTable kept by a worker process for all the chunks it generates"""
+    return RadicalTable(max_size)
+
+
+def partition_worker(arguments: tuple) -> tuple:
+    """Generate at most `limit` isomers of one root partition after a cursor (None: from its start) in a worker
+    Return the partition, the count, the isomers ((encoding, condensed formula) pairs, None without keep)
+    and the cursor to continue from (None once the partition is done)"""
+    n, partition, after, limit, keep = arguments
+    table = radical_table(n // 2)
+    count, isomers, cursor = 0, [] if keep else None, None
+    for cursor in itertools.islice(skeletons(n, after, partition, table), limit):
+        count += 1
+        if keep:
+            isomers.append(make_isomer(table, *cursor)[:2])
+    return partition, count, isomers, cursor if count == limit else None
+
+
+def parallel_alkane_isomers(n: int, processes=None, keep=True, chunk_size=CHUNK_SIZE):
+    """Generate the root partitions of CnH2n+2 in a pool of processes, yielding (partition, count, isomers)
+    for every chunk of at most chunk_size isomers as it finishes (isomers are (encoding, condensed formula) pairs,
+    None without keep). A partition is resumed from the cursor of its previous chunk, and at most two chunks per
+    process are in flight, so memory does not grow with the size of the partitions."""
+    results = queue.Queue()
+    ready = collections.deque((partition, None) for partition in root_partitions(n))
+    most_in_flight = 2 * (processes or multiprocessing.cpu_count())
+    in_flight = 0
+    with multiprocessing.Pool(processes) as pool:
+        while ready or in_flight:
+            while ready and in_flight < most_in_flight:
+                partition, after = ready.popleft()
+                pool.apply_async(
+                    partition_worker, ((n, partition, after, chunk_size, keep),),
+                    callback=results.put, error_callback=results.put
+                )
+                in_flight += 1
+            result = results.get()
+            in_flight -= 1
+            if isinstance(result, BaseException):
+                raise result
+            partition, count, isomers, after = result
+            if after is not None:
+                ready.appendleft((partition, after))  # finish started partitions first
+            yield partition, count, isomers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate the constitutional isomers of CnH2n+2")
+    parser.add_argument('n', type=int)
+    parser.add_argument('--count', action='store_true', help="only count them")
+    parser.add_argument('--processes', type=int, help="split root partitions between processes")
+    parser.add_argument('--after', help="JSON cursor of the last isomer already generated, to resume after it")
+    arguments = parser.parse_args()
+    if arguments.processes and arguments.after:
+        # partitions finish in any order, so no single cursor tells which isomers a parallel run has printed
+        parser.error("--after cannot be used with --processes")
+    start_time = time.perf_counter()
+    total = 0
+    if arguments.processes:
+        for _, partition_count, partition_isomers in parallel_alkane_isomers(
+                arguments.n, arguments.processes, keep=not arguments.count
+        ):
+            total += partition_count
+            for isomer_encoding, isomer_condensed_formula in partition_isomers or []:
+                print(isomer_encoding, isomer_condensed_formula)
+    else:
+        resume = json.loads(arguments.after) if arguments.after else None
+        if arguments.count:
+            total = sum(1 for _ in skeletons(arguments.n, after=resume))
+        else:
+            for alkane in alkane_isomers(arguments.n, after=resume):
+                total += 1
+                print(alkane.encoding, alkane.condensed_formula, json.dumps(alkane.cursor))
+    print(f"{total} isomers (expected {count_alkane_isomers(arguments.n)}) in {time.perf_counter() - start_time:.2f} s",
+          file=sys.stderr)
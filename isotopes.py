@@ -0,0 +1,114 @@
+# coding=utf-8
+"""Isotope patterns of molecules, from the natural abundances of the isotopes of each element
+The isotopes of an element are laid on a grid of nominal masses (integers): its P spectrum holds the abundance of
+each nominal mass and its M spectrum the abundance times the exact mass. The pattern of a molecule is the product
+of the polynomials of its atoms, computed with FFTs: P^k and k M P^(k - 1) for k atoms of an element, then
+(P1 P2, M1 P2 + P1 M2) between elements, so that nothing is enumerated.
+Each nominal mass gives one centroided peak of mass M / P; peaks below a threshold (relative to the most intense
+one) are dropped. Formulas whose grids have the same length are transformed together.
+Usage: python isotopes.py '<latex>' ... [--threshold 1e-6] (or one latex formula per line on stdin)"""
+import argparse
+import collections
+import functools
+import json
+import sys
+import numpy
+
+ELECTRON_MASS = 0.000548579909
+THRESHOLD = 1e-6
+
+with open("static/data.json") as data:
+    isotopes = json.loads(data.read())["isotopes"]
+
+IsotopePeak = collections.namedtuple('IsotopePeak', ['mass', 'intensity'])
+IsotopePeak.__doc__ = """Centroided peak of an isotope pattern
+    mass: mean exact mass of the isotopic variants of one nominal mass (electrons removed for cations)
+    intensity: relative to the most intense peak of the pattern (100)"""
+
+
+@functools.lru_cache(maxsize=None)
+def element_distribution(element: str) -> tuple:
+    """(lightest nominal mass, P spectrum, M spectrum) of an element, over consecutive nominal masses"""
+    if element not in isotopes:
+        raise ValueError(f"{element}: no natural isotope data")
+    nominal_masses = [round(mass) for mass, _ in isotopes[element]]
+    lightest = min(nominal_masses)
+    p = numpy.zeros(max(nominal_masses) - lightest + 1)
+    m = numpy.zeros(len(p))
+    for (mass, abundance), nominal_mass in zip(isotopes[element], nominal_masses):
+        p[nominal_mass - lightest] += abundance
+        m[nominal_mass - lightest] += abundance * mass
+    return lightest, p, m
+
+
+@functools.lru_cache(maxsize=4096)
+def element_spectrum(element: str, length: int) -> tuple:
+    """Fourier transforms of the P and M spectra of an element on a grid of length nominal masses,
+    with the logarithm of the first"""
+    _, p, m = element_distribution(element)
+    transform_p = numpy.fft.rfft(p, length)
+    with numpy.errstate(divide='ignore'):
+        return transform_p, numpy.fft.rfft(m, length), numpy.log(transform_p)
+
+
+def atom_counts(molecular_formula: dict) -> dict:
+    """Number of atoms of each element of a parsed molecular formula (electrons are counted by the charge)"""
+    counts = {element: count for element, count in molecular_formula.items() if element not in ('sign', 'e') and count}
+    if not counts:
+        raise ValueError("no atom in the molecular formula")
+    return counts
+
+
+def isotope_patterns(molecular_formulas: list, threshold=THRESHOLD) -> list:
+    """Isotope patterns (lists of IsotopePeak by increasing mass) of parsed molecular formulas"""
+    groups = collections.defaultdict(list)  # grid length -> indices of the formulas
+    layouts = []
+    for index, molecular_formula in enumerate(molecular_formulas):
+        counts = atom_counts(molecular_formula)
+        span = sum((len(element_distribution(element)[1]) - 1) * count for element, count in counts.items())
+        layouts.append((counts, span))
+        groups[1 << span.bit_length()].append(index)  # longer than the span: the convolution does not wrap around
+
+    patterns = [None] * len(molecular_formulas)
+    for length, indices in groups.items():
+        elements = sorted({element for index in indices for element in layouts[index][0]})
+        counts = numpy.array([[layouts[index][0].get(element, 0) for element in elements] for index in indices])
+        p = numpy.ones((len(indices), length // 2 + 1), dtype=complex)
+        m = numpy.zeros_like(p)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for column, element in enumerate(elements):
+                element_p, element_m, log_p = element_spectrum(element, length)
+                k = counts[:, column:column + 1]
+                power_p = numpy.where(k > 0, numpy.exp(k * log_p), 1)  # complex powers through one logarithm
+                power_m = numpy.where(
+                    k > 1, k * element_m * numpy.exp((k - 1) * log_p), numpy.where(k > 0, element_m, 0)
+                )
+                p, m = p * power_p, m * power_p + p * power_m
+        p, m = numpy.fft.irfft(p, length), numpy.fft.irfft(m, length)
+        for row, index in enumerate(indices):
+            span = layouts[index][1]
+            row_p, row_m = p[row, :span + 1], m[row, :span + 1]
+            highest = row_p.max()
+            kept = row_p >= highest * threshold
+            masses = row_m[kept] / row_p[kept] - molecular_formulas[index].get('sign', 0) * ELECTRON_MASS
+            patterns[index] = [
+                IsotopePeak(mass, intensity)
+                for mass, intensity in zip(masses.tolist(), (row_p[kept] / highest * 100).tolist())
+            ]
+    return patterns
+
+
+def isotope_pattern(molecular_formula: dict, threshold=THRESHOLD) -> list:
+    """Isotope pattern (list of IsotopePeak by increasing mass) of a parsed molecular formula"""
+    return isotope_patterns([molecular_formula], threshold=threshold)[0]
+
+
+if __name__ == '__main__':
+    from latex_parser import latex2chem
+    parser = argparse.ArgumentParser(description="Centroided isotope patterns of molecules, one JSON list per line")
+    parser.add_argument('latex', nargs='*')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="relative to the most intense peak")
+    arguments = parser.parse_args()
+    formulas = arguments.latex or [line.strip() for line in sys.stdin if line.strip()]
+    for pattern in isotope_patterns([latex2chem(formula) for formula in formulas], threshold=arguments.threshold):
+        print(json.dumps([[round(mass, 6), round(intensity, 6)] for mass, intensity in pattern]))
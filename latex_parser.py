@@ -7,92 +7,63 @@ import CHEMaths
 from simpleeval import simple_eval
 
 
-def latex_valid(latex: str, mode: str) -> (bool, str):
-    """Check if there is any syntax error in the given latex string depending on given mode
-    Return True and an empty string if nothing is wrong, else return False with error message"""
-    latex = latex
-    if mode == "this":
-        return True, "Welcome! Type some chemistry or click on the red buttons :)"
-    elif mode == "molecule":
-        illegal_characters = [char for char in latex
-                              if char not in string.ascii_lowercase and char not in string.ascii_uppercase
-                              and char not in '0123456789+-()_^{ }\\']
-        if illegal_characters:
-            return False, f"Illegal character(s): '{''.join(illegal_characters)}'"
-        if "{ }" in latex:
-            return False, "Superscript / subscript is left empty"
-        if len(re.findall(r"(?<![A-Za-z])e(?!\^(-|{1-}))", latex)):
-            return False, "Electrons should only be used with -1 charge alone"
-        if len(re.findall(r"_(?!{?\d}?)", latex)):
-            return False, "Subscript should only contain integer coefficient"
-        if len(re.findall(r"\^(?!({\d)?[+-]}?)", latex)):
-            return False, "<br>" \
-                          "Superscript should only contain 1-digit integer charges <br>" \
-                          "(0 and 1 can and should be omitted) <br>" \
-                          "with '+' or '-' placed at the end <br>"
-        matched = re.findall(
-            r"(?:[()eA-Z][a-z]*(?:_{? ?\d*\}?(?:(?:_\d)?)*)?)+(?:\^{? ?\d*[+-]?}?)?", latex
-        )[0]
-        if matched != latex:
-            return False, "Syntax error"
-        parsed = latex2chem(latex)
-        for element in parsed.keys():
-            if element not in CHEMaths.relative_atomic_mass and element != "sign":
-                return False, f"Unknown element: '{element}'"
-        return True, parsed
-    elif mode == "equation":
-        try:
-            reactants_string, products_string = latex.split('\\rightarrow')
-        except ValueError:  # not enough values to unpack
-            return False, "Invalid syntax: '->' (\\rightarrow) is misplaced or missing"
-        else:
-            if not reactants_string:
-                return False, "No reactant found"
-            if not products_string:
-                return False, "No product found"
-            reactants = re.split(r"(?<!{\d)(?<!\^)\+", reactants_string)
-            products = re.split(r"(?<!{\d)(?<!\^)\+", products_string)
-            reactants_parsed, products_parsed = [], []
-            for index, molecule in enumerate(reactants + products):
-                molecule_check = latex_valid(molecule, "molecule")
-                if not molecule_check[0]:
-                    return False, f"'{molecule}': {molecule_check[1]}"
-                else:
-                    if index < len(reactants):
-                        reactants_parsed.append(molecule_check[1])  # parsed molecule
-                    else:
-                        products_parsed.append(molecule_check[1])
-            try:
-                equation = CHEMaths.Equation(reactants_parsed, products_parsed)
-            except ArithmeticError:
-                return False, "Arithmetic Error: this is not one single equation"
-            except ValueError:
-                return False, "Value Error: equation not feasible"
-            else:
-                return True, (
-                    [reactants_parsed, products_parsed],
-                    reactants, products, equation
-                )
-    else:
-        if mode == "empirical":
-            pass
-        if mode == "organic":
-            if len(latex.split("::")) != 2:
-                return False, "Syntax error: separator '::' not found or too many found"
-            else:
-                organic_mode, size = latex.split("::")  # TODO support eval, perhaps?
-                if not re.findall(r"^[1-9]\d*$", size):
-                    return False, f"{size}: Size should contain integer only"
-                else:
-                    if organic_mode == "alcohol":
-                        return True, CHEMaths.StraightChainPrimaryAlcohol(int(size))
-                    elif organic_mode == "alkane":
-                        return True, CHEMaths.StraightChainAlkane(int(size))
-                    else:
-                        return False, f"{organic_mode}: unsupported functional group " \
-                                      f"(not matched by 'alcohol' or 'alkane')"
+def check_molecule_syntax(latex: str):
+    """Return the message of the first syntax error in the latex string of a molecule, None if there is none"""
+    illegal_characters = [char for char in latex
+                          if char not in string.ascii_lowercase and char not in string.ascii_uppercase
+                          and char not in '0123456789+-()_^{ }\\']
+    if illegal_characters:
+        return f"Illegal character(s): '{''.join(illegal_characters)}'"
+    if "{ }" in latex:
+        return "Superscript / subscript is left empty"
+    if len(re.findall(r"(?<![A-Za-z])e(?!\^(-|{1-}))", latex)):
+        return "Electrons should only be used with -1 charge alone"
+    if len(re.findall(r"_(?!{?\d}?)", latex)):
+        return "Subscript should only contain integer coefficient"
+    if len(re.findall(r"\^(?!({\d)?[+-]}?)", latex)):
+        return "<br>" \
+               "Superscript should only contain 1-digit integer charges <br>" \
+               "(0 and 1 can and should be omitted) <br>" \
+               "with '+' or '-' placed at the end <br>"
+    matched = re.findall(
+        r"(?:[()eA-Z][a-z]*(?:_{? ?\d*\}?(?:(?:_\d)?)*)?)+(?:\^{? ?\d*[+-]?}?)?", latex
+    )
+    if not matched or matched[0] != latex:
+        return "Syntax error"
+    return None
+
+
+def check_elements(parsed: dict):
+    """Return an error message if the parsed molecule contains an unknown element, None otherwise"""
+    for element in parsed.keys():
+        if element not in CHEMaths.relative_atomic_mass and element != "sign":
+            return f"Unknown element: '{element}'"
+    return None
+
 
-        return True, ""
+REPEAT_COUNT = re.compile(r"\)_(?:\{(?P<braced>[A-Za-z]\w*|\d{3,})\}|(?P<letter>[A-Za-z]))")
+
+
+def split_repeat_unit(latex: str):
+    """Split the latex of a polymer, e.g. H(C_2H_4)_{n}H, into (head, repeat unit, count, tail)
+    count is a name ('n') or an integer of 3 digits or more; return None if there is no such repeat unit"""
+    matches = list(REPEAT_COUNT.finditer(latex))
+    if len(matches) != 1:
+        return None
+    match = matches[0]
+    level = 0
+    for opening in range(match.start() - 1, -1, -1):  # find the matching parenthesis
+        if latex[opening] == ')':
+            level += 1
+        elif latex[opening] == '(':
+            if not level:
+                break
+            level -= 1
+    else:
+        return None
+    count = match.group('braced') or match.group('letter')
+    return latex[:opening], latex[opening + 1:match.start()], int(count) if count.isdigit() else count, \
+        latex[match.end():]
 
 
 def eval_latex(latex: str) -> float:
@@ -268,11 +239,13 @@ def jingjie_latex2chem(latex: str) -> dict:
 def determine_mode(latex: str) -> str:
     """Determine the mode (i.e. functionality) the server should use to process the given latex string
     Return one of the following strings:
-    this (default case), molecule, equation, empirical, organic"""
+    this (default case), molecule, equation, empirical, organic, polymer"""
     if "::" in latex:
         return "organic"
     elif ":" in latex:
         return "empirical"
+    elif r"\rightarrow" not in latex and split_repeat_unit(latex):
+        return "polymer"
     elif latex:
         molecules_list = re.findall(
             r"(?:[()eA-Z][a-z]*(?:_{? ?\d*\}?(?:(?:_\d)?)*)?)+(?:\^{? ?\d*[+-]?\}?)?", latex
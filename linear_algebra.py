@@ -1,12 +1,43 @@
 # coding=utf-8
 """Implementation of matrices, along with other maths utilities
-Compared to numpy, this is merely my sketch trying to generalize mathematical concepts"""
+Compared to numpy, this is merely my sketch trying to generalize mathematical concepts
+When numpy is installed, the row reduction of large float matrices (at least Matrix.numpy_threshold entries,
+at least one of them a float and none a Fraction; integers such as zero padding are converted) is handed to it;
+matrices of Fraction or only int entries always stay on the exact pure Python path.
+For well-conditioned matrices, results of the two backends agree within about FLOAT_TOLERANCE times the
+condition number, relative to the largest entry: the numpy row reduction pivots on the largest entry of each
+column and treats entries below FLOAT_TOLERANCE times the largest entry of the matrix as zero"""
+import collections
 import fractions
 import functools
 import itertools
 import math
 import ast
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FLOAT_TOLERANCE = 1e-12
+
+
+def float_entries(*sequences) -> bool:
+    """Return True if the entries of the sequences are floats and integers, at least one of them a float
+    (and the numpy backend may be used, converting the integers)"""
+    if numpy is None:
+        return False
+    types = {type(entry) for sequence in sequences for entry in sequence}
+    return float in types and types <= {float, int}
+
+
+def divide_entries(entries: list, divisor) -> list:
+    """Divide the entries by a non-zero constant, exactly for fractions and integers
+    (an integer divided by an integer is a Fraction)"""
+    if type(divisor) is int:
+        return [fractions.Fraction(entry, divisor) if type(entry) is int else entry / divisor for entry in entries]
+    return [entry / divisor for entry in entries]
+
 
 def lcm(a: int, b: int) -> int:
     """Return lowest common multiple."""
@@ -34,6 +65,69 @@ def ext_euclid(a: int, b: int) -> tuple:
         return x, y, q
 
 
+# Mersenne primes used for modular elimination; their product bounds the rationals that can be reconstructed
+MODULAR_PRIMES = (2 ** 61 - 1, 2 ** 89 - 1, 2 ** 107 - 1, 2 ** 127 - 1, 2 ** 521 - 1, 2 ** 607 - 1)
+
+
+def rref_mod(rows: list, p: int) -> tuple:
+    """Reduced row echelon form of an integer matrix (nested list) over the integers modulo the prime p
+    Return the reduced rows (new lists) and the list of pivot columns"""
+    A = [[entry % p for entry in row] for row in rows]
+    m, n = len(A), len(A[0]) if A else 0
+    pivot_columns = []
+    row = 0
+    for col in range(n):
+        if row == m:
+            break
+        pivot_row = next((r for r in range(row, m) if A[r][col]), None)
+        if pivot_row is None:
+            continue
+        A[row], A[pivot_row] = A[pivot_row], A[row]
+        inverse = pow(A[row][col], p - 2, p)
+        pivot = A[row] = [entry * inverse % p for entry in A[row]]
+        for r in range(m):
+            factor = A[r][col]
+            if r != row and factor:
+                A[r] = [(entry - factor * pivot_entry) % p for entry, pivot_entry in zip(A[r], pivot)]
+        pivot_columns.append(col)
+        row += 1
+    return A, pivot_columns
+
+
+def chinese_remainder(residue1: int, modulus1: int, residue2: int, modulus2: int) -> int:
+    """Return x modulo modulus1 * modulus2 such that x = residue1 (mod modulus1) and x = residue2 (mod modulus2)
+    The two moduli have to be coprime"""
+    inverse = ext_euclid(modulus1, modulus2)[0] % modulus2  # modulus1 * inverse = 1 (mod modulus2)
+    return (residue1 + (residue2 - residue1) * inverse % modulus2 * modulus1) % (modulus1 * modulus2)
+
+
+def integer_sqrt(n: int) -> int:
+    """Return the floor of the square root of a non-negative integer of any size"""
+    if n < 2:
+        return n
+    x = 1 << ((n.bit_length() + 1) // 2)
+    while True:
+        y = (x + n // x) // 2
+        if y >= x:
+            return x
+        x = y
+
+
+def rational_reconstruction(a: int, m: int):
+    """Find the fraction r / s such that r = a * s (mod m) with |r|, s <= sqrt(m / 2)
+    Return None if no such fraction exists"""
+    bound = integer_sqrt(m // 2)
+    r0, r1 = m, a % m
+    s0, s1 = 0, 1
+    while r1 > bound:
+        quotient = r0 // r1
+        r0, r1 = r1, r0 - quotient * r1
+        s0, s1 = s1, s0 - quotient * s1
+    if s1 == 0 or abs(s1) > bound or math.gcd(r1, abs(s1)) != 1:
+        return None
+    return fractions.Fraction(r1, s1)
+
+
 def partition(n, k) -> int:
     """return number of partitions of integer n into k strictly positive parts"""
     if n == k:
@@ -49,11 +143,23 @@ def sf(number: float):
     pass
 
 
+RowReduction = collections.namedtuple('RowReduction', ['rows', 'pivots'])
+RowReduction.__doc__ = """Reduced row echelon form of a matrix (rows, not to be modified)
+    and its (row, column) pivots"""
+
+
 class Matrix:
     """Implementation of matrices in mathematics
-    constructs a zero matrix of size m * n by default"""
+    constructs a zero matrix of size m * n by default
+    Entries are stored row by row (self.matrix is a list of rows); the row reduction computed by factorize()
+    is kept with a snapshot of the entries it was computed from, and shared by rref, rank, solve and null_space
+    until self.matrix is replaced or its entries differ from the snapshot (e.g. after A.matrix[i][j] = x)
+    Float matrices with at least numpy_threshold entries are row reduced with numpy"""
+    numpy_threshold = 256
+
     def __init__(self, m: int, n: int, identity=False):
         """Initiate a m*n zero matrix"""
+        self.factorized_entries = None
         self.matrix = [[0] * n for _ in range(m)]
         self.size = [m, n]
 
@@ -72,13 +178,20 @@ class Matrix:
             A = SquareMatrix(m)
         else:
             A = Matrix(m, n)
-        for i in range(m):
-            nested_list = matrix_list[i]
-            for j in range(n):
-                entry = nested_list[j] if j < len(nested_list) else 0
-                A.assign_new_value(i, j, entry)
+        A.matrix = [list(nested_list) + [0] * (n - len(nested_list)) for nested_list in matrix_list]
         return A
 
+    @property
+    def matrix(self) -> list:
+        """Entries, row by row"""
+        return self.rows
+
+    @matrix.setter
+    def matrix(self, rows: list):
+        """Replace the entries, dropping the row reduction of the previous ones"""
+        self.rows = rows
+        self.factorization = None
+
     def __str__(self) -> str:
         """String representation of a matrix"""
         return "[\n" + '\n'.join(['  ' + ' '.join([str(num) for num in row]) for row in self.matrix]) + "\n]"
@@ -89,8 +202,11 @@ class Matrix:
 
     def __copy__(self) -> 'Matrix':
         """Return a copy of the matrix to avoid side effects"""
-        A = Matrix(self.size[0], self.size[1])
+        A = Matrix(0, 0)
         A.matrix = [row.copy() for row in self.matrix]
+        A.size = list(self.size)
+        A.factorization = self.factorization
+        A.factorized_entries = self.factorized_entries
         return A
 
     @staticmethod
@@ -106,142 +222,259 @@ class Matrix:
 
     def transpose(self, override=False) -> 'Matrix':
         """Return the transpose of this matrix"""
-        A = Matrix(self.size[1], self.size[0])
-        for i in range(self.size[0]):
-            for j in range(self.size[1]):
-                A.matrix[j][i] = self.matrix[i][j]
+        A = Matrix(0, 0)
+        A.matrix = [list(column) for column in zip(*self.matrix)] if self.size[0] else [[] for _ in range(self.size[1])]
+        A.size = self.size[::-1]
         if override:
             self.matrix = A.matrix
-            self.size = self.size[::-1]
+            self.size = A.size
+            self.factorization = None
         return A
 
     def assign_new_value(self, i: int, j: int, value):
         """Assign value to position (i, j) in the matrix"""
         self.matrix[i][j] = value
+        self.factorization = None
 
     def swap_rows(self, row_index1: int, row_index2: int):
         """Elementary row operation:
         Swap two rows inside a matrix"""
         self.matrix[row_index1], self.matrix[row_index2] = self.matrix[row_index2], self.matrix[row_index1]
+        self.factorization = None
 
-    def multiply_row(self, row_index: int, constant):
+    def multiply_row(self, row_index: int, constant, start=0):
         """Elementary row operation:
-        Multiply a row in the matrix by a non-zero constant"""
+        Multiply a row in the matrix by a non-zero constant (entries before start are left as they are)"""
         if constant != 0:
             row = self.matrix[row_index]
-            for col_index in range(self.size[1]):
-                row[col_index] *= constant
+            row[start:] = [entry * constant for entry in row[start:]]
+            self.factorization = None
 
-    def add_row(self, row_index: int, row_to_add_index: int, coefficient=1):
+    def divide_row(self, row_index: int, divisor, start=0):
         """Elementary row operation:
-        Add a multiple of a row to another row in the matrix"""
-        for col_index in range(self.size[1]):
-            self.matrix[row_index][col_index] += coefficient * self.matrix[row_to_add_index][col_index]
+        Divide a row in the matrix by a non-zero constant, exactly for fractions and integers
+        (an integer divided by an integer is a Fraction; entries before start are left as they are)"""
+        row = self.matrix[row_index]
+        row[start:] = divide_entries(row[start:], divisor)
+        self.factorization = None
 
-    def rref(self, override=False, return_pivots=False, juxtaposed=None):
-        """return the reduced row echelon form of the matrix"""
-        # Make a copy of matrix to avoid side effects
+    def add_row(self, row_index: int, row_to_add_index: int, coefficient=1, start=0):
+        """Elementary row operation:
+        Add a multiple of a row to another row in the matrix (entries before start are left as they are)"""
+        row, row_to_add = self.matrix[row_index], self.matrix[row_to_add_index]
+        row[start:] = [
+            entry + coefficient * entry_to_add for entry, entry_to_add in zip(row[start:], row_to_add[start:])
+        ]
+        self.factorization = None
+
+    def eliminate(self, juxtaposed=None) -> list:
+        """Reduce this matrix to reduced row echelon form in place (Gauss-Jordan elimination)
+        Operations on rows are also applied to the juxtaposed matrix, if any
+        The pivot row is divided exactly by the pivot (see divide_entries), and every row operation starts
+        at the pivot column since the entries on its left are already zero; return the list of (row, column) pivots"""
         m, n = self.size
-        A = self.__copy__()
-
-        # Transform the matrix into row echelon form
-        col = 0  # index of leading coefficient (first non-zero element in a row)
-        row = 0  # index of row containing the current leading coefficient
-        pivot_list = []
-
-        while row < m and col < n:
-            pivot = A.matrix[row][col]
-            if pivot == 0:
-                for new_row in range(row + 1, m):
-                    if A.matrix[new_row][col] != 0:
-                        pivot = A.matrix[new_row][col]
-                        if isinstance(juxtaposed, Matrix):
-                            juxtaposed.swap_rows(row, new_row)
-                        A.swap_rows(row, new_row)
-                        break
-                else:
-                    col += 1
+        if self.uses_numpy(juxtaposed):
+            return self.eliminate_numpy(juxtaposed)
+        rows = self.matrix
+        other = juxtaposed.matrix if isinstance(juxtaposed, Matrix) else None
+        pivots = []
+        row = 0
+        for col in range(n):
+            if row == m:
+                break
+            pivot_row = next((r for r in range(row, m) if rows[r][col] != 0), None)
+            if pivot_row is None:
+                continue
+            if pivot_row != row:
+                rows[row], rows[pivot_row] = rows[pivot_row], rows[row]
+                if other is not None:
+                    other[row], other[pivot_row] = other[pivot_row], other[row]
+            pivot = rows[row][col]
+            pivot_entries = rows[row]
+            if pivot != 1:
+                pivot_entries[col:] = divide_entries(pivot_entries[col:], pivot)
+                if other is not None:
+                    other[row] = divide_entries(other[row], pivot)
+            pivot_tail = pivot_entries[col:]
+            for r in range(m):
+                factor = rows[r][col]
+                if r == row or factor == 0:
                     continue
-            pivot_list.append((row, col))
-            if isinstance(juxtaposed, Matrix):
-                juxtaposed.multiply_row(row, 1 / pivot)
-            A.multiply_row(row, 1 / pivot)
-            for row_to_subtract in range(row + 1, m):
-                if A.matrix[row_to_subtract][col] != 0:
-                    if isinstance(juxtaposed, Matrix):
-                        juxtaposed.add_row(row_to_subtract, row, coefficient=-A.matrix[row_to_subtract][col])
-                    A.add_row(row_to_subtract, row, coefficient=-A.matrix[row_to_subtract][col])
+                target = rows[r]
+                target[col:] = [entry - factor * pivot_entry for entry, pivot_entry in zip(target[col:], pivot_tail)]
+                if other is not None:
+                    other[r] = [entry - factor * pivot_entry for entry, pivot_entry in zip(other[r], other[row])]
+            pivots.append((row, col))
             row += 1
-            col += 1
+        self.factorization = RowReduction(rows, pivots)
+        self.factorized_entries = [tuple(row) for row in rows]
+        if isinstance(juxtaposed, Matrix):
+            juxtaposed.factorization = None
+        return pivots
+
+    def uses_numpy(self, juxtaposed=None) -> bool:
+        """Whether the row reduction goes to numpy: a large float matrix, juxtaposed with floats or integers"""
+        return self.size[0] * self.size[1] >= self.numpy_threshold and float_entries(*self.matrix) and (
+            juxtaposed is None or all(type(entry) in (int, float) for row in juxtaposed.matrix for entry in row)
+        )
+
+    def eliminate_numpy(self, juxtaposed=None) -> list:
+        """eliminate() on float entries with numpy, pivoting on the largest entry of each column
+        Entries of a column below FLOAT_TOLERANCE times the largest entry of the matrix are taken as zero"""
+        m, n = self.size
+        other = juxtaposed.matrix if isinstance(juxtaposed, Matrix) else [[] for _ in range(m)]
+        array = numpy.array([row + list(other_row) for row, other_row in zip(self.matrix, other)], dtype=float)
+        tolerance = FLOAT_TOLERANCE * max(float(numpy.abs(array[:, :n]).max()), 1.0)
+        pivots = []
+        row = 0
+        for col in range(n):
+            if row == m:
+                break
+            pivot_row = row + int(numpy.argmax(numpy.abs(array[row:, col])))
+            if abs(array[pivot_row, col]) <= tolerance:
+                array[row:, col] = 0.0
+                continue
+            if pivot_row != row:
+                array[[row, pivot_row]] = array[[pivot_row, row]]
+            array[row, col:] /= array[row, col]
+            factors = array[:, col].copy()
+            factors[row] = 0.0
+            array[:, col:] -= numpy.outer(factors, array[row, col:])
+            array[:, col] = 0.0
+            array[row, col] = 1.0
+            pivots.append((row, col))
+            row += 1
+        self.matrix = array[:, :n].tolist()
+        self.factorization = RowReduction(self.matrix, pivots)
+        self.factorized_entries = [tuple(row) for row in self.matrix]
+        if isinstance(juxtaposed, Matrix):
+            juxtaposed.matrix = array[:, n:].tolist()
+            juxtaposed.factorization = None
+        return pivots
+
+    def factorize(self) -> RowReduction:
+        """Row reduction of this matrix, computed once on a copy and kept until the matrix changes"""
+        entries = [tuple(row) for row in self.matrix]
+        if self.factorization is None or entries != self.factorized_entries:
+            A = self.__copy__()
+            A.eliminate()
+            self.factorization = A.factorization
+            self.factorized_entries = entries
+        return self.factorization
 
-        # Transform matrix to reduced row echelon form
+    def rref(self, override=False, return_pivots=False, juxtaposed=None):
+        """return the reduced row echelon form of the matrix
+        override: reduce this matrix in place instead of working on a copy
+        juxtaposed: a matrix whose rows undergo the same row operations"""
+        if juxtaposed is not None:
+            A = self if override else self.__copy__()
+            A.eliminate(juxtaposed=juxtaposed)
+            if not override:
+                self.factorization = A.factorization
+                self.factorized_entries = [tuple(row) for row in self.matrix]
+            reduction = A.factorization
         else:
-            pivot_list_copy = pivot_list.copy()
-            while pivot_list:
-                r_pivot, r_col = pivot_list.pop()
-                for r in range(r_pivot):
-                    if isinstance(juxtaposed, Matrix):
-                        juxtaposed.add_row(r, r_pivot, coefficient=-A.matrix[r][r_col])
-                    A.add_row(r, r_pivot, coefficient=-A.matrix[r][r_col])
-
-        if override:
-            self.matrix = A.matrix
+            reduction = self.factorize()
+            if override:
+                self.matrix = [row.copy() for row in reduction.rows]
+                self.factorization = reduction  # the row reduction of a reduced matrix is itself
+                self.factorized_entries = [tuple(row) for row in self.matrix]
         if return_pivots:
-            return pivot_list_copy
-        return A.matrix
+            return list(reduction.pivots)
+        return [row.copy() for row in reduction.rows] if not override else self.matrix
 
     def rank(self, pre_processed=None) -> int:
-        """Returns the rank of this matrix
-        after reducing the matrix to reduced row echelon form"""
-        if not pre_processed:
-            row_echelon = self.rref()
-        else:
-            row_echelon = self.matrix
-        row_count = 0
-        while row_count < self.size[0]:
-            if all([num == 0 for num in row_echelon[row_count]]):
-                return row_count
-            row_count += 1
-        return self.size[0]
+        """Returns the rank of this matrix (the number of pivots of its row reduction)
+        pre_processed is accepted for compatibility: the row reduction is reused anyway"""
+        return len(self.factorize().pivots)
+
+    def free_columns(self) -> list:
+        """Columns without a pivot in the row reduction, i.e. the independent variables of Ax = 0"""
+        pivot_columns = set(col for _, col in self.factorize().pivots)
+        return [col for col in range(self.size[1]) if col not in pivot_columns]
 
     def solve(self):
         """Solve for X taking this matrix as the coefficient matrix"""
-        # avoid side effects
-        A = self.__copy__()
-        pivots = A.rref(override=True, return_pivots=True)  # pivots list
-        independent_variables = A.size[1] - A.rank(pre_processed=True)
-        if independent_variables == 0:  # no independent variable -> zero solution
+        rows, pivots = self.factorize()
+        independent_variables_list = self.free_columns()
+        if not independent_variables_list:  # no independent variable -> zero solution
             return [0] * self.size[1]
-        else:  # one or more independent variable
-            solution_lists = []
-            independent_variables_list = set([i for i in range(A.size[1])]) - set([pivot[1] for pivot in pivots])
-
-            for independent_variable in independent_variables_list:
-                local_solution_list = [fractions.Fraction(0)] * A.size[1]
-                for pivot in pivots:
-                    local_solution_list[pivot[1]] = -A.matrix[pivot[0]][independent_variable]
-                local_solution_list[independent_variable] = fractions.Fraction(1)
-
-                solution_lists.append(local_solution_list)
-            return solution_lists
+        solution_lists = []
+        for independent_variable in independent_variables_list:
+            local_solution_list = [fractions.Fraction(0)] * self.size[1]
+            for pivot_row, pivot_col in pivots:
+                local_solution_list[pivot_col] = -rows[pivot_row][independent_variable]
+            local_solution_list[independent_variable] = fractions.Fraction(1)
+            solution_lists.append(local_solution_list)
+        return solution_lists
 
     def null_space(self) -> list:
         """Determine the basis of kernel / null space of this matrix
         i.e. the set v such that Av = 0
-        This can be found by transforming (A^T|I^T)^T to (B^T|C^T)^T
-        where B^T is in row echelon form and B thus in column echelon form
-        the basis of the null space correspond to the non-zero rows of C^T such that
-        corresponding rows of B^T are zero rows"""
-        A_T = self.__copy__().transpose()  # avoid side effects
-        I_T = Matrix(self.size[1], self.size[1], identity=True)
-        B_T = A_T.rref(juxtaposed=I_T)  # note: B_T is a list of lists, not a Matrix
-        C_T = I_T
+        Read from the reduced row echelon form: one vector per free column, that column being set to 1
+        and the pivot variables to minus the entries of that column"""
+        if not self.free_columns():
+            return []
+        return [Vector(solution) for solution in self.solve()]
+
+    def lu(self) -> 'LUFactorization':
+        """Factor this square matrix once (PA = LU) to solve it for any number of right-hand sides"""
+        return LUFactorization(self)
+
+    def null_space_modular(self, primes=MODULAR_PRIMES) -> list:
+        """Determine the basis of the null space with modular arithmetic instead of exact fractions
+        The matrix is row reduced modulo one or more large primes, residues are combined with the chinese
+        remainder theorem, and entries are lifted back to fractions with rational reconstruction.
+        Primes are added until the lifted basis satisfies Av = 0 over the integers, which avoids
+        the coefficient growth of fraction elimination on large matrices.
+        Falls back to null_space if the primes run out; the basis is that of the rref (free variables set to 1)"""
+        m, n = self.size
+        # scale rows to integers: this does not change the null space
+        rows = []
+        for row in self.matrix:
+            multiple = lcm_multiple(1, *[fractions.Fraction(entry).denominator for entry in row])
+            rows.append([int(entry * multiple) for entry in row])
+
+        combined, modulus, pivot_columns = None, 1, None
+        for p in primes:
+            reduced, pivots = rref_mod(rows, p)
+            if pivot_columns is not None and pivots != pivot_columns:
+                # unlucky primes lose pivots or push them to the right: keep the earliest set of pivot columns
+                if len(pivots) < len(pivot_columns) or (len(pivots) == len(pivot_columns) and pivots > pivot_columns):
+                    continue
+                combined, modulus = None, 1
+            pivot_columns = pivots
+            free_columns = [col for col in range(n) if col not in set(pivots)]
+            residues = [[reduced[i][col] for col in free_columns] for i in range(len(pivots))]
+            if combined is None:
+                combined = residues
+            else:
+                combined = [
+                    [chinese_remainder(old, modulus, new, p) for old, new in zip(old_row, new_row)]
+                    for old_row, new_row in zip(combined, residues)
+                ]
+            modulus *= p
+
+            lifted = [[rational_reconstruction(entry, modulus) for entry in row] for row in combined]
+            if any(entry is None for row in lifted for entry in row):
+                continue  # not enough primes yet
+            kernel = []
+            for free_index, free_column in enumerate(free_columns):
+                solution = [fractions.Fraction(0)] * n
+                solution[free_column] = fractions.Fraction(1)
+                for pivot_index, pivot_column in enumerate(pivot_columns):
+                    solution[pivot_column] = -lifted[pivot_index][free_index]
+                kernel.append(solution)
+            if all(self.verify_null_vector(rows, solution) for solution in kernel):
+                return [Vector(solution) for solution in kernel]
+        return self.null_space()
 
-        kernel = []
-        for r_index in range(A_T.size[0]):
-            if all([B_T[r_index][c_index] == 0 for c_index in range(A_T.size[1])]):
-                kernel.append(Vector(C_T.matrix[r_index]))
-        return kernel
+    @staticmethod
+    def verify_null_vector(rows: list, solution: list) -> bool:
+        """Check that Av = 0 exactly for an integer matrix A (nested list) and a rational vector v"""
+        multiple = lcm_multiple(1, *[entry.denominator for entry in solution])
+        integer_solution = [int(entry * multiple) for entry in solution]
+        return all(sum(a * x for a, x in zip(row, integer_solution)) == 0 for row in rows)
 
 
 class SquareMatrix(Matrix):
@@ -263,8 +496,241 @@ class SquareMatrix(Matrix):
         return sum_determinant
 
 
+class LUFactorization:
+    """PA = LU factorization of a square matrix with row pivoting, to solve Ax = b for many b
+    Exact if the matrix has no float entry (entries become fractions, the first non-zero entry is the pivot),
+    otherwise in floats with the largest entry of the column as pivot
+    lu holds L (below the diagonal, unit diagonal implied) and U (diagonal and above); row i of PA is row
+    permutation[i] of A"""
+    def __init__(self, matrix: Matrix):
+        n = matrix.size[0]
+        if matrix.size[1] != n:
+            raise ValueError("only square matrices can be factored")
+        self.size = n
+        self.exact = not any(type(entry) is float for row in matrix.matrix for entry in row)
+        convert = fractions.Fraction if self.exact else float
+        rows = [[convert(entry) for entry in row] for row in matrix.matrix]
+        tolerance = 0 if self.exact else FLOAT_TOLERANCE * max([abs(entry) for row in rows for entry in row] + [1.0])
+        self.permutation = list(range(n))
+        self.sign = 1
+        for k in range(n):
+            if self.exact:
+                pivot_row = next((r for r in range(k, n) if rows[r][k] != 0), k)
+            else:
+                pivot_row = max(range(k, n), key=lambda r: abs(rows[r][k]))
+            if abs(rows[pivot_row][k]) <= tolerance:
+                raise ValueError("matrix is singular")
+            if pivot_row != k:
+                rows[k], rows[pivot_row] = rows[pivot_row], rows[k]
+                self.permutation[k], self.permutation[pivot_row] = self.permutation[pivot_row], self.permutation[k]
+                self.sign = -self.sign
+            pivot_entries = rows[k]
+            pivot_tail = pivot_entries[k + 1:]
+            for r in range(k + 1, n):
+                factor = rows[r][k] / pivot_entries[k]
+                rows[r][k] = factor
+                if factor != 0:
+                    target = rows[r]
+                    target[k + 1:] = [entry - factor * pivot_entry
+                                      for entry, pivot_entry in zip(target[k + 1:], pivot_tail)]
+        self.lu = rows
+
+    def det(self):
+        """Determinant of the factored matrix"""
+        determinant = self.sign
+        for i in range(self.size):
+            determinant *= self.lu[i][i]
+        return determinant
+
+    def solve(self, b: list) -> list:
+        """Solve Ax = b for one right-hand side (a list of n numbers)"""
+        return [row[0] for row in self.solve_many([[entry] for entry in b])]
+
+    def solve_many(self, b):
+        """Solve AX = B for a right-hand side matrix B of n rows: a Matrix, a nested list or a numpy array
+        Return X in the same form; float systems with many right-hand sides are solved with numpy"""
+        rows = b.matrix if isinstance(b, Matrix) else b
+        k = len(rows[0]) if self.size else 0
+        if numpy is not None and (isinstance(b, numpy.ndarray) or
+                                  not self.exact and self.size * k >= Matrix.numpy_threshold):
+            solution = self.substitute_numpy(numpy.asarray(rows, dtype=float))
+            if isinstance(b, numpy.ndarray):
+                return solution
+            solution = solution.tolist()
+        else:
+            solution = self.substitute([list(row) for row in rows])
+        if isinstance(b, Matrix):
+            X = Matrix(0, 0)
+            X.matrix, X.size = solution, [self.size, k]
+            return X
+        return solution
+
+    def substitute(self, rows: list) -> list:
+        """Forward then back substitution on the rows of the right-hand sides (lists, changed in place)"""
+        n, lu = self.size, self.lu
+        convert = fractions.Fraction if self.exact else float
+        rows = [[convert(entry) for entry in rows[index]] for index in self.permutation]
+        for i in range(n):
+            for j in range(i):
+                factor = lu[i][j]
+                if factor != 0:
+                    rows[i] = [entry - factor * other for entry, other in zip(rows[i], rows[j])]
+        for i in reversed(range(n)):
+            for j in range(i + 1, n):
+                factor = lu[i][j]
+                if factor != 0:
+                    rows[i] = [entry - factor * other for entry, other in zip(rows[i], rows[j])]
+            rows[i] = [entry / lu[i][i] for entry in rows[i]]
+        return rows
+
+    def substitute_numpy(self, array):
+        """substitute() on a float numpy array, each step covering every right-hand side at once"""
+        n = self.size
+        lu = numpy.array(self.lu, dtype=float)
+        array = array[self.permutation].copy()
+        for i in range(n):
+            array[i] -= lu[i, :i] @ array[:i]
+        for i in reversed(range(n)):
+            array[i] = (array[i] - lu[i, i + 1:] @ array[i + 1:]) / lu[i, i]
+        return array
+
+
+class IncrementalRowReduction:
+    """Exact reduced row echelon form R = EA of a matrix A, kept up to date as rows are appended and columns are
+    appended or removed, instead of reducing A again
+    rows holds R: the pivot rows by increasing pivot column (pivot_columns), then the zero rows;
+    transform holds E, the row operations applied to A so far, so that an appended column c enters as Ec.
+    Appending a column or a row costs O(m^2 + mn), removing a pivot column O(mn); R is the rref of A
+    (the same as Matrix.rref up to the order of the zero rows) and null_space() the same basis."""
+
+    def __init__(self):
+        self.size = [0, 0]
+        self.rows = []
+        self.transform = []
+        self.pivot_columns = []
+
+    @classmethod
+    def from_matrix(cls, matrix: Matrix) -> 'IncrementalRowReduction':
+        """Reduction of an exact matrix in one Gauss-Jordan pass, the row operations being recorded on an identity"""
+        m, n = matrix.size
+        reduced = Matrix.from_nested_list([[fractions.Fraction(entry) for entry in row] for row in matrix.matrix]) \
+            if m else Matrix(0, n)
+        transform = Matrix(m, m, identity=True)
+        pivots = reduced.eliminate(juxtaposed=transform)
+        reduction = cls()
+        reduction.size = [m, n]
+        reduction.rows = reduced.matrix
+        reduction.transform = [[fractions.Fraction(entry) for entry in row] for row in transform.matrix]
+        reduction.pivot_columns = [col for _, col in pivots]
+        return reduction
+
+    def copy(self) -> 'IncrementalRowReduction':
+        """Independent copy, to update while keeping this one"""
+        reduction = IncrementalRowReduction()
+        reduction.size = list(self.size)
+        reduction.rows = [row.copy() for row in self.rows]
+        reduction.transform = [row.copy() for row in self.transform]
+        reduction.pivot_columns = list(self.pivot_columns)
+        return reduction
+
+    def eliminate_column(self, rank: int, col: int):
+        """Clear column col in every row but the pivot row rank (its entry being 1)"""
+        pivot_row, pivot_transform = self.rows[rank], self.transform[rank]
+        for r in range(self.size[0]):
+            factor = self.rows[r][col]
+            if r == rank or factor == 0:
+                continue
+            self.rows[r] = [entry - factor * pivot_entry for entry, pivot_entry in zip(self.rows[r], pivot_row)]
+            self.transform[r] = [
+                entry - factor * pivot_entry for entry, pivot_entry in zip(self.transform[r], pivot_transform)
+            ]
+
+    def place_pivot(self, row: int, col: int):
+        """Make row (reduced against the other pivot rows, col being its first non-zero entry) a pivot row"""
+        pivot = self.rows[row][col]
+        if pivot != 1:
+            self.rows[row] = [entry / pivot for entry in self.rows[row]]
+            self.transform[row] = [entry / pivot for entry in self.transform[row]]
+        position = sum(1 for pivot_column in self.pivot_columns if pivot_column < col)
+        for table in (self.rows, self.transform):
+            table.insert(position, table.pop(row))
+        self.pivot_columns.insert(position, col)
+        self.eliminate_column(position, col)
+
+    def append_row(self, entries: list):
+        """Add a row to A (one entry per column)"""
+        m, n = self.size
+        row = [fractions.Fraction(entry) for entry in entries]
+        transform = [fractions.Fraction(0)] * m + [fractions.Fraction(1)]
+        for other in self.transform:
+            other.append(fractions.Fraction(0))
+        for pivot_row, pivot_column in enumerate(self.pivot_columns):
+            factor = row[pivot_column]
+            if factor != 0:
+                row = [entry - factor * pivot_entry for entry, pivot_entry in zip(row, self.rows[pivot_row])]
+                transform = [entry - factor * pivot_entry
+                             for entry, pivot_entry in zip(transform, self.transform[pivot_row])]
+        self.rows.append(row)
+        self.transform.append(transform)
+        self.size[0] += 1
+        col = next((col for col in range(n) if row[col] != 0), None)
+        if col is not None:
+            self.place_pivot(m, col)
+
+    def append_column(self, entries: list):
+        """Add a column to A (one entry per row)"""
+        m, n = self.size
+        column = [sum((factor * entry for factor, entry in zip(transform, entries) if entry), fractions.Fraction(0))
+                  for transform in self.transform]
+        for row, entry in zip(self.rows, column):
+            row.append(entry)
+        self.size[1] += 1
+        rank = len(self.pivot_columns)
+        row = next((r for r in range(rank, m) if column[r] != 0), None)
+        if row is not None:
+            self.place_pivot(row, n)
+
+    def remove_column(self, col: int):
+        """Remove a column of A"""
+        for row in self.rows:
+            del row[col]
+        self.size[1] -= 1
+        if col not in self.pivot_columns:
+            self.pivot_columns = [pivot_column - (pivot_column > col) for pivot_column in self.pivot_columns]
+            return
+        # the pivot row of the column loses its pivot: its next non-zero entry (in a free column) takes over
+        row = self.pivot_columns.index(col)
+        del self.pivot_columns[row]
+        self.pivot_columns = [pivot_column - (pivot_column > col) for pivot_column in self.pivot_columns]
+        new_col = next((c for c in range(col, self.size[1]) if self.rows[row][c] != 0), None)
+        if new_col is None:  # now a zero row
+            for table in (self.rows, self.transform):
+                table.append(table.pop(row))
+        else:
+            self.place_pivot(row, new_col)
+
+    def free_columns(self) -> list:
+        """Columns without a pivot"""
+        pivot_columns = set(self.pivot_columns)
+        return [col for col in range(self.size[1]) if col not in pivot_columns]
+
+    def null_space(self) -> list:
+        """Basis of the null space of A, as Matrix.null_space: one vector per free column, that column being 1"""
+        kernel = []
+        for free_column in self.free_columns():
+            solution = [fractions.Fraction(0)] * self.size[1]
+            solution[free_column] = fractions.Fraction(1)
+            for pivot_row, pivot_column in enumerate(self.pivot_columns):
+                solution[pivot_column] = -self.rows[pivot_row][free_column]
+            kernel.append(Vector(solution))
+        return kernel
+
+
 class Vector:
-    """A (row) vector"""
+    """A (row) vector
+    Entries stay in a list at any size: converting them to a numpy array costs more than a single operation on it
+    saves (python benchmarks.py vector: dot product and addition are slower through numpy up to 65536 entries,
+    the norm at most 17% faster once the entries are checked to be floats)"""
     def __init__(self, vector: list, size=2):
         if vector:
             self.dimension = len(vector)
@@ -298,7 +764,7 @@ class Vector:
         if self.dimension != vector.dimension:
             raise ValueError("Dimension of vectors must agree")
         else:
-            return sum([self.vector[i] * vector.vector[i] for i in range(self.dimension)])
+            return sum([entry * other_entry for entry, other_entry in zip(self.vector, vector.vector)])
 
     def __eq__(self, other: 'Vector') -> bool:
         """Comparing vectors: two vectors are only equal if they have the same dimension
@@ -318,14 +784,14 @@ class Vector:
         if self.dimension != other.dimension:
             raise ValueError("Dimension of vectors must agree")
         else:
-            return Vector([self.vector[i] + other.vector[i] for i in range(self.dimension)])
+            return Vector([entry + other_entry for entry, other_entry in zip(self.vector, other.vector)])
 
     def __sub__(self, other: 'Vector') -> 'Vector':
         """Vector subtractions"""
         if self.dimension != other.dimension:
             raise ValueError("Dimension of vectors must agree")
         else:
-            return Vector([self.vector[i] - other.vector[i] for i in range(self.dimension)])
+            return Vector([entry - other_entry for entry, other_entry in zip(self.vector, other.vector)])
 
     def __mul__(self, other: float) -> 'Vector':
         """Scalar multiplication: vector * scalar"""
@@ -365,10 +831,16 @@ class Line2D:
         self.slope = -a / b if b != 0 else float("Inf")
         self.y_intercept = -c / b if b != 0 else float("Inf")
 
-        self.general_form = \
-            f"{a}x {('+ ' if b >=0 else '- ') + str(abs(b))}y {('+ ' if c >= 0 else '- ') + str(abs(c))} = 0"
-        self.slope_intercept_form = \
-            f"y = {self.slope}x {('+ ' if self.y_intercept >= 0 else '- ') + str(abs(self.y_intercept))}"
+    @property
+    def general_form(self) -> str:
+        """ax + by + c = 0, formatted when asked for"""
+        a, b, c = self.equation
+        return f"{a}x {('+ ' if b >=0 else '- ') + str(abs(b))}y {('+ ' if c >= 0 else '- ') + str(abs(c))} = 0"
+
+    @property
+    def slope_intercept_form(self) -> str:
+        """y = mx + p, formatted when asked for"""
+        return f"y = {self.slope}x {('+ ' if self.y_intercept >= 0 else '- ') + str(abs(self.y_intercept))}"
 
     @classmethod
     def from_slope_intercept(cls, slope: float, y_intercept: float) -> 'Line2D':
@@ -445,7 +917,7 @@ class Line2D:
         Return a float"""
         a, b, c = self.equation
         m, n = point
-        return fractions.Fraction(abs(a * m + b * n + c), math.sqrt(a ** 2 + b ** 2))
+        return abs(a * m + b * n + c) / math.sqrt(a ** 2 + b ** 2)
 
 
 class Segment2D:
@@ -502,20 +974,26 @@ class Quadratic2D:
         a = (y - k) / (x - h) ** 2
         return Quadratic2D.from_vertex_form(a, h, k)
 
+    @staticmethod
+    def vandermonde(x_coordinates: tuple) -> LUFactorization:
+        """Factorization of the system giving a, b and c from the y-coordinates at three x-coordinates"""
+        return Matrix.from_nested_list([[float(x) ** 2, float(x), 1.0] for x in x_coordinates]).lu()
+
     @classmethod
     def from_three_points(cls, p1: (float, float), p2: (float, float), p3: (float, float)) -> 'Quadratic2D':
         """Construct a quadratic curve from the coordinates of three points"""
-        constant = Matrix.from_nested_list([[p1[1]], [p2[1]], [p3[1]]])
-        coefficient = Matrix.from_nested_list([
-            [p1[0] ** 2, p1[0], 1],
-            [p2[0] ** 2, p2[0], 1],
-            [p3[0] ** 2, p3[0], 1]
-        ])
-        coefficient.rref(juxtaposed=constant)
-        a, b, c = [constant_list[0] for constant_list in constant.matrix]
-
+        a, b, c = cls.vandermonde((p1[0], p2[0], p3[0])).solve([p1[1], p2[1], p3[1]])
         return Quadratic2D(a, b, c)
 
+    @classmethod
+    def fit_shared_x(cls, x_coordinates: tuple, y_triples: list) -> list:
+        """Construct one quadratic curve through each triple of y-coordinates, all taken at the same three
+        x-coordinates: the system is factored once and solved for every triple at the same time"""
+        if not y_triples:
+            return []
+        a_list, b_list, c_list = cls.vandermonde(x_coordinates).solve_many([list(y) for y in zip(*y_triples)])
+        return [Quadratic2D(a, b, c) for a, b, c in zip(a_list, b_list, c_list)]
+
     def calculate_vertex(self) -> (float, float):
         """Calculate the coordinates of the vertex"""
         a, b, c = self.equation
@@ -561,7 +1039,258 @@ class Quadratic2D:
         return f"{a}(x - {p})(x - {q})"  # TODO match with sign
 
 
+def require_numpy(name: str):
+    """Raise ImportError if numpy, needed by the array classes, is not installed"""
+    if numpy is None:
+        raise ImportError(f"{name} needs numpy")
+
+
+class Line2DArray:
+    """Many lines a[i]x + b[i]y + c[i] = 0 held in numpy arrays, for batched geometry
+    Operations broadcast like numpy: lines with lines of the same shape, or lines with arrays of points"""
+    def __init__(self, a, b, c):
+        require_numpy('Line2DArray')
+        self.a, self.b, self.c = numpy.broadcast_arrays(*[numpy.asarray(array, dtype=float) for array in (a, b, c)])
+
+    @classmethod
+    def from_slope_intercept(cls, slopes, y_intercepts) -> 'Line2DArray':
+        """Lines y = slope * x + y_intercept"""
+        slopes = numpy.asarray(slopes, dtype=float)
+        return cls(slopes, -numpy.ones_like(slopes), y_intercepts)
+
+    @classmethod
+    def from2points(cls, x1, y1, x2, y2) -> 'Line2DArray':
+        """Lines through the points (x1, y1) and (x2, y2) (vertical lines are allowed)"""
+        x1, y1, x2, y2 = [numpy.asarray(array, dtype=float) for array in (x1, y1, x2, y2)]
+        return cls(y2 - y1, x1 - x2, x2 * y1 - x1 * y2)
+
+    @classmethod
+    def from_lines(cls, lines: list) -> 'Line2DArray':
+        """Pack Line2D objects"""
+        return cls(*zip(*[line.equation for line in lines])) if lines else cls([], [], [])
+
+    def __len__(self) -> int:
+        return len(self.a)
+
+    def __getitem__(self, index) -> Line2D:
+        return Line2D(float(self.a[index]), float(self.b[index]), float(self.c[index]))
+
+    @property
+    def slope(self):
+        """Slopes (inf for vertical lines, as in Line2D)"""
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(self.b != 0, -self.a / self.b, numpy.inf)
+
+    @property
+    def y_intercept(self):
+        """y-intercepts (inf for vertical lines, as in Line2D)"""
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(self.b != 0, -self.c / self.b, numpy.inf)
+
+    def y_calculate(self, x):
+        """y of each line at x (broadcast)"""
+        return self.slope * x + self.y_intercept
+
+    def x_calculate(self, y):
+        """x of each line at y (broadcast)"""
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (y - self.y_intercept) / self.slope
+
+    def intersect(self, lines: 'Line2DArray') -> tuple:
+        """Intersections of line i of this array with line i of the other (broadcast)
+        Return the arrays of x and y, inf where lines are parallel"""
+        determinant = self.a * lines.b - lines.a * self.b
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x = numpy.where(determinant != 0, (self.b * lines.c - lines.b * self.c) / determinant, numpy.inf)
+            y = numpy.where(determinant != 0, (self.c * lines.a - lines.c * self.a) / determinant, numpy.inf)
+        return x, y
+
+    def intersect_pairwise(self) -> tuple:
+        """Intersections of every pair of lines: x[i, j] and y[i, j] for lines i and j (inf if parallel)"""
+        column = Line2DArray(self.a[:, None], self.b[:, None], self.c[:, None])
+        return column.intersect(Line2DArray(self.a[None, :], self.b[None, :], self.c[None, :]))
+
+    def distance_to_points(self, x, y):
+        """Distance from line i to point (x[i], y[i]) (broadcast: x[:, None] and y[:, None] give the distance
+        from every line to every point, indexed [point, line])"""
+        return numpy.abs(self.a * x + self.b * y + self.c) / numpy.hypot(self.a, self.b)
+
+    def general_forms(self) -> list:
+        """Strings of the lines, formatted only when asked for"""
+        return [self[i].general_form for i in range(len(self))]
+
+
+class Segment2DArray:
+    """Many segments from (x1[i], y1[i]) to (x2[i], y2[i]) held in numpy arrays"""
+    def __init__(self, x1, y1, x2, y2):
+        require_numpy('Segment2DArray')
+        self.x1, self.y1, self.x2, self.y2 = numpy.broadcast_arrays(
+            *[numpy.asarray(array, dtype=float) for array in (x1, y1, x2, y2)]
+        )
+
+    def __len__(self) -> int:
+        return len(self.x1)
+
+    def midpoint(self) -> tuple:
+        """Arrays of the x and y of the midpoints"""
+        return (self.x1 + self.x2) / 2, (self.y1 + self.y2) / 2
+
+    def length(self):
+        """Lengths of the segments"""
+        return numpy.hypot(self.x2 - self.x1, self.y2 - self.y1)
+
+    def lines(self) -> Line2DArray:
+        """Lines carrying the segments"""
+        return Line2DArray.from2points(self.x1, self.y1, self.x2, self.y2)
+
+
+class Quadratic2DArray:
+    """Many quadratic curves y = a[i]x ** 2 + b[i]x + c[i] held in numpy arrays
+    Operations broadcast like numpy: y_calculate(x[:, None]) evaluates every curve at every x, indexed [x, curve]"""
+    def __init__(self, a, b, c):
+        require_numpy('Quadratic2DArray')
+        self.a, self.b, self.c = numpy.broadcast_arrays(*[numpy.asarray(array, dtype=float) for array in (a, b, c)])
+        assert numpy.all(self.a != 0), "not a quadratic curve!"
+
+    @classmethod
+    def from_three_points(cls, x, y) -> 'Quadratic2DArray':
+        """Curves through three points each: x and y are k x 3 arrays (row i holds the points of curve i)"""
+        x, y = numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float)
+        systems = numpy.stack([x ** 2, x, numpy.ones_like(x)], axis=-1)
+        a, b, c = numpy.linalg.solve(systems, y[..., None])[..., 0].T
+        return cls(a, b, c)
+
+    @classmethod
+    def fit_shared_x(cls, x_coordinates: tuple, y) -> 'Quadratic2DArray':
+        """Curves through y[i] (k x 3) at the same three x-coordinates, with one factorization (see Quadratic2D)"""
+        a, b, c = Quadratic2D.vandermonde(x_coordinates).solve_many(numpy.asarray(y, dtype=float).T)
+        return cls(a, b, c)
+
+    @classmethod
+    def from_curves(cls, curves: list) -> 'Quadratic2DArray':
+        """Pack Quadratic2D objects"""
+        return cls(*zip(*[curve.equation for curve in curves]))
+
+    def __len__(self) -> int:
+        return len(self.a)
+
+    def __getitem__(self, index) -> Quadratic2D:
+        return Quadratic2D(float(self.a[index]), float(self.b[index]), float(self.c[index]))
+
+    @property
+    def discriminant(self):
+        """b ** 2 - 4ac of each curve"""
+        return self.b ** 2 - 4 * self.a * self.c
+
+    def y_calculate(self, x):
+        """y of each curve at x (broadcast), by Horner's scheme"""
+        return (self.a * x + self.b) * x + self.c
+
+    def calculate_vertex(self) -> tuple:
+        """Arrays of the x and y of the vertices"""
+        return -self.b / (2 * self.a), -self.discriminant / (4 * self.a)
+
+    def calculate_root(self) -> tuple:
+        """Arrays of the two roots, in the order of Quadratic2D.calculate_root (nan where the roots are complex)"""
+        with numpy.errstate(invalid='ignore'):
+            square_root = numpy.sqrt(self.discriminant)
+        return (-self.b - square_root) / (2 * self.a), (-self.b + square_root) / (2 * self.a)
+
+    def calculate_y_intercept(self):
+        """y-intercepts (x = 0) of the curves"""
+        return self.c
+
+
+def debug():
+    """Test the functionality of functions"""
+    prime = MODULAR_PRIMES[0]
+    composition = Matrix.from_nested_list([[1, 0, -1, 0], [4, 0, 0, -2], [0, 2, -2, -1]])  # CH4 + O2 -> CO2 + H2O
+    dense = Matrix.from_nested_list([
+        [(3 * i + 7 * j) % 11 - 5 for j in range(9)] for i in range(6)
+    ] + [[sum((3 * i + 7 * j) % 11 - 5 for i in range(6)) for j in range(9)]])  # rank 6, last row the sum
+    system = [[2, 1, 1], [4, -6, 0], [-2, 7, 2]]  # x = (1, 1, 2) for b = (5, -2, 9), determinant -16
+    right_hand_sides = [[math.sin(i + 3 * j) for j in range(100)] for i in range(3)]
+    y_triples = [(math.sin(j), math.cos(j), 1 + j % 3) for j in range(50)]
+    # the first and last lines are parallel
+    lines = [Line2D.from_slope_intercept(*line) for line in [(0.5, 1), (-2, 4), (3, -2), (0.5, -3)]]
+    points = [(0, 0), (1.5, -2), (-3, 4)]
+    extremities = [((0, 0), (3, 4)), ((1, -1), (-2, 3)), ((2, 2), (2, 7))]
+    curves = [Quadratic2D(1, -3, 2), Quadratic2D(-2, 1, 6), Quadratic2D(0.5, 0, -8)]
+
+    def rank_after_write(matrix: Matrix, i: int, j: int, value) -> int:
+        """Rank of the matrix once its row reduction is cached and an entry is then written directly"""
+        matrix.rank()
+        matrix.matrix[i][j] = value
+        return matrix.rank()
+
+    valid = [
+        # ---Debugging 1 - rational reconstruction of -3/7 from its residue
+        fractions.Fraction(-3, 7) == rational_reconstruction(-3 * pow(7, prime - 2, prime) % prime, prime),
+        # ---Debugging 2 - modular null space: the one of fraction elimination
+        [vector.vector for vector in composition.null_space_modular()] == [
+            vector.vector for vector in composition.__copy__().null_space()
+        ],
+        # ---Debugging 3 - modular null space of a rank deficient matrix: the exact one
+        [vector.vector for vector in dense.null_space_modular()] == [
+            vector.vector for vector in Matrix.from_nested_list(
+                [[fractions.Fraction(entry) for entry in row] for row in dense.matrix]
+            ).null_space()
+        ],
+        # ---Debugging 4 - integer elimination is exact: fractions only, as many vectors as free columns
+        [vector.vector for vector in dense.__copy__().null_space()] == [
+            vector.vector for vector in dense.null_space_modular()
+        ] and all(type(entry) is fractions.Fraction for vector in dense.null_space() for entry in vector.vector),
+        # ---Debugging 5 - the cached row reduction is dropped when an entry is written directly
+        rank_after_write(Matrix.from_nested_list([[1, 2], [2, 4]]), 1, 1, 5) == 2,
+        # ---Debugging 6 - exact LU factorization: solution and determinant (that of the permutation expansion)
+        Matrix.from_nested_list(system).lu().solve([5, -2, 9]) == [1, 1, 2] and
+        Matrix.from_nested_list(system).lu().det() == Matrix.from_nested_list(system).det() == -16,
+        # ---Debugging 7 - many float right-hand sides at once (numpy): the solutions of one at a time
+        all(abs(x - y) < 1e-9 for column, solution in zip(
+            zip(*right_hand_sides), zip(*Matrix.from_nested_list(system).lu().solve_many(right_hand_sides))
+        ) for x, y in zip(Matrix.from_nested_list(system).lu().solve(list(column)), solution)),
+        # ---Debugging 8 - quadratics sharing their x-coordinates: the curves fitted one by one
+        all(abs(p - q) < 1e-9 for curve, (y1, y2, y3) in zip(
+            Quadratic2D.fit_shared_x((-1, 0.5, 2), y_triples), y_triples
+        ) for p, q in zip(curve.equation, Quadratic2D.from_three_points((-1, y1), (0.5, y2), (2, y3)).equation)),
+        # ---Debugging 9 - batched intersections of every pair of lines: those of Line2D (inf if parallel)
+        numpy is None or numpy.allclose(
+            [[line.intersect(other) for other in lines] for line in lines],
+            numpy.dstack(Line2DArray.from_lines(lines).intersect_pairwise())
+        ),
+        # ---Debugging 10 - batched distances to points and y: those of Line2D
+        numpy is None or numpy.allclose(
+            [[line.distance_to_point(point) for line in lines] for point in points],
+            Line2DArray.from_lines(lines).distance_to_points(*[numpy.array(axis)[:, None] for axis in zip(*points)])
+        ) and numpy.allclose(
+            [[line.y_calculate(x) for line in lines] for x, _ in points],
+            Line2DArray.from_lines(lines).y_calculate(numpy.array([x for x, _ in points])[:, None])
+        ),
+        # ---Debugging 11 - batched segments: midpoints of Segment2D, lengths, lines through both extremities
+        numpy is None or numpy.allclose(
+            [Segment2D(*pair).midpoint() for pair in extremities],
+            numpy.transpose(Segment2DArray(*zip(*[start + end for start, end in extremities])).midpoint())
+        ) and numpy.allclose(Segment2DArray(*zip(*[start + end for start, end in extremities])).length(), 5) and
+        numpy.allclose(Segment2DArray(*zip(*[start + end for start, end in extremities])).lines().distance_to_points(
+            *zip(*[end for _, end in extremities])
+        ), 0),
+        # ---Debugging 12 - batched quadratics: vertices, roots and y of Quadratic2D
+        numpy is None or numpy.allclose(
+            [curve.calculate_vertex() + curve.calculate_root() for curve in curves],
+            numpy.transpose(Quadratic2DArray.from_curves(curves).calculate_vertex() +
+                            Quadratic2DArray.from_curves(curves).calculate_root())
+        ) and numpy.allclose(
+            [[(a * x + b) * x + c for a, b, c in [curve.equation for curve in curves]] for x in (-1, 0, 2.5)],
+            Quadratic2DArray.from_curves(curves).y_calculate(numpy.array([-1, 0, 2.5])[:, None])
+        ),
+    ]
+    invalid = [index + 1 for index, func in enumerate(valid) if not func]
+    if any(invalid):
+        print(f"Warning: Bug detected.\nContact developers (via github): reference code {invalid}\n")
+
+
 if __name__ == "__main__":
+    debug()
     # > Humbert
     print("Zis you ask Humbert")
     v = Vector([47, 140])
@@ -0,0 +1,214 @@
+# coding=utf-8
+"""Reaction mechanism ingestion and bulk balancing
+A mechanism file contains either
+    - plain equations, one per line, as accepted by Equation.from_string ('CH4 + O2 -> CO2 + H2O')
+    - a CHEMKIN-like block: REACTIONS ... END, with lines such as 'H + O2 <=> O + OH  3.5E15 -0.4 0.0'
+Species are parsed once into a shared index, and reactions are balanced and checked as they are read
+Usage: python mechanism.py <file> [--profile DIR]"""
+import argparse
+import collections
+import re
+import sys
+from CHEMaths import Molecule, Equation
+from linear_algebra import Matrix
+from profiling import Profile
+
+ReactionResult = collections.namedtuple(
+    'ReactionResult', ['index', 'text', 'reactants', 'products', 'stated', 'coefficients', 'conserved', 'error']
+)
+ReactionResult.__doc__ = """Outcome for one reaction of a mechanism
+    stated: coefficients written in the file (None if there are none)
+    coefficients: smallest integer coefficients balancing the reaction (None if it cannot be balanced)
+    conserved: whether the stated coefficients conserve atoms and charge (None without stated coefficients)"""
+
+THIRD_BODY = re.compile(r"\(\+\s*[A-Za-z0-9]*\)")  # pressure dependent '(+M)' or '(+AR)'
+ARROW = re.compile(r"<=>|=>|=")
+STOICHIOMETRIC_PREFIX = re.compile(r"^(\d+(?:\.\d*)?)\s*(?=[A-Za-z(])")
+NOBLE_GASES = {'AR': 'Ar', 'HE': 'He', 'NE': 'Ne', 'KR': 'Kr', 'XE': 'Xe'}  # CHEMKIN writes elements in capitals
+
+
+def normalize_species_name(name: str) -> str:
+    """Strip CHEMKIN isomer and state tags to get a formula Molecule.from_string can read
+    Ex: 'CH2(S)' -> 'CH2', 'C3H5-A' -> 'C3H5', 'N-C3H7' -> 'C3H7', 'AR' -> 'Ar'"""
+    formula = re.sub(r"\([SLG]\)$", '', name)
+    formula = re.sub(r"^(?:[NISTnist]|SEC|TERT)-(?=[A-Z])", '', formula)
+    formula = re.sub(r"(?<=[A-Za-z0-9)])-[A-Za-z0-9]+$", '', formula)
+    return NOBLE_GASES.get(formula, formula)
+
+
+def split_chemkin_side(side: str) -> list:
+    """Split one side of a CHEMKIN reaction into (coefficient, species) pairs, dropping third bodies"""
+    terms = []
+    for term in side.split('+'):
+        term = term.strip()
+        if not term or term == 'M':
+            continue
+        prefix = STOICHIOMETRIC_PREFIX.match(term)
+        if prefix:
+            coefficient = float(prefix.group(1))
+            terms.append((int(coefficient) if coefficient.is_integer() else coefficient, term[prefix.end():].strip()))
+        else:
+            terms.append((1, term))
+    return terms
+
+
+def parse_chemkin_reaction(line: str):
+    """Parse a reaction line of a REACTIONS block; return None for auxiliary lines (LOW/, TROE/, DUPLICATE...)
+    The Arrhenius parameters (last three numbers) are ignored"""
+    if '/' in line or line.upper().startswith('DUP'):
+        return None
+    tokens = line.split()
+    while len(tokens) > 1 and re.match(r"^[-+]?(\d+\.?\d*|\.\d+)([eEdD][-+]?\d+)?$", tokens[-1]):
+        tokens.pop()
+    equation = THIRD_BODY.sub('', ' '.join(tokens))
+    sides = ARROW.split(equation)
+    if len(sides) != 2:
+        raise SyntaxError(f"'{line}': reaction arrow is misplaced or missing")
+    return split_chemkin_side(sides[0]), split_chemkin_side(sides[1])
+
+
+def parse_plain_reaction(line: str):
+    """Parse an equation written as for Equation.from_string, without coefficients"""
+    sides = line.split('->')
+    if len(sides) != 2:
+        raise SyntaxError(f"'{line}': '->' is misplaced")
+    return tuple([(None, species.strip()) for species in side.split(' + ') if species.strip()] for side in sides)
+
+
+def read_reactions(lines):
+    """Yield (text, reactants, products) for every reaction in the lines of a mechanism file
+    reactants and products are lists of (coefficient, species name), coefficient being None for plain equations"""
+    in_block = None  # None: format unknown yet, True / False: inside / outside a REACTIONS block
+    for raw_line in lines:
+        line = raw_line.split('!')[0].strip()
+        if not line:
+            continue
+        keyword = line.split()[0].upper()
+        if keyword.startswith('REAC'):
+            in_block = True
+            continue
+        if keyword == 'END':
+            in_block = False
+            continue
+        if in_block is None and '->' in line:
+            yield (line,) + parse_plain_reaction(line)
+        elif in_block:
+            reaction = parse_chemkin_reaction(line)
+            if reaction:
+                yield (line,) + reaction
+
+
+class Mechanism:
+    """A set of reactions sharing one species index
+    stoichiometry[j] maps species index -> net coefficient of reaction j (products positive, reactants negative)"""
+
+    def __init__(self):
+        self.species = []
+        self.species_index = {}
+        self.compositions = []  # parsed molecular formula of each species, None if it could not be parsed
+        self.stoichiometry = []
+        self.balance_cache = {}  # (reactant indices, product indices) -> coefficients or exception
+
+    def add_species(self, name: str) -> int:
+        """Return the index of a species, parsing it the first time it is seen"""
+        if name not in self.species_index:
+            try:
+                composition = Molecule.from_string(normalize_species_name(name)).molecular_formula
+            except (TypeError, KeyError, IndexError, ValueError):
+                composition = None
+            self.species_index[name] = len(self.species)
+            self.species.append(name)
+            self.compositions.append(composition or None)
+        return self.species_index[name]
+
+    def balance_reaction(self, reactant_indices: tuple, product_indices: tuple) -> list:
+        """Smallest integer coefficients for a reaction between indexed species, computed once per reaction"""
+        key = (reactant_indices, product_indices)
+        if key not in self.balance_cache:
+            try:
+                self.balance_cache[key] = Equation(
+                    [self.compositions[index] for index in reactant_indices],
+                    [self.compositions[index] for index in product_indices]
+                ).coefficients
+            except (ArithmeticError, ValueError, AssertionError) as error:
+                self.balance_cache[key] = error
+        result = self.balance_cache[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def is_conserved(self, reactant_indices: tuple, product_indices: tuple, stated: list) -> bool:
+        """Check that the stated coefficients conserve every element and the charge"""
+        net = collections.Counter()
+        for position, (index, coefficient) in enumerate(zip(reactant_indices + product_indices, stated)):
+            sign = 1 if position < len(reactant_indices) else -1
+            for element, quantity in self.compositions[index].items():
+                net[element] += coefficient * quantity * sign
+        return all(abs(total) < 1e-9 for total in net.values())
+
+    def load(self, lines):
+        """Read reactions from the lines of a mechanism file, yielding a ReactionResult as each one is processed"""
+        for text, reactants, products in read_reactions(lines):
+            index = len(self.stoichiometry)
+            reactant_indices = tuple(self.add_species(name) for _, name in reactants)
+            product_indices = tuple(self.add_species(name) for _, name in products)
+            stated = [coefficient for coefficient, _ in reactants + products]
+            stated = None if None in stated else stated
+            names = ([name for _, name in reactants], [name for _, name in products])
+
+            unknown = [self.species[i] for i in reactant_indices + product_indices if self.compositions[i] is None]
+            coefficients, conserved, error = None, None, None
+            if unknown:
+                error = f"unknown species: {', '.join(sorted(set(unknown)))}"
+            else:
+                try:
+                    coefficients = self.balance_reaction(reactant_indices, product_indices)
+                except ArithmeticError:
+                    error = "not one single reaction"
+                except (ValueError, AssertionError):
+                    error = "equation not feasible"
+                if stated:
+                    conserved = self.is_conserved(reactant_indices, product_indices, stated)
+                    if conserved and error:  # e.g. several independent balances: the stated one is still valid
+                        coefficients, error = stated, None
+
+            net = collections.defaultdict(int)
+            used = stated or coefficients or [0] * len(reactant_indices + product_indices)
+            for position, species_index in enumerate(reactant_indices + product_indices):
+                net[species_index] += used[position] * (-1 if position < len(reactant_indices) else 1)
+            self.stoichiometry.append(dict(net))
+            yield ReactionResult(index, text, names[0], names[1], stated, coefficients, conserved, error)
+
+    def stoichiometric_matrix(self) -> Matrix:
+        """Dense species x reactions stoichiometric matrix (use `stoichiometry` for large mechanisms)"""
+        matrix = Matrix(len(self.species), len(self.stoichiometry))
+        for reaction_index, column in enumerate(self.stoichiometry):
+            for species_index, coefficient in column.items():
+                matrix.assign_new_value(species_index, reaction_index, coefficient)
+        return matrix
+
+
+def format_result(result: ReactionResult) -> str:
+    """One line summary of a ReactionResult"""
+    if result.error:
+        status = f"ERROR {result.error}"
+    elif result.conserved is False:
+        status = f"UNBALANCED (balanced: {result.coefficients})"
+    else:
+        status = f"OK {result.coefficients}"
+    return f"{result.index + 1}: {result.text}  =>  {status}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Balance and check every reaction of a mechanism file")
+    parser.add_argument('mechanism', help="plain equations or a CHEMKIN-like REACTIONS block")
+    parser.add_argument('--profile', metavar='DIR', help="write cProfile stats and collapsed stacks of the batch")
+    arguments = parser.parse_args()
+    mechanism = Mechanism()
+    errors = 0
+    with Profile(arguments.profile, label="mechanism"), open(arguments.mechanism) as mechanism_file:
+        for reaction_result in mechanism.load(mechanism_file):
+            errors += bool(reaction_result.error or reaction_result.conserved is False)
+            print(format_result(reaction_result), flush=True)
+    print(f"{len(mechanism.stoichiometry)} reactions, {len(mechanism.species)} species, {errors} problem(s)",
+          file=sys.stderr)
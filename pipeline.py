@@ -0,0 +1,430 @@
+# coding=utf-8
+"""Staged analysis of a latex input, shared by CHEMaths_website and the command line
+    normalize -> detect mode -> tokenize -> parse -> validate -> analyze -> serialize
+Each stage takes the result of the previous one, so nothing is parsed, built or balanced twice.
+A stage raises PipelineError with the message shown to the user when the input is invalid.
+The interactive shell of CHEMaths.py runs the same stages on plain text input (see launch_shell).
+Usage: python pipeline.py '<latex>' ... (or one latex string per line on stdin)"""
+import collections
+import json
+import re
+import sys
+import time
+import CHEMaths
+from profiling import Profile
+from simpleeval import simple_eval
+from latex_parser import check_elements, check_molecule_syntax, determine_mode, eval_latex, latex2chem, \
+    split_repeat_unit
+
+WELCOME_MESSAGE = "Welcome! Type some chemistry or click on the red buttons :)"
+
+Tokens = collections.namedtuple('Tokens', ['mode', 'latex', 'reactants', 'products', 'arguments'])
+Tokens.__doc__ = """Latex split into species (reactants / products, a molecule being a single reactant,
+    a polymer its repeat unit followed by its end groups)
+    arguments: organic (functional group, size), empirical [(chemical, weight latex)] pairs or polymer count"""
+Parsed = collections.namedtuple('Parsed', ['tokens', 'reactants', 'products', 'arguments'])
+Parsed.__doc__ = """Parsed molecular formulas of the species
+    arguments: organic (functional group, size), empirical {chemical: positive weight} or polymer count"""
+Analysis = collections.namedtuple('Analysis', ['parsed', 'result', 'record'])
+Analysis.__doc__ = """result: Molecule, Equation, FunctionalGroup or Polymer built from the parsed input
+        (None in 'this' mode, or when the record was found in a result store)
+    record: computed values of a molecule or an equation (see molecule_record and equation_record)"""
+
+# reductions of the composition matrices of recent equations: typing a species onto an equation updates the
+# reduction of the previous keystroke instead of balancing it from scratch
+REDUCTIONS = CHEMaths.ReductionCache()
+
+ORGANIC_GROUPS = {
+    'alcohol': CHEMaths.StraightChainPrimaryAlcohol,
+    'alkane': CHEMaths.StraightChainAlkane
+}
+ORGANIC_MAX_SIZE = 1000  # carbons: refused beyond (about 17 s for alkane::1000, mostly counting the isomers)
+
+
+class PipelineError(Exception):
+    """Invalid input; the message is meant for the user"""
+
+
+def normalize(raw_latex: str) -> str:
+    """Remove the spacing and sizing commands MathQuill adds"""
+    return raw_latex.replace("\\ ", '').replace(" ", '').replace("\\left(", '(').replace(r"\right)", ')')
+
+
+def detect_mode(latex: str) -> str:
+    """Determine which functionality should handle the latex (see latex_parser.determine_mode)"""
+    return determine_mode(latex)
+
+
+def tokenize(latex: str, mode: str) -> Tokens:
+    """Split the latex into the species (and arguments) the mode works on"""
+    reactants, products, arguments = [], [], None
+    if mode == "molecule":
+        reactants = [latex]
+    elif mode == "equation":
+        try:
+            reactants_string, products_string = latex.split('\\rightarrow')
+        except ValueError:  # not enough values to unpack
+            raise PipelineError("Invalid syntax: '->' (\\rightarrow) is misplaced or missing")
+        if not reactants_string:
+            raise PipelineError("No reactant found")
+        if not products_string:
+            raise PipelineError("No product found")
+        reactants = re.split(r"(?<!{\d)(?<!\^)\+", reactants_string)
+        products = re.split(r"(?<!{\d)(?<!\^)\+", products_string)
+    elif mode == "empirical":
+        arguments = []
+        for pair in re.split(r"[,;]", latex):
+            if not pair:
+                continue
+            if pair.count(':') != 1:
+                raise PipelineError(f"'{pair}': expected 'element: mass or percentage', pairs separated by ','")
+            chemical, weight_latex = pair.split(':')
+            if not chemical:
+                raise PipelineError(f"'{chemical}': missing element")
+            arguments.append((chemical, weight_latex))
+        if not arguments:
+            raise PipelineError("No element found")
+        reactants = [chemical for chemical, _ in arguments]
+    elif mode == "organic":
+        if len(latex.split("::")) != 2:
+            raise PipelineError("Syntax error: separator '::' not found or too many found")
+        arguments = tuple(latex.split("::"))  # TODO support eval, perhaps?
+    elif mode == "polymer":
+        head, unit, arguments, tail = split_repeat_unit(latex)
+        if not unit:
+            raise PipelineError("The repeat unit is empty")
+        reactants = [unit] + [end_group for end_group in (head, tail) if end_group]
+    return Tokens(mode, latex, reactants, products, arguments)
+
+
+def parse_molecule(latex: str) -> dict:
+    """Check the syntax of a single species and parse it"""
+    error = check_molecule_syntax(latex)
+    if error:
+        raise PipelineError(error)
+    return latex2chem(latex)
+
+
+def parse_plain_molecule(string: str) -> dict:
+    """Parse a species typed without latex, such as CH3COOH (see shell_tokens)"""
+    return CHEMaths.Molecule.from_string(string).molecular_formula
+
+
+def parse(tokens: Tokens, parse_species=parse_molecule) -> Parsed:
+    """Parse every species of the tokens into molecular formulas (latex unless another parse_species is given)"""
+    parsed_species = []
+    for molecule in tokens.reactants + tokens.products:
+        try:
+            parsed_species.append(parse_species(molecule))
+        except PipelineError as error:
+            raise PipelineError(f"'{molecule}': {error}" if tokens.mode != "molecule" else str(error))
+    reactants, products = parsed_species[:len(tokens.reactants)], parsed_species[len(tokens.reactants):]
+
+    arguments = tokens.arguments
+    if tokens.mode == "empirical":
+        arguments = {}
+        for chemical, weight_latex in tokens.arguments:
+            try:
+                arguments[chemical] = eval_latex(weight_latex)
+            except Exception:  # simple_eval may raise almost anything on invalid input
+                raise PipelineError(f"'{weight_latex}': invalid mass or percentage")
+            if arguments[chemical] <= 0:
+                raise PipelineError(f"'{weight_latex}': mass or percentage should be positive")
+    elif tokens.mode == "organic":
+        organic_mode, size = tokens.arguments
+        if not re.findall(r"^[1-9]\d*$", size):
+            raise PipelineError(f"{size}: Size should contain integer only")
+        arguments = (organic_mode, int(size))
+    return Parsed(tokens, reactants, products, arguments)
+
+
+def validate(parsed: Parsed) -> Parsed:
+    """Check that the parsed input makes sense chemically"""
+    for latex, molecule in zip(parsed.tokens.reactants + parsed.tokens.products, parsed.reactants + parsed.products):
+        error = check_elements(molecule)
+        if error:
+            raise PipelineError(f"'{latex}': {error}" if parsed.tokens.mode != "molecule" else error)
+    if parsed.tokens.mode == "organic":
+        organic_mode, size = parsed.arguments
+        if organic_mode not in ORGANIC_GROUPS:
+            raise PipelineError(f"{organic_mode}: unsupported functional group (not matched by 'alcohol' or 'alkane')")
+        if size > ORGANIC_MAX_SIZE:
+            raise PipelineError(f"{size}: Size should be at most {ORGANIC_MAX_SIZE}")
+    return parsed
+
+
+def molecule_record(molecule: CHEMaths.Molecule) -> dict:
+    """Values shown for a molecule"""
+    oxidation = molecule.calculate_oxidation()
+    return {
+        'mr': molecule.mr,
+        'element_percentages': molecule.calculate_percentages(),
+        'oxidation': {element: str(oxidation_number) for element, oxidation_number in oxidation.items()}
+    }
+
+
+def equation_record(reactants: list, products: list, raw_reactants=None, raw_products=None) -> tuple:
+    """Values shown for an equation (or the reason it cannot be balanced) and the balanced Equation (or None)"""
+    try:
+        equation = CHEMaths.Equation(
+            reactants, products, raw_reactants=raw_reactants, raw_products=raw_products,
+            reduction=REDUCTIONS.get(reactants, products)
+        )
+    except ArithmeticError:
+        return {'error': "Arithmetic Error: this is not one single equation"}, None
+    except (ValueError, AssertionError):
+        return {'error': "Value Error: equation not feasible"}, None
+    return {
+        'reaction_type': equation.get_reaction_type(),
+        'coefficients': equation.coefficients,
+        'mr': equation.calculate_relative_formula_masses()
+    }, equation
+
+
+def reaction(reactants: list, products: list, raw_reactants=None, raw_products=None, store=None) -> tuple:
+    """Record of an equation, from the store if it holds one, and the Equation if it was balanced (see equation_record)
+    store: optional result_store.ResultStore"""
+    record = store.get_reaction(reactants, products) if store is not None else None
+    if record is not None:
+        return record, None
+    record, equation = equation_record(reactants, products, raw_reactants, raw_products)
+    if store is not None:
+        store.put_reaction(reactants, products, record)
+    return record, equation
+
+
+def molecule_mr(latex: str) -> float:
+    """Relative formula mass of the latex of a molecule, from the parsed stage (nothing is scheduled or built)"""
+    latex = normalize(latex)
+    if detect_mode(latex) != "molecule":
+        raise PipelineError(f"'{latex}' is not a molecule")
+    parsed = validate(parse(tokenize(latex, "molecule")))
+    return CHEMaths.calculate_formula_mass(parsed.reactants[0])
+
+
+def equation_amounts(record: dict, masses: list, moles: list) -> dict:
+    """Masses and moles of every species of a balanced equation record for the masses and moles given (None if not):
+    the species running out first sets the extent of reaction (see Equation.calculate_extent_from_moles)"""
+    if 'error' in record:
+        raise PipelineError(record['error'])
+    coefficients, formula_masses = record['coefficients'], record['mr']
+    assert len(masses) == len(moles) == len(coefficients), "Size of input does not agree with equation"
+    extent = min([
+        amount / coefficient
+        for mass, mole, coefficient, mr in zip(masses, moles, coefficients, formula_masses)
+        for amount in (mass / mr if mass else None, mole) if amount
+    ], default=float("Inf"))
+    reaction_moles = [extent * coefficient for coefficient in coefficients]
+    return {
+        'reaction_masses': [mole * mr if mole else None for mole, mr in zip(reaction_moles, formula_masses)],
+        'reaction_moles': reaction_moles
+    }
+
+
+def polymer_record(polymer: CHEMaths.Polymer) -> dict:
+    """Values shown for a polymer; percentages and empirical formula are those of a long chain if the count is a name"""
+    empirical_formula = polymer.calculate_empirical_formula()
+    return {
+        'count': str(polymer.count),
+        'repeat-unit': polymer.latex_repeat_unit,
+        'mr-per-unit': polymer.unit_mr,
+        'mr': polymer.get_mr_latex(),
+        'element_percentages': polymer.calculate_percentages(),
+        'empirical-formula': ''.join(f'{i}_{{{j}}}' if j != 1 else i for i, j in empirical_formula.items())
+    }
+
+
+def analyze(parsed: Parsed, store=None) -> Analysis:
+    """Build the Molecule, Equation, FunctionalGroup or Polymer once (an equation is balanced here)
+    store: optional result_store.ResultStore; on a hit, the record is used and no Molecule / Equation is built"""
+    mode = parsed.tokens.mode
+    result, record = None, None
+    if mode == "molecule":
+        record = store.get_molecule(parsed.reactants[0]) if store is not None else None
+        if record is None:
+            result = CHEMaths.Molecule(parsed.reactants[0], raw_string=parsed.tokens.latex)
+            record = molecule_record(result)
+            if store is not None:
+                store.put_molecule(parsed.reactants[0], record)
+    elif mode == "equation":
+        record, result = reaction(
+            parsed.reactants, parsed.products, parsed.tokens.reactants, parsed.tokens.products, store=store
+        )
+        if 'error' in record:
+            raise PipelineError(record['error'])
+    elif mode == "empirical":
+        result = CHEMaths.Molecule.from_ratio(
+            parsed.arguments, latex=True, parsed=dict(zip(parsed.tokens.reactants, parsed.reactants))
+        )
+    elif mode == "organic":
+        organic_mode, size = parsed.arguments
+        result = ORGANIC_GROUPS[organic_mode](size)
+    elif mode == "polymer":
+        end_groups = collections.Counter()
+        for end_group in parsed.reactants[1:]:
+            end_groups.update(end_group)
+        result = CHEMaths.Polymer(parsed.reactants[0], parsed.arguments, dict(end_groups), parsed.tokens.latex)
+        record = polymer_record(result)
+    return Analysis(parsed, result, record)
+
+
+def serialize(analysis: Analysis) -> dict:
+    """Convert the analysis to the JSON-serializable response of /live_preview"""
+    parsed, result, record = analysis
+    mode = parsed.tokens.mode
+    if mode == "this":
+        return {'mode': mode, 'syntax': True, 'error': WELCOME_MESSAGE}
+    elif mode == "molecule":
+        return {
+            'error': None,
+            'mode': mode,
+            'syntax': True,
+            'molecule': parsed.reactants[0],
+            'info': record
+        }
+    elif mode == "equation":
+        return {
+            'mode': mode,
+            'syntax': True,
+            'parsed': [parsed.reactants, parsed.products],
+            'reaction_type': record['reaction_type'],
+            'reactants': parsed.tokens.reactants,
+            'products': parsed.tokens.products,
+            'coefficients': record['coefficients'],
+            'mr': record['mr'],
+            'error': None
+        }
+    elif mode == "empirical":
+        return {
+            'error': None,
+            'mode': mode,
+            'syntax': True,
+            'molecule': result.molecular_formula,
+            'empirical-formula': result.latex_molecular_formula,
+            'mr': result.mr
+        }
+    elif mode == "organic":
+        return {
+            'organic-name': result.get_name().capitalize(),
+            'molecular-formula': result.molecule.latex_molecular_formula,
+            'condensed-structural-formula': result.get_condensed_structural_formula(),
+            'isomers-number': result.calculate_isomer_numbers(),
+            'combustion-enthalpy': str(result.calculate_combustion_enthalpy()) + " kJ mol<sup>-1</sup>",
+            'lewis-structure': result.get_lewis(sep='<br/>'),
+            'mode': mode,
+            'syntax': True
+        }
+    elif mode == "polymer":
+        return dict(record, error=None, mode=mode, syntax=True)
+    return {'error': None, 'mode': mode, 'syntax': True}
+
+
+def run(raw_latex: str, cache=None, store=None) -> dict:
+    """Run every stage on a raw latex string and return the response for /live_preview
+    cache: optional shared_cache.SharedCache holding responses by normalized latex
+    store: optional result_store.ResultStore holding analyses by canonical composition"""
+    latex = normalize(raw_latex)
+    if cache is not None:
+        response = cache.get(f"run:{latex}")
+        if response is not None:
+            return response
+    mode = detect_mode(latex)
+    try:
+        response = serialize(analyze(validate(parse(tokenize(latex, mode))), store=store))
+    except PipelineError as error:
+        response = {'error': str(error), 'mode': mode, 'syntax': False}
+    if cache is not None:
+        cache.put(f"run:{latex}", response)
+    return response
+
+
+def shell_tokens(line: str) -> Tokens:
+    """Split a line typed in the shell (plain text such as 'CH4 + O2 -> CO2 + H2O', 'Alkane: 5' or a molecule)
+    into species, as tokenize splits latex"""
+    if '->' in line:
+        sides = line.split('->')
+        if len(sides) != 2:
+            raise PipelineError("'->' is misplaced")
+        if not sides[0].strip():
+            raise PipelineError("No reactant found")
+        if not sides[1].strip():
+            raise PipelineError("No product found")
+        reactants, products = [[species.strip() for species in side.split(' + ')] for side in sides]
+        return Tokens("equation", line, reactants, products, None)
+    if "alkane" in line.lower():
+        line = line.replace(" ", "")
+        if ":" not in line:
+            raise PipelineError("expected input format: 'Alkane: <size>'")
+        return Tokens("organic", line, [], [], ("alkane", line.split(":")[1]))
+    return Tokens("molecule", line, [line], [], None)
+
+
+def launch_shell(profile_dir=None):
+    """Interactive shell: a formula, an equation or an alkane goes through the stages from parse on
+    If profile_dir is given, each input is profiled and written to that directory"""
+    while True:
+        print("===START===")
+        formula = input("Enter a formula or equation to balance (enter if you don't): ")
+        with Profile(profile_dir, label=formula or "empirical", timer=time.process_time):
+            start = time.process_time()
+            if not formula:
+                elements = {}
+                print("Enter elements and their associated mass / percentage; enter to end")
+                while True:
+                    ele = input("Element: ")
+                    if ele == '':
+                        break
+                    weight = input(ele + " (" + str(CHEMaths.relative_atomic_mass[ele]) + "): ")
+                    elements[ele] = simple_eval(weight)
+                start = time.process_time()
+                print(CHEMaths.Molecule.from_ratio(elements))
+            else:
+                try:
+                    tokens = shell_tokens(formula)
+                    mass_input, mole_input = None, None
+                    if tokens.mode == "molecule":
+                        mass_input = input("Mass (g): ")
+                        if not mass_input:
+                            mole_input = input("Mole (mol): ")
+                        start = time.process_time()
+                    analysis = analyze(validate(parse(tokens, parse_species=parse_plain_molecule)))
+                except PipelineError as error:
+                    print(error)
+                else:
+                    if tokens.mode == "equation":
+                        equation = analysis.result
+                        print(equation.get_balanced_string())
+                        if input("Proceed to calculate mass / mole? [Y / n] ") == 'Y':
+                            masses, moles = [], []
+                            for chemical in tokens.reactants + tokens.products:
+                                mass_input = input(f"Mass (g) of {chemical}: ")
+                                mole_input = input(f"Mole (mol) of {chemical}: ") if not mass_input else None
+                                masses.append(simple_eval(mass_input) if mass_input else None)
+                                moles.append(simple_eval(mole_input) if mole_input else None)
+                            start = time.process_time()
+                            amounts = equation_amounts(analysis.record, masses, moles)
+                            print('\n'.join([
+                                f"{chemical}: {mass} g <=> {mole} mol" for chemical, mass, mole in zip(
+                                    tokens.reactants + tokens.products,
+                                    amounts['reaction_masses'], amounts['reaction_moles']
+                                )
+                            ]))
+                    elif tokens.mode == "organic":
+                        print(analysis.result)
+                    else:
+                        molecule = analysis.result
+                        if mass_input:
+                            molecule.mass = simple_eval(mass_input)
+                            molecule.mole = molecule.calculate_mole(molecule.mass)
+                        elif mole_input:
+                            molecule.mole = simple_eval(mole_input)
+                            molecule.mass = molecule.calculate_mass(molecule.mole)
+                        print(molecule)
+        time_end = time.process_time()
+        time_taken = round(time_end - start, 6)
+        print("===END:", time_taken, "seconds===\n")
+
+
+if __name__ == '__main__':
+    for latex_input in sys.argv[1:] or (line.rstrip('\n') for line in sys.stdin):
+        print(json.dumps(run(latex_input), default=str))
@@ -0,0 +1,124 @@
+# coding=utf-8
+"""Opt-in profiling for CHEMaths (shell, batch jobs and sampled web requests)
+Each profile is written twice:
+    - <name>.pstats: raw cProfile dump, readable with `python -m pstats`
+    - <name>.folded: collapsed stacks (`frame;frame;frame count`), ready for flamegraph.pl or speedscope
+Nothing here runs unless a profile directory is given, so the default behaviour is unchanged.
+A directory keeps at most MAX_PROFILES profiles: the oldest are removed as new ones are written."""
+import collections
+import cProfile
+import glob
+import hmac
+import os
+import pstats
+import random
+import re
+import time
+
+MAX_STACK_DEPTH = 64  # collapsed stacks deeper than this are truncated
+MAX_PROFILES = 200  # profiles kept per directory (each is a .pstats and a .folded file)
+
+
+def format_function(function: tuple) -> str:
+    """Return a short, flamegraph friendly label for a pstats function key (filename, line, name)"""
+    filename, line, name = function
+    if filename == '~':  # built-in functions have no source file
+        return name.replace(';', ',')
+    return f"{os.path.basename(filename)}:{name}:{line}".replace(';', ',')
+
+
+def collapse_stats(stats: pstats.Stats) -> list:
+    """Convert profile statistics to collapsed stacks, weighted in microseconds
+    cProfile only records caller -> callee edges, so the time of a function is split between its callers
+    in proportion to the time each edge contributed (the same approximation used by gprof2dot)"""
+    raw_stats = stats.stats  # {function: (primitive calls, total calls, self time, cumulative time, callers)}
+    callees = collections.defaultdict(list)
+    for function, (_, _, _, _, callers) in raw_stats.items():
+        for caller, (_, _, _, edge_cumulative_time) in callers.items():
+            callees[caller].append((function, edge_cumulative_time))
+
+    stacks = collections.Counter()
+    to_visit = [
+        ((function,), entry[3]) for function, entry in raw_stats.items() if not entry[4]
+    ]  # (path, time of the last function spent on this path)
+    while to_visit:
+        path, weight = to_visit.pop()
+        function = path[-1]
+        _, _, self_time, cumulative_time, _ = raw_stats[function]
+        share = weight / cumulative_time if cumulative_time else 0
+        stacks[path] += self_time * share
+        if len(path) >= MAX_STACK_DEPTH:
+            continue
+        for callee, edge_cumulative_time in callees[function]:
+            callee_weight = edge_cumulative_time * share
+            if callee not in path and callee_weight >= 1e-6:  # skip recursion and sub-microsecond paths
+                to_visit.append((path + (callee,), callee_weight))
+
+    return [
+        f"{';'.join(format_function(function) for function in path)} {round(weight * 1e6)}"
+        for path, weight in sorted(stacks.items()) if round(weight * 1e6)
+    ]
+
+
+def remove_old_profiles(directory: str, keep: int):
+    """Remove the oldest profiles of the directory so that at most `keep` remain"""
+    profiles = sorted(glob.glob(os.path.join(glob.escape(directory), '*.pstats')), key=os.path.getmtime)
+    for path in profiles[:max(0, len(profiles) - keep)]:
+        for stale in (path, path[:-len('.pstats')] + '.folded'):
+            try:
+                os.remove(stale)
+            except OSError:  # removed by another worker meanwhile
+                pass
+
+
+def write_profile(profiler: cProfile.Profile, directory: str, label: str, max_profiles=MAX_PROFILES) -> str:
+    """Dump the profiler to `directory` as .pstats and .folded files, keeping at most max_profiles profiles there
+    Return the common path (without extension) of the two files"""
+    os.makedirs(directory, exist_ok=True)
+    remove_old_profiles(directory, max_profiles - 1)
+    safe_label = re.sub(r"[^A-Za-z0-9_.-]+", '_', label)[:64] or 'profile'
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe_label}")
+    while os.path.exists(path + '.pstats'):  # several profiles within the same second
+        path += '_'
+    profiler.dump_stats(path + '.pstats')
+    with open(path + '.folded', 'w') as folded:
+        folded.write('\n'.join(collapse_stats(pstats.Stats(profiler))) + '\n')
+    return path
+
+
+class Profile:
+    """Context manager profiling the enclosed block when a directory is given, doing nothing otherwise
+    Ex: with Profile('profiles', label='CH_4'): ..."""
+
+    def __init__(self, directory=None, label='profile', timer=None, max_profiles=MAX_PROFILES):
+        self.directory = directory
+        self.label = label
+        self.timer = timer  # e.g. time.process_time to ignore time spent waiting for input
+        self.max_profiles = max_profiles
+        self.profiler = None
+        self.path = None
+
+    def __enter__(self) -> 'Profile':
+        if self.directory:
+            self.profiler = cProfile.Profile(self.timer) if self.timer else cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:  # another profiler is already active: never let profiling break the caller
+                self.profiler = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if self.profiler:
+            self.profiler.disable()
+            self.path = write_profile(self.profiler, self.directory, self.label, self.max_profiles)
+            self.profiler = None
+        return False
+
+
+def should_sample(rate: float, header_value=None, token=None) -> bool:
+    """Decide whether a web request should be profiled
+    Requests are sampled at `rate` (0 to 1), or forced by a profiling header holding the secret token
+    (never forced without a token, so that anonymous clients cannot make every request write a profile)"""
+    if token and header_value and hmac.compare_digest(header_value.encode(), token.encode()):
+        return True
+    return rate > 0 and random.random() < rate
@@ -0,0 +1,187 @@
+# coding=utf-8
+"""Persistent store of computed analyses, kept in a local SQLite file across deploys
+Molecules are keyed by their canonical composition (sorted elements and charge) and reactions by the canonical
+compositions of their species, so 'OH_2' and 'H_2O' or 'O_2+H_2' and 'H_2+O_2' share one record.
+Records hold what the website shows: Mr, percentages and oxidation numbers of a molecule;
+coefficients, Mr and reaction type of a reaction (or the reason it cannot be balanced).
+Rows are tagged with a digest of data.json and dropped when it changes.
+warm_up() runs a list of common inputs at boot so that their records are in memory before the first request."""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import pipeline
+from shared_cache import content_version
+
+STORE_FORMAT = 1  # bump when the content of the records changes
+MEMORY_ENTRIES = 10000
+
+
+def molecule_key(molecular_formula: dict) -> str:
+    """Canonical key of a parsed molecule"""
+    elements = sorted((element, count) for element, count in molecular_formula.items() if element != 'sign' and count)
+    return ''.join(f"{element}{count}" for element, count in elements) + f"^{molecular_formula.get('sign', 0)}"
+
+
+def reaction_order(reactants: list, products: list) -> list:
+    """Indices of the species of a reaction in canonical order (reactants first, each side sorted by key)"""
+    keys = [molecule_key(molecule) for molecule in reactants + products]
+    return sorted(range(len(reactants)), key=lambda i: keys[i]) + \
+        sorted(range(len(reactants), len(keys)), key=lambda i: keys[i])
+
+
+def reaction_key(reactants: list, products: list) -> str:
+    """Canonical key of a reaction between parsed molecules"""
+    species = reactants + products
+    keys = [molecule_key(species[i]) for i in reaction_order(reactants, products)]
+    return '+'.join(keys[:len(reactants)]) + '->' + '+'.join(keys[len(reactants):])
+
+
+class ResultStore:
+    """SQLite-backed records with an in-memory LRU layer in front
+    Each thread of each process gets its own connection; several workers can share the file"""
+
+    def __init__(self, path: str, version=None):
+        self.path = path
+        self.version = f"{STORE_FORMAT}:{version or content_version('static/data.json')}"
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.stats_counter = dict.fromkeys(['memory_hits', 'disk_hits', 'misses', 'stores', 'errors'], 0)
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (version TEXT, key TEXT, value TEXT, PRIMARY KEY (version, key))"
+            )
+            connection.execute("DELETE FROM results WHERE version != ?", (self.version,))
+
+    def connect(self) -> sqlite3.Connection:
+        """Connection of the current thread, opened again in a forked process"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=10)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def count(self, counter: str):
+        """Increment one of the counters"""
+        with self.lock:
+            self.stats_counter[counter] += 1
+
+    def remember(self, key: str, record: dict):
+        """Put a record in the in-memory layer, dropping the least recently used one if full"""
+        with self.lock:
+            self.memory[key] = record
+            self.memory.move_to_end(key)
+            if len(self.memory) > MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        """Return the record of a canonical key, None if it has not been computed yet"""
+        with self.lock:
+            record = self.memory.get(key)
+            if record is not None:
+                self.memory.move_to_end(key)
+                self.stats_counter['memory_hits'] += 1
+                return record
+        try:
+            row = self.connect().execute(
+                "SELECT value FROM results WHERE version = ? AND key = ?", (self.version, key)
+            ).fetchone()
+        except sqlite3.Error:
+            self.count('errors')
+            row = None
+        if row is None:
+            self.count('misses')
+            return None
+        record = json.loads(row[0])
+        self.remember(key, record)
+        self.count('disk_hits')
+        return record
+
+    def put(self, key: str, record: dict):
+        """Save the record of a canonical key (a record that cannot be saved is still kept in memory)"""
+        self.remember(key, record)
+        try:
+            connection = self.connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (self.version, key, json.dumps(record))
+                )
+        except sqlite3.Error:
+            self.count('errors')
+        else:
+            self.count('stores')
+
+    def get_molecule(self, molecular_formula: dict):
+        """Record of a molecule, with its dictionaries in the element order of the given formula"""
+        record = self.get('molecule:' + molecule_key(molecular_formula))
+        if record is None:
+            return None
+        return {
+            name: {element: value[element] for element in molecular_formula if element in value}
+            if isinstance(value, dict) else value
+            for name, value in record.items()
+        }
+
+    def put_molecule(self, molecular_formula: dict, record: dict):
+        """Save the record of a molecule"""
+        self.put('molecule:' + molecule_key(molecular_formula), record)
+
+    def get_reaction(self, reactants: list, products: list):
+        """Record of a reaction, with its lists in the order of the given species"""
+        record = self.get('reaction:' + reaction_key(reactants, products))
+        if record is None:
+            return None
+        order = reaction_order(reactants, products)
+        restored = dict(record)
+        for name, value in record.items():
+            if isinstance(value, list):
+                restored[name] = [None] * len(value)
+                for canonical_position, position in enumerate(order):
+                    restored[name][position] = value[canonical_position]
+        return restored
+
+    def put_reaction(self, reactants: list, products: list, record: dict):
+        """Save the record of a reaction, its lists (one value per species) being stored in canonical order"""
+        order = reaction_order(reactants, products)
+        self.put('reaction:' + reaction_key(reactants, products), {
+            name: [value[position] for position in order] if isinstance(value, list) else value
+            for name, value in record.items()
+        })
+
+    def stats(self) -> dict:
+        """Counters of the current process"""
+        with self.lock:
+            stats = dict(self.stats_counter)
+            stats['memory_entries'] = len(self.memory)
+        stats['version'] = self.version
+        return stats
+
+
+def read_warm_up_list(path: str) -> list:
+    """Latex inputs of a warm-up file, one per line ('#' starts a comment)"""
+    with open(path) as warm_up_file:
+        return [line.split('#')[0].strip() for line in warm_up_file if line.split('#')[0].strip()]
+
+
+def warm_up(store: ResultStore, inputs: list, cache=None) -> int:
+    """Run common inputs through the pipeline so that their records are loaded (or computed) before any request
+    Return the number of inputs processed"""
+    for latex in inputs:
+        pipeline.run(latex, cache=cache, store=store)
+    return len(inputs)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Fill a result store with the inputs of a warm-up file")
+    parser.add_argument('store')
+    parser.add_argument('warm_up_file')
+    arguments = parser.parse_args()
+    result_store = ResultStore(arguments.store)
+    start = time.perf_counter()
+    count = warm_up(result_store, read_warm_up_list(arguments.warm_up_file))
+    print(f"{count} inputs in {time.perf_counter() - start:.3f} s: {result_store.stats()}")
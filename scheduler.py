@@ -0,0 +1,203 @@
+# coding=utf-8
+"""Scheduling of /live_preview requests by estimated cost
+Cheap requests (a molecule, a small equation, a short alkane...) are answered inline by the worker.
+Expensive ones (a large organic size, an equation with many species, a very long input) run on a small process
+pool owned by the worker, behind a bounded queue: the GIL and the CPU of the worker stay free for the cheap
+requests of its other threads (run gunicorn with --threads), and when the queue is full the request is refused
+at once with Overloaded instead of waiting behind the others. A computation that times out has the processes
+of the pool killed (a new pool starts with the next request), so that it neither keeps its place nor blocks shutdown:
+the pool processes report their pid when they start, so the scheduler knows which processes to kill.
+The pool processes are started by a forkserver, not forked from the worker: its other threads may hold locks
+(pipeline.REDUCTIONS.lock, logging...) at the time of the fork.
+Queue depth, wait and run times are counted for /stats."""
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import pipeline
+from concurrent.futures.process import BrokenProcessPool
+
+CHEAP = 'cheap'
+HEAVY = 'heavy'
+# carbons: pipeline.run takes about 20 ms for alkane::120, 40 ms at 150, 90 ms at 200 (about n^2.8)
+ORGANIC_INLINE_SIZE = 120
+EQUATION_INLINE_SPECIES = 8
+INLINE_LENGTH = 300  # characters of latex
+RECENT_TIMINGS = 256
+# pool processes are not forked from the (threaded) worker; forkserver is POSIX only
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class Overloaded(Exception):
+    """The queue of expensive requests is full; the message is meant for the user"""
+
+
+def estimate_cost(latex: str) -> str:
+    """Cost class (CHEAP or HEAVY) of the normalized latex of a request, from its mode, species and size"""
+    if len(latex) > INLINE_LENGTH:
+        return HEAVY
+    mode = pipeline.detect_mode(latex)
+    try:
+        tokens = pipeline.tokenize(latex, mode)
+    except pipeline.PipelineError:  # answered at once with the error
+        return CHEAP
+    if mode == "organic":
+        size = tokens.arguments[1]
+        if size.isdigit() and ORGANIC_INLINE_SIZE < int(size) <= pipeline.ORGANIC_MAX_SIZE:  # else refused at once
+            return HEAVY
+    elif mode == "equation" and len(tokens.reactants) + len(tokens.products) > EQUATION_INLINE_SPECIES:
+        return HEAVY
+    return CHEAP
+
+
+def report_pid(pids):
+    """Initializer of the pool processes: put the pid of the process in the queue of its pool"""
+    pids.put(os.getpid())
+
+
+def run_heavy(latex: str) -> tuple:
+    """Run the pipeline in a pool process; return the response, when it started and how long it took"""
+    started = time.time()
+    response = pipeline.run(latex)
+    return response, started, time.time() - started
+
+
+def summarize(timings) -> dict:
+    """Mean, median, 95th percentile and maximum of recent timings, in ms"""
+    if not timings:
+        return {'mean': None, 'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(timings)
+    return {
+        'mean': sum(ordered) / len(ordered) * 1000,
+        'p50': ordered[len(ordered) // 2] * 1000,
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max': ordered[-1] * 1000
+    }
+
+
+class Scheduler:
+    """Answer cheap requests inline and expensive ones on a bounded process pool
+    processes: size of the pool (0: everything inline); max_pending: expensive requests queued or running
+    beyond which Overloaded is raised; timeout: seconds to wait for an expensive result"""
+
+    def __init__(self, processes=1, max_pending=8, timeout=30):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        self.worker_pids = {}  # pool -> queue of the pids reported by its processes
+        self.pending = 0
+        self.counters = dict.fromkeys(['inline', 'heavy', 'rejected', 'timeouts', 'errors'], 0)
+        self.max_pending_seen = 0
+        self.waits = collections.deque(maxlen=RECENT_TIMINGS)
+        self.runs = collections.deque(maxlen=RECENT_TIMINGS)
+
+    def ensure_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Pool of the current process, started on first use (a forked worker does not share its parent's)"""
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                context = multiprocessing.get_context(START_METHOD)
+                if START_METHOD == 'forkserver':
+                    context.set_forkserver_preload(['scheduler'])
+                pids = context.SimpleQueue()
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=context, initializer=report_pid, initargs=(pids,)
+                )
+                self.worker_pids = {self.executor: pids}  # the pools of a parent process are not ours to kill
+            return self.executor
+
+    def release(self, _=None):
+        """Free the place of an expensive request in the queue"""
+        with self.lock:
+            self.pending -= 1
+
+    def reset(self, executor: concurrent.futures.ProcessPoolExecutor, counter='errors'):
+        """Start a new pool next time: a process of this pool died
+        Return the queue of the pids of its processes (None once the pool has been reset)"""
+        with self.lock:
+            self.counters[counter] += 1
+            if self.executor is executor:
+                self.executor = None
+            return self.worker_pids.pop(executor, None)
+
+    def terminate(self, executor: concurrent.futures.ProcessPoolExecutor):
+        """Kill the processes of a pool whose computation timed out (the pool breaks: the requests running on it
+        fail at once and free their places) and start a new pool next time"""
+        pids = self.reset(executor, counter='timeouts')
+        while pids is not None and not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except ProcessLookupError:  # already gone
+                pass
+        executor.shutdown(wait=False)
+
+    def count(self, counter: str):
+        """Increment one of the counters"""
+        with self.lock:
+            self.counters[counter] += 1
+
+    def run(self, raw_latex: str, cache=None, store=None) -> dict:
+        """Response of /live_preview for a raw latex string, computed inline or on the pool depending on its cost
+        A cached response is returned inline whatever its cost; an expensive one is cached once computed
+        (the pool processes do not use the result store). Raise Overloaded if the pool's queue is full."""
+        latex = pipeline.normalize(raw_latex)
+        if not self.processes or estimate_cost(latex) == CHEAP:
+            self.count('inline')
+            return pipeline.run(latex, cache=cache, store=store)
+        if cache is not None:
+            response = cache.get(f"run:{latex}")
+            if response is not None:
+                self.count('inline')
+                return response
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counters['rejected'] += 1
+                raise Overloaded("The server is busy with long computations, please try again in a moment")
+            self.pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self.pending)
+            self.counters['heavy'] += 1
+        submitted = time.time()
+        executor = self.ensure_executor()
+        try:
+            future = executor.submit(run_heavy, latex)
+        except (BrokenProcessPool, RuntimeError):
+            self.release()
+            self.reset(executor)
+            raise Overloaded("The computation failed, please try again")
+        # the place is freed once the pool is done with the request: killed along with the pool if it times out
+        future.add_done_callback(self.release)
+        try:
+            response, started, duration = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            self.terminate(executor)
+            raise Overloaded("This computation takes too long, please try a smaller input")
+        except BrokenProcessPool:
+            self.reset(executor)
+            raise Overloaded("The computation failed, please try again")
+        with self.lock:
+            self.waits.append(max(0.0, started - submitted))
+            self.runs.append(duration)
+        if cache is not None:
+            cache.put(f"run:{latex}", response)
+        return response
+
+    def stats(self) -> dict:
+        """Counters, queue depth and recent wait / run times (ms) of the current process"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'processes': self.processes,
+                'max_pending': self.max_pending,
+                'queue_depth': self.pending,
+                'max_queue_depth': self.max_pending_seen,
+                'wait_ms': summarize(self.waits),
+                'run_ms': summarize(self.runs)
+            })
+        return stats
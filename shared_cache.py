@@ -0,0 +1,222 @@
+# coding=utf-8
+"""Result cache shared by the worker processes of one host (e.g. gunicorn workers)
+The cache is a memory-mapped file (put it on /dev/shm) split into fixed-size slots:
+    header | slot 0 | slot 1 | ... where each slot is digest (16 bytes) | length | last use | JSON payload
+The key digest is keyed with the version digest, so a worker still running an older version after the file was
+re-initialised for a newer one never reads (or serves) the results of the other version.
+Slots are grouped in sets of `ways`; a key can only live in the set its digest points to, and the least
+recently used slot of the set is evicted when the set is full. Each set is locked with fcntl while in use,
+so memory stays at the size of the file whatever the number of workers.
+A process forked after opening the cache (gunicorn --preload) reopens the file on first use,
+and counts its own hits and misses and reports its resident memory (see resident_memory)."""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX: only one process can use the cache safely
+    fcntl = None
+
+MAGIC = b'CHMCACHE'
+HEADER = struct.Struct('<8sIII32s')  # magic, slots, slot size, ways, version digest
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct('<16sId')  # key digest, payload length (0: empty slot), last use
+EMPTY_DIGEST = bytes(16)
+
+
+def content_version(*paths) -> str:
+    """Digest of the content of some files, to invalidate cached results when they change"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as content:
+            digest.update(content.read())
+    return digest.hexdigest()
+
+
+def resident_memory() -> dict:
+    """Resident memory of the current process in bytes, and the part shared with other processes (such as the
+    pages of the cache file), from /proc/self/statm; None where it is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            _, resident, shared = [int(pages) for pages in statm.read().split()[:3]]
+    except (OSError, ValueError):
+        return {'resident_bytes': None, 'resident_shared_bytes': None}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return {'resident_bytes': resident * page_size, 'resident_shared_bytes': shared * page_size}
+
+
+class SharedCache:
+    """Fixed-size set-associative cache of JSON-serializable values, shared through a memory-mapped file"""
+
+    def __init__(self, path: str, slots=4096, slot_size=4096, ways=4, version=''):
+        """version: results cached under another version are dropped (None: keep the version of the file)"""
+        if slots % ways:
+            raise ValueError("the number of slots should be a multiple of ways")
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError(f"slot_size should be larger than {SLOT_HEADER.size} bytes")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = slots // ways
+        self.size = HEADER_SIZE + slots * slot_size
+        self.version = version
+        self.pid = None
+        self.memory = None
+        self.open()
+
+    def open(self):
+        """Map the file (again, in a forked process), initializing it if its layout or version differs"""
+        if self.memory is not None:  # inherited from the parent process
+            self.memory.close()
+            os.close(self.file_descriptor)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.stats_counter = dict.fromkeys(['hits', 'misses', 'stores', 'evictions', 'oversize', 'errors'], 0)
+        self.file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock_range(0, 0, exclusive=True)  # whole file
+        try:
+            current = os.pread(self.file_descriptor, HEADER.size, 0)
+            version_digest = hashlib.sha256(self.version.encode()).digest() if self.version is not None \
+                else current[-32:].rjust(32, b'\0')
+            header = HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways, version_digest)
+            if os.fstat(self.file_descriptor).st_size != self.size or current != header:
+                os.ftruncate(self.file_descriptor, 0)
+                os.ftruncate(self.file_descriptor, self.size)  # zero filled: every slot is empty
+                os.pwrite(self.file_descriptor, header, 0)
+            self.version_digest = version_digest
+            self.memory = mmap.mmap(self.file_descriptor, self.size)
+        finally:
+            self.unlock_range(0, 0)
+
+    def ensure_open(self):
+        """Reopen the file after a fork: locks and mappings are not meant to be shared with the parent"""
+        if self.pid != os.getpid():
+            self.open()
+
+    def lock_range(self, start: int, length: int, exclusive=True):
+        """Lock bytes of the file against other processes (a length of 0 locks up to the end)"""
+        if fcntl is not None:
+            fcntl.lockf(self.file_descriptor, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, start)
+
+    def unlock_range(self, start: int, length: int):
+        """Release a lock taken with lock_range"""
+        if fcntl is not None:
+            fcntl.lockf(self.file_descriptor, fcntl.LOCK_UN, length, start)
+
+    def locate(self, key: str) -> tuple:
+        """Digest of the key (under the version of this process) and offset of the first slot of its set"""
+        digest = hashlib.blake2b(key.encode(), digest_size=16, key=self.version_digest).digest()
+        set_index = int.from_bytes(digest[:8], 'little') % self.sets
+        return digest, HEADER_SIZE + set_index * self.ways * self.slot_size
+
+    def get(self, key: str):
+        """Return the cached value of the key, None if it is not cached"""
+        self.ensure_open()
+        digest, set_offset = self.locate(key)
+        set_length = self.ways * self.slot_size
+        with self.lock:
+            self.lock_range(set_offset, set_length)
+            try:
+                for offset in range(set_offset, set_offset + set_length, self.slot_size):
+                    slot_digest, length, _ = SLOT_HEADER.unpack_from(self.memory, offset)
+                    if length and slot_digest == digest:
+                        SLOT_HEADER.pack_into(self.memory, offset, digest, length, time.time())
+                        payload = self.memory[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+                        break
+                else:
+                    self.stats_counter['misses'] += 1
+                    return None
+            finally:
+                self.unlock_range(set_offset, set_length)
+            try:
+                value = json.loads(payload.decode())
+            except ValueError:  # torn write from a crashed process
+                self.stats_counter['errors'] += 1
+                self.stats_counter['misses'] += 1
+                return None
+            self.stats_counter['hits'] += 1
+            return value
+
+    def put(self, key: str, value) -> bool:
+        """Cache a JSON-serializable value; return False if it is too large for a slot"""
+        self.ensure_open()
+        payload = json.dumps(value, separators=(',', ':'), default=str).encode()
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            with self.lock:
+                self.stats_counter['oversize'] += 1
+            return False
+        digest, set_offset = self.locate(key)
+        set_length = self.ways * self.slot_size
+        with self.lock:
+            self.lock_range(set_offset, set_length)
+            try:
+                victim, victim_used = None, None
+                for offset in range(set_offset, set_offset + set_length, self.slot_size):
+                    slot_digest, length, last_used = SLOT_HEADER.unpack_from(self.memory, offset)
+                    if not length or slot_digest == digest:
+                        victim, victim_used = offset, None
+                        break
+                    if victim is None or last_used < victim_used:
+                        victim, victim_used = offset, last_used
+                if victim_used is not None:
+                    self.stats_counter['evictions'] += 1
+                SLOT_HEADER.pack_into(self.memory, victim, EMPTY_DIGEST, 0, 0)  # readers skip it while written
+                self.memory[victim + SLOT_HEADER.size:victim + SLOT_HEADER.size + len(payload)] = payload
+                SLOT_HEADER.pack_into(self.memory, victim, digest, len(payload), time.time())
+            finally:
+                self.unlock_range(set_offset, set_length)
+            self.stats_counter['stores'] += 1
+        return True
+
+    def clear(self):
+        """Empty every slot"""
+        self.ensure_open()
+        with self.lock:
+            self.lock_range(0, 0)
+            try:
+                self.memory[HEADER_SIZE:] = bytes(self.size - HEADER_SIZE)
+            finally:
+                self.unlock_range(0, 0)
+
+    def stats(self) -> dict:
+        """Counters of the current process (the slots themselves are shared)"""
+        self.ensure_open()
+        with self.lock:
+            stats = dict(self.stats_counter)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'pid': self.pid,
+            'hit_rate': stats['hits'] / lookups if lookups else None,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'ways': self.ways,
+            'bytes': self.size
+        })
+        stats.update(resident_memory())
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect or clear a shared cache file")
+    parser.add_argument('path')
+    parser.add_argument('--clear', action='store_true')
+    arguments = parser.parse_args()
+    with open(arguments.path, 'rb') as cache_file:
+        magic, cache_slots, cache_slot_size, cache_ways, _ = HEADER.unpack(cache_file.read(HEADER.size))
+    if magic != MAGIC:
+        raise SystemExit(f"{arguments.path}: not a cache file")
+    cache = SharedCache(arguments.path, cache_slots, cache_slot_size, cache_ways, version=None)
+    if arguments.clear:
+        cache.clear()
+    used = sum(
+        bool(SLOT_HEADER.unpack_from(cache.memory, HEADER_SIZE + index * cache_slot_size)[1])
+        for index in range(cache_slots)
+    )
+    print(f"{used} / {cache_slots} slots used ({cache_slot_size} bytes each, {cache_ways}-way)")
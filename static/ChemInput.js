@@ -1,5 +1,5 @@
 var modes = [
-    "this", "molecule", "equation", "empirical", "organic"
+    "this", "molecule", "equation", "empirical", "organic", "polymer"
 ];
 var count = 0;  // keep record of how many times render_results is called
 var MQ = MathQuill.getInterface(2);
@@ -7,6 +7,8 @@ var mainField;  // global variable
 var molecule_mass_entry, molecule_mole_entry, masses_input, moles_input;
 var currentMode = 'this';
 var urlData;  // pre-written in index.html
+var initialResult;  // pre-written in index.html: the response of /live_preview for urlData.Input, computed by the server
+var restoring = false;  // true while the page of a permalink is rendered from initialResult: nothing is requested
 
 
 function retrieveUrlData() {
@@ -78,7 +80,8 @@ function renderResult(result) {
             // Molar mass TODO: add option to change units ?
             $('#molar_mass').html('<div></div> g / mol')
             $('#molar_mass>div').data('fullfloat', result.info.mr);
-            python_round([result.info.mr], $('input#molar_mass_precision').val(), function (response) {
+            round_values([result.info.mr], $('input#molar_mass_precision').val(),
+                         result.rounded && [result.rounded.mr], function (response) {
                 $('#molar_mass>div').html(response.result);
             });
 
@@ -93,7 +96,9 @@ function renderResult(result) {
             });
             $("#components").html('');  //clean up components
             var precision = $('#components_precision').val();
-            python_round(array_to_round, precision, function (rounded_array) {
+            round_values(array_to_round, precision, result.rounded && sorted_elements.map(function (x) {
+                return result.rounded.element_percentages[x];
+            }), function (rounded_array) {
                 var element;
                 var percentage;
                 for (var i = 0; i < sorted_elements.length; i++) {
@@ -218,6 +223,13 @@ function renderResult(result) {
                 }
             })
             molecule_mass_entry.latex(urlData.inputs.mass ? urlData.inputs.mass : '');
+            if (restoring && result.mass_mole) {
+                if (result.mass_mole.mass) {
+                    molecule_mass_entry.latex(result.mass_mole.mass);
+                } else if (result.mass_mole.mole) {
+                    molecule_mole_entry.latex(result.mass_mole.mole);
+                }
+            }
 
             // Set all precision range inputs to 2
             $.makeArray($('.precision')).map(function (slider) {
@@ -244,6 +256,9 @@ function renderResult(result) {
             supSubsRequireOperand: true,
             handlers: {
                 edit: function(mathField) {
+                    if (restoring) {
+                        return;  // the amounts of the permalink come with initialResult
+                    }
                     var mass_array_latex = [];
                     var mole_array_latex = [];
                     masses_input.forEach(function (MQinput, _, _) {
@@ -263,16 +278,7 @@ function renderResult(result) {
                         }),
                         contentType: "application/json; charset=utf-8",
                         dataType: "json",
-                        success: function (data) {
-                            console.log(data);
-                            reaction_masses = data.reaction_masses;
-                            reaction_moles = data.reaction_moles;
-                            for (var i = 0; i < reaction_masses.length; i++) {
-                                index = i * 2;
-                                $('#equation-reaction-mass' + index).text(reaction_masses[i]);
-                                $('#equation-reaction-mole' + index).text(reaction_moles[i]);
-                            }
-                        }
+                        success: renderReactionAmounts
                     })
                 },
             }
@@ -393,9 +399,34 @@ function renderResult(result) {
                 masses_input[i].latex(urlData.inputs.masses[i] ? urlData.inputs.masses[i] : '');
                 moles_input[i].latex(urlData.inputs.moles[i] ? urlData.inputs.moles[i] : '');
             }
+            if (restoring && result.mass_mole) {
+                renderReactionAmounts(result.mass_mole);
+            }
         }
     } else if (mode == "empirical") {
-        // TODO this and fix float point issues
+        if (error) {
+            $('#empirical-formula').html('<p class=error>' + error + '</p>');
+        } else {
+            $('#empirical-formula').html('<span></span>');
+            MQ.StaticMath($('#empirical-formula>span')[0]).latex(result['empirical-formula']);
+            $('#empirical-mr').html(result.mr);
+        }
+    } else if (mode == "polymer") {
+        if (error) {
+            $('#polymer-repeat-unit').html('<p class=error>' + error + '</p>');
+        } else {
+            $('#polymer-repeat-unit').html('<span></span>');
+            MQ.StaticMath($('#polymer-repeat-unit>span')[0])
+                .latex('(' + result['repeat-unit'] + ')_{' + result.count + '}');
+            MQ.StaticMath($('#polymer-mr>span')[0]).latex(result.mr);
+            $('#polymer-mr-per-unit').html(result['mr-per-unit']);
+            MQ.StaticMath($('#polymer-empirical-formula>span')[0]).latex(result['empirical-formula']);
+            var percentages = [];
+            for (var element in result.element_percentages) {
+                percentages.push(element + ': ' + result.element_percentages[element].toFixed(2) + '%');
+            }
+            $('#polymer-percentages').html(percentages.join(', '));
+        }
     } else if (mode == "organic") {
         var error = result.error;
         if (error) {
@@ -418,6 +449,17 @@ function renderResult(result) {
     count++;
 }
 
+// masses and moles of every species of an equation (response of /mass_mole_equation)
+function renderReactionAmounts(data) {
+    var reaction_masses = data.reaction_masses;
+    var reaction_moles = data.reaction_moles;
+    for (var i = 0; i < reaction_masses.length; i++) {
+        var index = i * 2;
+        $('#equation-reaction-mass' + index).text(reaction_masses[i]);
+        $('#equation-reaction-mole' + index).text(reaction_moles[i]);
+    }
+}
+
 // update render
 function render(mode) {
     for (var i = 0; i < modes.length; i++) {
@@ -464,6 +506,15 @@ function python_round(num_array, precision, callback) {
     });
 }
 
+// round with the values the server computed for a permalink (precomputed), else ask /round
+function round_values(num_array, precision, precomputed, callback) {
+    if (restoring && precomputed) {
+        callback({'result': precomputed});
+    } else {
+        python_round(num_array, precision, callback);
+    }
+}
+
 
 $(document).ready(function () {
     // set up input box
@@ -482,6 +533,9 @@ $(document).ready(function () {
                     latex = mainField.latex();
                 }
 
+                if (restoring) {
+                    return;  // initialResult is rendered instead
+                }
                 // ajax request for live preview
                 $.ajax({
                     url: "/live_preview",
@@ -491,6 +545,12 @@ $(document).ready(function () {
                     },
                     success: function(response){
                         renderResult(response);
+                    },
+                    error: function(xhr) {
+                        // 503: the server is busy with long computations, the response explains it
+                        if (xhr.responseJSON) {
+                            renderResult(xhr.responseJSON);
+                        }
                     }
                 });
             }
@@ -498,7 +558,13 @@ $(document).ready(function () {
     });
 
     mainField.focus();
+    // render the permalink from the state embedded by the server instead of requesting it
+    restoring = initialResult !== undefined && initialResult !== null;
     mainField.latex(urlData.Input);
+    if (restoring) {
+        renderResult(initialResult);
+        restoring = false;
+    }
 
     $('#enter').hover(function () {
         $('#enter')[0].href = '?' + retrieveUrlData();
@@ -564,6 +630,9 @@ $(document).ready(function () {
             case "organic":
                 text = "alkane::5";
                 break;
+            case "polymer":
+                text = "H(C_2H_4)_{n}H";
+                break;
             default:
                 text = "";
         }
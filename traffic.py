@@ -0,0 +1,210 @@
+# coding=utf-8
+"""Traffic capture and replay for CHEMaths_website
+Recording (opt-in): set CHEMATHS_RECORD_FILE and every request is appended to that file as one JSON line
+holding the route, the request body and the timing - no address, header or cookie is kept. Of the body, only
+chemistry (element symbols, latex syntax, numbers) is kept as typed, for replay to reproduce the load; any other
+text is replaced by a digest salted per recorder (see anonymize). Arrival times are absolute (every worker
+appending to the file shares the clock) and made relative to the first request on loading.
+Replay: python traffic.py <recording> [--url http://127.0.0.1:8000] [--concurrency 8] [--speedup 10]
+drives the in-process Flask app (default) or a running server and reports latency percentiles per route"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from CHEMaths import relative_atomic_mass
+
+# words of the chemistry inputs that are not element symbols: latex commands, organic groups and modes
+CHEMISTRY_WORDS = re.compile(
+    r"\\(?:rightarrow|cdot|frac|left|right|times|sqrt)|\\ |alkane|alcohol|this|molecule|equation|empirical|organic|"
+    r"polymer|sign|_\{?[a-z]\}?"  # the last: symbolic repeat counts of polymers
+)
+ELEMENT_SYMBOL = re.compile(r"[A-Z][a-z]?")
+CHEMISTRY_SYNTAX = re.compile(r"[0-9+\-*/.,:;=^_{}()\[\] ]*")
+
+
+def is_chemistry(text: str) -> bool:
+    """Whether a string is made of element symbols, chemistry words, numbers and latex syntax only"""
+    rest = CHEMISTRY_WORDS.sub('', text)
+    symbols = ELEMENT_SYMBOL.findall(rest)
+    return all(symbol in relative_atomic_mass for symbol in symbols) and \
+        bool(CHEMISTRY_SYNTAX.fullmatch(ELEMENT_SYMBOL.sub('', rest)))
+
+
+class TrafficRecorder:
+    """Append-only JSON lines log of requests, safe to share between threads"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.salt = os.urandom(16)  # digests only tell identical texts apart within one recorder
+
+    def anonymize(self, value):
+        """Copy of a request body with every value that is not chemistry (see is_chemistry) replaced by a digest"""
+        if isinstance(value, str):
+            if is_chemistry(value):
+                return value
+            return f"<redacted {hmac.new(self.salt, value.encode(), hashlib.sha256).hexdigest()[:12]}>"
+        if isinstance(value, dict):
+            return {key: self.anonymize(item) for key, item in value.items()}  # keys: names of the fields
+        if isinstance(value, list):
+            return [self.anonymize(item) for item in value]
+        return value
+
+    def record(self, route: str, method: str, args: dict, form: dict, body, status: int, duration: float):
+        """Log one request, its free text anonymized; duration is in seconds"""
+        line = json.dumps({
+            'timestamp': round(time.time() - duration, 6),
+            'route': route,
+            'method': method,
+            'args': self.anonymize(args),
+            'form': self.anonymize(form),
+            'json': self.anonymize(body),
+            'status': status,
+            'duration': round(duration, 6)
+        })
+        with self.lock, open(self.path, 'a') as log:
+            log.write(line + '\n')
+
+
+def load_recording(path: str) -> list:
+    """Read a recording, sorted by arrival time, with the offset of each request from the first one (seconds)"""
+    with open(path) as log:
+        records = [json.loads(line) for line in log if line.strip()]
+    records.sort(key=lambda record: record['timestamp'])
+    origin = records[0]['timestamp'] if records else 0
+    for record in records:
+        record['offset'] = record['timestamp'] - origin
+    return records
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return float('nan')
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def send_with_client(client, record: dict) -> int:
+    """Send a recorded request through a Flask test client, return the status code"""
+    response = client.open(
+        record['route'], method=record['method'], query_string=record['args'],
+        data=record['form'] or None, json=record['json']
+    )
+    return response.status_code
+
+
+def send_over_http(base_url: str, record: dict) -> int:
+    """Send a recorded request to a running server, return the status code"""
+    url = base_url.rstrip('/') + record['route']
+    if record['args']:
+        url += '?' + urllib.parse.urlencode(record['args'], doseq=True)
+    headers = {}
+    data = None
+    if record['json'] is not None:
+        data = json.dumps(record['json']).encode()
+        headers['Content-Type'] = 'application/json'
+    elif record['form']:
+        data = urllib.parse.urlencode(record['form'], doseq=True).encode()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    request = urllib.request.Request(url, data=data, headers=headers, method=record['method'])
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def replay(records: list, app=None, base_url=None, concurrency=4, speedup=1.0) -> dict:
+    """Replay recorded requests against a Flask app (in-process) or a server at base_url
+    Requests keep their recorded inter-arrival times divided by speedup (0 sends them back to back)
+    Return {route: {count, errors, throughput, p50, p90, p99, max}} with latencies in milliseconds"""
+    if (app is None) == (base_url is None):
+        raise ValueError("exactly one of app and base_url should be given")
+    local = threading.local()
+
+    def send(record: dict) -> tuple:
+        """Send one request and time it"""
+        start = time.perf_counter()
+        if app is not None:
+            if not hasattr(local, 'client'):
+                local.client = app.test_client()
+            status = send_with_client(local.client, record)
+        else:
+            status = send_over_http(base_url, record)
+        return record['route'], status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_offset = records[0]['offset'] if records else 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for record in records:
+            if speedup:
+                delay = (record['offset'] - first_offset) / speedup - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(send, record))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    for route, status, latency in results:
+        latencies[route].append(latency * 1000)
+        if status >= 400:
+            errors[route] += 1
+    report = {}
+    for route, route_latencies in sorted(latencies.items()):
+        route_latencies.sort()
+        report[route] = {
+            'count': len(route_latencies),
+            'errors': errors[route],
+            'throughput': len(route_latencies) / elapsed if elapsed else float('inf'),
+            'p50': percentile(route_latencies, 0.5),
+            'p90': percentile(route_latencies, 0.9),
+            'p99': percentile(route_latencies, 0.99),
+            'max': route_latencies[-1]
+        }
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Tabulate a replay report"""
+    lines = [
+        f"{'route':<24}{'count':>8}{'errors':>8}{'req/s':>10}"
+        f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    ]
+    for route, row in report.items():
+        lines.append(
+            f"{route:<24}{row['count']:>8}{row['errors']:>8}{row['throughput']:>10.1f}"
+            f"{row['p50']:>10.2f}{row['p90']:>10.2f}{row['p99']:>10.2f}{row['max']:>10.2f}"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded CHEMaths traffic")
+    parser.add_argument('recording', help="JSON lines file written with CHEMATHS_RECORD_FILE")
+    parser.add_argument('--url', help="base url of a running server (default: in-process Flask test client)")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--speedup', type=float, default=1.0, help="divide recorded delays by this (0: no delay)")
+    arguments = parser.parse_args()
+    if arguments.url:
+        target = {'base_url': arguments.url}
+    else:
+        from CHEMaths_website import app as website
+        target = {'app': website}
+    print(format_report(replay(
+        load_recording(arguments.recording), concurrency=arguments.concurrency, speedup=arguments.speedup, **target
+    )))